@@ -6,6 +6,7 @@ sys.path.append(parent_dir)
 # app.py
 from flask import Flask, request, jsonify
 import chunker.publish_to_pubsub_embed as pbembed
+from chunker.loaders import PartialDocumentError
 
 import logging
 
@@ -27,6 +28,10 @@ def pubsub_to_store_batch(vector_name):
                 return jsonify({'status': 'ok', 'message': 'No action required'}), 201
             file_uploaded = str(meta.get("source", "Could not find a source"))
             return jsonify({'status': 'Success', 'source': file_uploaded}), 200
+        except PartialDocumentError as err:
+            # not acked, so Pub/Sub redelivers it and the document is read again
+            logging.error(f'QNA_ERROR_EMBED: Partly read document for {vector_name}, asking for redelivery: {str(err)}')
+            return {'status': 'error', 'message': f'{str(err)}'}, 500
         except Exception as err:
             logging.error(f'QNA_ERROR_EMBED: Batch Error when sending {data} to {vector_name} pubsub_to_store: {str(err)} traceback: {traceback.format_exc()}')
             return {'status': 'error', 'message':f'{str(err)}'}, 200
@@ -46,10 +51,28 @@ def pubsub_to_store(vector_name):
                 return jsonify({'status': 'ok', 'message': 'No action required'}), 201
             file_uploaded = str(meta.get("source", "Could not find a source"))
             return jsonify({'status': 'Success', 'source': file_uploaded}), 200
+        except PartialDocumentError as err:
+            # not acked, so Pub/Sub redelivers it and the document is read again
+            logging.error(f'QNA_ERROR_EMBED: Partly read document for {vector_name}, asking for redelivery: {str(err)}')
+            return {'status': 'error', 'message': f'{str(err)}'}, 500
         except Exception as err:
             logging.error(f'QNA_ERROR_EMBED: Error when sending {data} to {vector_name} pubsub_to_store: {str(err)} traceback: {traceback.format_exc()}')
             return {'status': 'error', 'message':f'{str(err)}'}, 200
 
+@app.route('/ingest_status/<vector_name>', methods=['GET'])
+def ingest_status(vector_name):
+    """
+    progress of recent ingest jobs, or of the job for ?source= and its parts,
+      with a summary per file type of the last ?hours=
+    """
+    from qna.ingest_jobs import get_jobs, job_summary
+    source = request.args.get('source', None)
+    limit = request.args.get('limit', 20, type=int)
+    hours = request.args.get('hours', 24, type=int)
+
+    return jsonify({'jobs': get_jobs(vector_name, source=source, limit=limit),
+                    'summary': job_summary(vector_name, hours=hours)}), 200
+
 if __name__ == "__main__":
     import os
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)), debug=True)
@@ -109,9 +109,9 @@ def valid_batch_id(input_string:str):
 if __name__ == "__main__":
     import sys
     import logging
-    from chunker.publish_to_pubsub_embed import chunk_doc_to_docs
+    from chunker.publish_to_pubsub_embed import iter_chunk_docs
     from chunker.publish_to_pubsub_embed import process_docs_chunks_vector_name
-    from chunker.loaders import read_file_to_document
+    from chunker.loaders import iter_file_documents
 
     # Get arguments from command line
     gs_file = sys.argv[1]
@@ -120,10 +120,10 @@ if __name__ == "__main__":
 
     
     logging.info("Start batch chunker for {gs_file} to {vector_name}")
-    docs = read_file_to_document(gs_file, vector_name, metadata)
-    logging.info("Finished batch chunker for {gs_file} to {vector_name}")
+    # documents are read, chunked and published as a stream so memory stays bounded
+    docs = iter_file_documents(gs_file, metadata=json.loads(metadata))
 
-    chunks = chunk_doc_to_docs(docs)
+    chunks = iter_chunk_docs(docs)
 
     logging.info("Sending chunks to embed for {gs_file} to {vector_name}")
     process_docs_chunks_vector_name(chunks, vector_name, metadata)
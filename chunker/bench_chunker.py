@@ -0,0 +1,88 @@
+import os, sys
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+
+import random
+import time
+import tracemalloc
+
+from langchain.schema import Document
+
+from chunker.chunking import iter_chunk_docs
+
+# Measures chunking throughput on a large generated (or given) text, e.g.
+#   python chunker/bench_chunker.py --mb 100
+#   python chunker/bench_chunker.py --file big.txt --docs 1
+
+WORDS = ["the", "embedding", "vector", "store", "document", "chunk", "of", "a", "retrieval",
+         "question", "answer", "model", "and", "to", "in", "with", "context", "token"]
+
+def generate_text(size_bytes: int, seed: int=42):
+    """Markdown-ish text of about size_bytes, with headings and paragraphs of mixed length
+    so plenty of pieces fall under min_size and get merged"""
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    section = 0
+    while size < size_bytes:
+        if rng.random() < 0.05:
+            section += 1
+            part = f"\n## Section {section}\n\n"
+        else:
+            words = rng.choice([5, 20, 80, 200, 400])
+            part = " ".join(rng.choice(WORDS) for _ in range(words)) + ".\n\n"
+        parts.append(part)
+        size += len(part)
+    return "".join(parts)
+
+def make_documents(text: str, docs: int):
+    step = max(len(text) // docs, 1)
+    for i in range(0, len(text), step):
+        yield Document(page_content=text[i:i + step], metadata={"source": f"bench_{i // step}"})
+
+def run(text: str, docs: int, extension: str, min_size: int, chunk_size: int, token_budget: bool, memory: bool=False):
+    if memory:
+        # tracing allocations slows chunking down, so throughput is only meaningful without it
+        tracemalloc.start()
+    start = time.perf_counter()
+    chunks = 0
+    chunk_chars = 0
+    for chunk in iter_chunk_docs(make_documents(text, docs), extension=extension, min_size=min_size,
+                                 chunk_size=chunk_size, token_budget=token_budget):
+        chunks += 1
+        chunk_chars += len(chunk.page_content)
+    seconds = time.perf_counter() - start
+    if memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    mb = len(text.encode("utf-8")) / (1024 * 1024)
+    print(f"input: {mb:.1f}MB in {docs} document(s), extension {extension}, min_size {min_size}, "
+          f"chunk_size {chunk_size or 'splitter default'}{' tokens' if token_budget else ''}")
+    print(f"chunks: {chunks} mean length {chunk_chars // max(chunks, 1)} chars")
+    print(f"time: {seconds:.2f}s throughput: {mb / seconds:.2f}MB/s")
+    if memory:
+        print(f"peak traced memory while chunking: {peak / (1024 * 1024):.1f}MB")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the streaming chunker",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--mb", type=int, default=100, help="Size of generated text in MB")
+    parser.add_argument("--file", default=None, help="Chunk this text file instead of generated text")
+    parser.add_argument("--docs", type=int, default=1000, help="Number of documents to split the text into")
+    parser.add_argument("--extension", default=".md", help="Extension used to pick the splitter")
+    parser.add_argument("--min_size", type=int, default=800, help="Chunks smaller than this are merged")
+    parser.add_argument("--chunk_size", type=int, default=None, help="Budget for each split piece")
+    parser.add_argument("--tokens", action="store_true", help="Count the chunk_size budget in tokens")
+    parser.add_argument("--memory", action="store_true", help="Also report peak memory, at the cost of speed")
+
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "r", encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = generate_text(args.mb * 1024 * 1024)
+
+    run(text, args.docs, args.extension, args.min_size, args.chunk_size, args.tokens, args.memory)
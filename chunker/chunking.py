@@ -0,0 +1,188 @@
+import os
+import logging
+import threading
+import multiprocessing
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
+
+import langchain.text_splitter as text_splitter
+from langchain.schema import Document
+
+# documents at least this many characters long are split across a process pool
+PARALLEL_THRESHOLD = int(os.getenv("CHUNK_PARALLEL_THRESHOLD", 2000000))
+# size of each shard of a large document sent to a worker process
+SHARD_SIZE = int(os.getenv("CHUNK_SHARD_SIZE", 500000))
+PROCESSES = int(os.getenv("CHUNK_PROCESSES", os.cpu_count() or 1))
+# boundaries to cut shards at, best first - a shard is cut at a hard position only if none are found
+SHARD_BOUNDARIES = ["\n\n", "\n", ". ", " "]
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_SPLITTERS = {
+    ".py": text_splitter.PythonCodeTextSplitter,
+    ".md": text_splitter.MarkdownTextSplitter,
+}
+
+@lru_cache(maxsize=None)
+def choose_splitter(extension: str, chunk_size: int=1024, chunk_overlap:int=0):
+    if extension == ".py":
+        return text_splitter.PythonCodeTextSplitter()
+    elif extension == ".md":
+        return text_splitter.MarkdownTextSplitter()
+
+    return text_splitter.RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+@lru_cache(maxsize=None)
+def budget_splitter(extension: str, chunk_size: int, chunk_overlap: int=0, token_budget: bool=False):
+    """A splitter for extension that keeps pieces under chunk_size characters, or tiktoken tokens if token_budget"""
+    splitter_class = _SPLITTERS.get(extension, text_splitter.RecursiveCharacterTextSplitter)
+    if token_budget:
+        return splitter_class.from_tiktoken_encoder(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return splitter_class(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+def remove_whitespace(page_content: str):
+    return page_content.replace("\n", " ").replace("\r", " ").replace("\t", " ").replace("  ", " ")
+
+
+class _Pending:
+    """Small pieces waiting to be merged, joined once when flushed rather than concatenated each time"""
+    def __init__(self):
+        self.parts = []
+
+    def add(self, text: str):
+        self.parts.append(text)
+        self.parts.append("\n")
+
+    def take(self):
+        text = "".join(self.parts)
+        self.parts = []
+        return text
+
+    def __bool__(self):
+        return bool(self.parts)
+
+
+def _combine_small_documents(documents, min_size: int):
+    # Combine entire documents that are smaller than min_size
+    pending = _Pending()
+    last = None
+    for document in documents:
+        last = document
+        content = remove_whitespace(document.page_content)
+        if len(content) < min_size:
+            pending.add(content)
+            logging.debug(f"Appending document as its smaller than {min_size}: length {len(content)}")
+            continue
+        if pending:
+            yield Document(page_content=pending.take(), metadata=document.metadata)
+        yield document
+
+    if pending:
+        yield Document(page_content=pending.take(), metadata=last.metadata)
+
+def get_process_pool():
+    """The process pool shared by the chunker for CPU bound work"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn rather than fork, as the chunker has Pub/Sub and gRPC threads running
+                _pool = ProcessPoolExecutor(max_workers=PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def discard_process_pool():
+    # a pool with a dead worker can't be reused, the next large document starts a new one
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def shard_text(text: str, shard_size: int):
+    """Cuts text into pieces of about shard_size characters, each ending at a paragraph,
+    line, sentence or word boundary within the last quarter of the shard where possible"""
+    shards = []
+    start = 0
+    while len(text) - start > shard_size:
+        end = start + shard_size
+        earliest = start + shard_size * 3 // 4
+        for boundary in SHARD_BOUNDARIES:
+            found = text.rfind(boundary, earliest, end)
+            if found != -1:
+                end = found + len(boundary)
+                break
+        shards.append(text[start:end])
+        start = end
+    shards.append(text[start:])
+    return shards
+
+def _splitter(extension, chunk_size, chunk_overlap, token_budget):
+    if chunk_size is None and not token_budget:
+        return choose_splitter(extension)
+    return budget_splitter(extension, chunk_size or 1024, chunk_overlap, token_budget)
+
+def _split_shard(shard: str, extension: str, chunk_size: int, chunk_overlap: int, token_budget: bool):
+    # runs in a worker process
+    return _splitter(extension, chunk_size, chunk_overlap, token_budget).split_text(shard)
+
+def _split_text(text: str, extension, chunk_size, chunk_overlap, token_budget):
+    splitter = _splitter(extension, chunk_size, chunk_overlap, token_budget)
+    if len(text) < PARALLEL_THRESHOLD or PROCESSES < 2:
+        return splitter.split_text(text)
+
+    shards = shard_text(text, SHARD_SIZE)
+    logging.info(f"Splitting {len(text)} characters as {len(shards)} shards over {PROCESSES} processes")
+    try:
+        pieces = []
+        # map returns shard results in order, so pieces keep their place in the document
+        split_shard = partial(_split_shard, extension=extension, chunk_size=chunk_size,
+                              chunk_overlap=chunk_overlap, token_budget=token_budget)
+        for shard_pieces in get_process_pool().map(split_shard, shards):
+            pieces.extend(shard_pieces)
+        return pieces
+    except Exception as err:
+        logging.warning(f"Parallel splitting failed, splitting in this process instead: {str(err)}")
+        discard_process_pool()
+        return splitter.split_text(text)
+
+def iter_chunk_docs(documents, extension: str = ".md", min_size: int = 800,
+                    chunk_size: int = None, chunk_overlap: int = 0, token_budget: bool = False):
+    """Yields Document chunks from an iterable of Documents, one at a time.
+       Documents and chunks smaller than min_size are merged with the ones that follow them.
+       The splitter for extension keeps its own default size unless a chunk_size budget is given,
+       in characters or in tiktoken tokens if token_budget is True.
+       Documents longer than CHUNK_PARALLEL_THRESHOLD are sharded and split on a process pool."""
+
+    count = 0
+    pending = _Pending()
+    for document in _combine_small_documents(documents, min_size):
+        for chunk in _split_text(document.page_content, extension, chunk_size, chunk_overlap, token_budget):
+            # If a chunk is smaller than the min_size, keep it to prefix the next chunk
+            if len(chunk) < min_size:
+                pending.add(chunk)
+                logging.debug(f"Appending chunk as its smaller than {min_size}: length {len(chunk)}")
+                continue
+
+            if pending:
+                pending.parts.append(chunk)
+                chunk = pending.take()
+
+            count += 1
+            yield Document(page_content=chunk, metadata=document.metadata)
+
+        # If there's any remaining content, it becomes a chunk of its own
+        if pending:
+            count += 1
+            yield Document(page_content=pending.take(), metadata=document.metadata)
+
+    logging.info(f"Chunked into {count} documents")
+
+def chunk_doc_to_docs(documents: list, extension: str = ".md", min_size: int = 800):
+    """Turns a Document object into a list of many Document chunks.
+       If a document or chunk is smaller than min_size, it will be merged with adjacent documents or chunks."""
+
+    if documents is None:
+        return None
+
+    return list(iter_chunk_docs(documents, extension=extension, min_size=min_size))
@@ -0,0 +1,206 @@
+import os, sys
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+
+import logging
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from git import Repo
+from git.exc import GitCommandError
+from langchain.schema import Document
+
+import qna.database as database
+from chunker.loaders import ignore_files, code_extensions
+
+# paths passed to a single git checkout, to stay under the command line length limit
+CHECKOUT_BATCH = 500
+# threads reading and chunking files of the checked out repository
+LOAD_WORKERS = int(os.getenv("GIT_LOAD_WORKERS", min(32, (os.cpu_count() or 1) * 4)))
+
+class GitRepoIngest:
+    """
+    Loads only what changed in a git repository since the commit last ingested into vector_name.
+    The repository is partially cloned (no file contents) so only the blobs of changed files are fetched.
+    Rows for removed and modified files are deleted, and call mark_ingested() once the
+    loaded documents have been published so the next run diffs from this commit.
+    Vectorstores without a per file delete (only supabase has one) always load the whole repository.
+    """
+    def __init__(self, clone_url: str, branch: str="main", vector_name: str=None, metadata: dict=None):
+        self.clone_url = clone_url
+        self.branch = branch
+        self.vector_name = vector_name
+        self.metadata = metadata
+        self.head = None
+        self.last_commit = None
+        self.incremental = False
+        self.changed = []
+        self.deleted = []
+
+    def _auth_url(self):
+        GIT_PAT = os.getenv('GIT_PAT', None)
+        if GIT_PAT is None:
+            logging.warning("No GIT_PAT is specified, won't be able to clone private git repositories")
+            return self.clone_url
+        logging.info("Using private GIT_PAT")
+        return self.clone_url.replace('https://', f'https://{GIT_PAT}@')
+
+    def _clone(self, tmp_dir):
+        return Repo.clone_from(self._auth_url(), tmp_dir,
+                               branch=self.branch,
+                               single_branch=True,
+                               no_checkout=True,
+                               filter="blob:none")
+
+    def _has_commit(self, repo, commit_sha):
+        try:
+            repo.git.cat_file("-e", f"{commit_sha}^{{commit}}")
+            return True
+        except GitCommandError:
+            return False
+
+    def _can_diff(self):
+        from utils.config import load_config_key
+        return self.vector_name is not None and load_config_key("vectorstore", self.vector_name) == "supabase"
+
+    def _plan(self, repo):
+        self.head = repo.head.commit.hexsha
+        self.incremental = self._can_diff()
+        if self.incremental:
+            try:
+                self.last_commit = database.get_git_commit(self.clone_url, self.branch, self.vector_name)
+            except Exception as err:
+                logging.warning(f"Could not read last ingested commit of {self.clone_url} for {self.vector_name}, "
+                                f"loading all of it: {str(err)}")
+                self.incremental = False
+        else:
+            logging.info(f"{self.vector_name} can't delete rows per file, loading all of {self.clone_url}")
+
+        if self.last_commit == self.head:
+            logging.info(f"{self.clone_url} - {self.branch} already ingested at {self.head}")
+            return
+
+        if self.last_commit is not None and self._has_commit(repo, self.last_commit):
+            diff = repo.git.diff("--name-status", "--no-renames", self.last_commit, self.head)
+            for line in diff.splitlines():
+                status, path = line.split("\t", 1)
+                if status.startswith("D"):
+                    self.deleted.append(path)
+                else:
+                    self.changed.append(path)
+            # modified files are reloaded in full, so clear their old rows too
+            to_delete = self.deleted + self.changed
+            logging.info(f"{self.clone_url} - {self.branch} changed from {self.last_commit} to {self.head}: "
+                         f"{len(self.changed)} added or modified, {len(self.deleted)} removed")
+        else:
+            if self.last_commit is not None:
+                logging.warning(f"Last ingested commit {self.last_commit} is no longer on {self.branch}, reloading {self.clone_url}")
+                database.delete_row_from_source(self.clone_url, vector_name=self.vector_name)
+            self.changed = repo.git.ls_tree("-r", "--name-only", self.head).splitlines()
+            to_delete = []
+
+        extensions = code_extensions()
+        self.changed = [path for path in self.changed if ignore_files(path, extensions)]
+
+        for path in to_delete:
+            ids = database.delete_rows_from_file(self.clone_url, path, vector_name=self.vector_name)
+            if ids:
+                logging.info(f"Deleted {len(ids)} rows for {path} from {self.vector_name}")
+
+    def _read(self, repo_dir, path):
+        file_path = os.path.join(repo_dir, path)
+        if not os.path.isfile(file_path):
+            return None
+        with open(file_path, "rb") as f:
+            content = f.read()
+        # loads only text files, as GitLoader does
+        try:
+            text_content = content.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+
+        file_name = os.path.basename(path)
+        metadata = {
+            "source": path,
+            "file_path": path,
+            "file_name": file_name,
+            "file_type": os.path.splitext(file_name)[1],
+        }
+        if self.metadata is not None:
+            metadata.update(self.metadata)
+
+        return Document(page_content=text_content, metadata=metadata)
+
+    def _checkout(self, tmp_dir):
+        try:
+            repo = self._clone(tmp_dir)
+            self._plan(repo)
+        except Exception as err:
+            logging.error(f"Failed to load repository: {str(err)}")
+            return False
+
+        # checking out just the changed paths fetches their blobs in one batch
+        for i in range(0, len(self.changed), CHECKOUT_BATCH):
+            repo.git.checkout(self.head, "--", *self.changed[i:i + CHECKOUT_BATCH])
+
+        return True
+
+    def load(self):
+        """Returns Documents for the files added or modified since the last ingested commit"""
+        logging.info(f"Reading git repo from {self.clone_url} - {self.branch}")
+        docs = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if not self._checkout(tmp_dir):
+                return None
+
+            for path in self.changed:
+                doc = self._read(tmp_dir, path)
+                if doc is not None:
+                    docs.append(doc)
+
+        logging.info(f"Read {len(docs)} changed doc(s) from {self.clone_url} at {self.head}")
+
+        return docs
+
+    def _read_chunks(self, repo_dir, path, chunk_fn):
+        doc = self._read(repo_dir, path)
+        if doc is None:
+            return []
+        return chunk_fn([doc]) or []
+
+    def iter_chunks(self, chunk_fn, workers: int=None):
+        """
+        Yields the chunks of each added or modified file, reading and chunking files on a bounded
+        thread pool so only a few files are held in memory at once. Chunks come out in path order.
+        """
+        workers = workers or LOAD_WORKERS
+        logging.info(f"Streaming git repo from {self.clone_url} - {self.branch} with {workers} workers")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if not self._checkout(tmp_dir):
+                return
+
+            files = 0
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="git-load") as executor:
+                pending = deque()
+                for path in self.changed:
+                    pending.append(executor.submit(self._read_chunks, tmp_dir, path, chunk_fn))
+                    if len(pending) >= workers * 2:
+                        files += 1
+                        yield from pending.popleft().result()
+                while pending:
+                    files += 1
+                    yield from pending.popleft().result()
+
+        logging.info(f"Streamed {files} changed file(s) from {self.clone_url} at {self.head}")
+
+    def mark_ingested(self):
+        if not self.incremental or self.head is None or self.head == self.last_commit:
+            return
+        try:
+            database.set_git_commit(self.clone_url, self.branch, self.head, vector_name=self.vector_name)
+        except Exception as err:
+            logging.warning(f"Could not record {self.clone_url} - {self.branch} as ingested, "
+                            f"the next run will diff from {self.last_commit}: {str(err)}")
+            return
+        logging.info(f"Recorded {self.clone_url} - {self.branch} as ingested at {self.head}")
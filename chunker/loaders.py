@@ -1,9 +1,9 @@
 from langchain.document_loaders.unstructured import UnstructuredFileLoader
-from langchain.document_loaders.unstructured import UnstructuredAPIFileLoader
 from langchain.document_loaders import UnstructuredURLLoader
-from langchain.document_loaders.git import GitLoader
 from langchain.document_loaders import GoogleDriveLoader
-from utils.config import load_config
+from utils.config import load_config, config_version
+from langchain.schema import Document
+import chunker.parse_cache as parse_cache
 from googleapiclient.errors import HttpError
 
 import logging
@@ -16,6 +16,10 @@ import time
 
 UNSTRUCTURED_KEY=os.getenv('UNSTRUCTURED_KEY')
 
+class PartialDocumentError(Exception):
+    """Reading a document failed after some of it was yielded, so it can't fall back to another parser
+    and needs reading again"""
+
 # utility functions
 def convert_to_txt(file_path):
     file_dir, file_name = os.path.split(file_path)
@@ -78,50 +82,27 @@ class MyGoogleDriveLoader(GoogleDriveLoader):
             else:
                 return []
 
-def ignore_files(filepath):
+_code_extensions = {"version": None, "extensions": ()}
+
+def code_extensions():
+    """The config.json "code_extensions" as a lower case tuple, rebuilt only when the config changes"""
+    version = config_version("config.json")
+    if _code_extensions["version"] != version:
+        config = load_config("config.json")
+        _code_extensions["extensions"] = tuple(ext.lower() for ext in config.get("code_extensions", []))
+        _code_extensions["version"] = version
+    return _code_extensions["extensions"]
+
+def ignore_files(filepath, extensions=None):
     """Returns True if the given path's file extension is found within 
     config.json "code_extensions" array
     Returns False if not
     """
-    # Load the configuration
-    config = load_config("config.json")
+    if extensions is None:
+        extensions = code_extensions()
 
-    code_extensions = config.get("code_extensions", [])
-
-    lower_filepath = filepath.lower()
     # TRUE if on the list, FALSE if not
-    return any(lower_filepath.endswith(ext) for ext in code_extensions)
-
-def read_git_repo(clone_url, branch="main", metadata=None):
-    logging.info(f"Reading git repo from {clone_url} - {branch}")
-    GIT_PAT = os.getenv('GIT_PAT', None)
-    if GIT_PAT is None:
-        logging.warning("No GIT_PAT is specified, won't be able to clone private git repositories")
-    else:
-        clone_url = clone_url.replace('https://', f'https://{GIT_PAT}@')
-        logging.info("Using private GIT_PAT")
-
-    with tempfile.TemporaryDirectory() as tmp_dir:
-            try:    
-                loader = GitLoader(repo_path=tmp_dir, 
-                                   clone_url=clone_url, 
-                                   branch=branch,
-                                   file_filter=ignore_files)
-            except Exception as err:
-                logging.error(f"Failed to load repository: {str(err)}")
-                return None
-            docs = loader.load()
-
-            if not docs:
-                return None
-            
-            if metadata is not None:
-                for doc in docs:
-                    doc.metadata.update(metadata)
-            
-    logging.info(f"GitLoader read {len(docs)} doc(s) from {clone_url}")
-        
-    return docs
+    return filepath.lower().endswith(extensions)
 
 
 def read_gdrive_to_document(url: str, metadata: dict = None):
@@ -154,35 +135,164 @@ def read_url_to_document(url: str, metadata: dict = None):
     
     return docs
 
-def read_file_to_document(gs_file: pathlib.Path, split=False, metadata: dict = None):
+# formats streamed straight from GCS as text, without a temp file or a parser
+STREAM_TEXT_SUFFIXES = tuple(os.getenv("STREAM_TEXT_SUFFIXES", ".txt,.md,.csv,.json,.jsonl,.log,.rst").split(","))
+# bytes read per ranged request and characters per streamed Document
+STREAM_BLOCK_BYTES = int(os.getenv("STREAM_BLOCK_BYTES", 8 * 1024 * 1024))
+STREAM_DOC_CHARS = int(os.getenv("STREAM_DOC_CHARS", 1024 * 1024))
+# PDFs up to this size are downloaded into memory rather than to a temp file
+IN_MEMORY_MAX_BYTES = int(os.getenv("IN_MEMORY_MAX_BYTES", 10 * 1024 * 1024))
+
+def _block_cut(buffer: str):
+    for boundary in ["\n\n", "\n"]:
+        found = buffer.rfind(boundary)
+        if found > 0:
+            return found + len(boundary)
+    return len(buffer)
+
+def iter_blob_text_documents(blob, metadata: dict = None, doc_chars: int = None):
+    """Streams a text blob with ranged reads, yielding Documents of about doc_chars characters
+    cut at paragraph or line boundaries so they chunk as the whole text would"""
+    doc_chars = doc_chars or STREAM_DOC_CHARS
+
+    def block_doc(text, block):
+        doc_metadata = dict(metadata or {})
+        doc_metadata["block"] = block
+        return Document(page_content=text, metadata=doc_metadata)
+
+    buffer = ""
+    block = 0
+    with blob.open("rt", chunk_size=STREAM_BLOCK_BYTES, encoding="utf-8", errors="replace") as f:
+        while True:
+            data = f.read(doc_chars)
+            if not data:
+                break
+            buffer += data
+            if len(buffer) < doc_chars:
+                continue
+            cut = _block_cut(buffer)
+            yield block_doc(buffer[:cut], block)
+            block += 1
+            buffer = buffer[cut:]
+
+    if buffer:
+        yield block_doc(buffer, block)
+        block += 1
+
+    logging.info(f"Streamed gs://{blob.bucket.name}/{blob.name} as {block} doc(s)")
+
+def _iter_pdf_blob_in_memory(blob, metadata: dict = None):
+    import io
+    from chunker.pdfs import iter_pdf_pages
+
+    pdf_stream = io.BytesIO(blob.download_as_bytes())
+    stats = {"chars": 0}
+    yielded = 0
+    try:
+        for doc in iter_pdf_pages(pdf_stream, metadata=metadata, workers=1, stats=stats):
+            yielded += 1
+            yield doc
+    except Exception as err:
+        if yielded:
+            raise PartialDocumentError(f"Reading PDF {blob.name} via pypdf failed after {yielded} pages: {str(err)}") from err
+        logging.warning(f"Could not extract PDF via pypdf ERROR - {str(err)}")
+
+    if stats["chars"] < 10:
+        # the parsers used when pypdf finds no text need a real file
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tmp_file_path = os.path.join(temp_dir, pathlib.Path(blob.name).name)
+            with open(tmp_file_path, "wb") as f:
+                f.write(pdf_stream.getvalue())
+            yield from read_file_to_document(tmp_file_path, metadata=metadata, try_pypdf=False)
+
+def iter_blob_documents(blob, size: int = None, metadata: dict = None):
+    """Yields the Documents of a GCS blob without a temp file download when its format allows,
+    or returns None if it needs to be downloaded to a file for its loader"""
+    suffix = pathlib.Path(blob.name).suffix.lower()
+    if suffix in STREAM_TEXT_SUFFIXES:
+        return iter_blob_text_documents(blob, metadata=metadata)
+    if suffix == ".pdf" and size is not None and size <= IN_MEMORY_MAX_BYTES:
+        return _iter_pdf_blob_in_memory(blob, metadata=metadata)
+    return None
+
+def iter_file_documents(gs_file: pathlib.Path, metadata: dict = None):
+    """Yields the Documents of a file one at a time. PDFs are streamed page by page,
+    and only sent to Unstructured if pypdf can't find any text in them."""
+    if pathlib.Path(gs_file).suffix != ".pdf":
+        yield from read_file_to_document(gs_file, metadata=metadata)
+        return
+
+    cached = parse_cache.get(gs_file, "pypdf_pages", metadata=metadata)
+    if cached is not None:
+        yield from cached
+        return
+
+    from chunker.pdfs import iter_pdf_pages
+    stats = {"chars": 0}
+    # pages are kept without the caller's metadata to cache once they have all been read
+    parsed = [] if parse_cache.enabled() else None
+    yielded = 0
+    try:
+        for doc in iter_pdf_pages(gs_file, stats=stats):
+            if parsed is not None:
+                parsed.append(Document(page_content=doc.page_content, metadata=dict(doc.metadata)))
+            if metadata is not None:
+                doc.metadata.update(metadata)
+            yielded += 1
+            yield doc
+    except Exception as err:
+        if yielded:
+            # the rest of the PDF would be silently dropped
+            raise PartialDocumentError(f"Reading PDF {gs_file} via pypdf failed after {yielded} pages: {str(err)}") from err
+        logging.warning(f"Could not extract PDF via pypdf ERROR - {str(err)}")
+        parsed = None
+
+    if stats["chars"] >= 10 and parsed:
+        parse_cache.put(gs_file, "pypdf_pages", parsed)
+
+    if stats["chars"] < 10:
+        logging.info(f"Could not read PDF {gs_file} via pypdf, trying UnstructuredAPIFileLoader")
+        yield from read_file_to_document(gs_file, metadata=metadata, try_pypdf=False)
+
+def read_file_to_document(gs_file: pathlib.Path, split=False, metadata: dict = None, try_pypdf=True):
     
+    # parsed docs are cached without the caller's metadata, which is added at the end
+    cache_variant = f"read_file_to_document:split={split}:pypdf={try_pypdf}"
+    cached = parse_cache.get(gs_file, cache_variant, metadata=metadata)
+    if cached is not None:
+        return cached
+
     docs = []
     done = False
     pdf_path = pathlib.Path(gs_file)
-    if pdf_path.suffix == ".pdf":
-        from chunker.pdfs import read_pdf_file
-        local_doc = read_pdf_file(pdf_path, metadata=metadata)
-        if local_doc is not None:
-            docs.append(local_doc)
+    if pdf_path.suffix == ".pdf" and try_pypdf:
+        from chunker.pdfs import read_pdf_pages
+        local_docs = read_pdf_pages(pdf_path, metadata=None)
+        if local_docs is not None:
+            docs.extend(local_docs)
             done = True
+
+    if not done and not split:
+        from chunker.local_partition import choose_partition_backend, partition_locally
+        if choose_partition_backend(gs_file) == "local":
+            try:
+                docs = partition_locally(gs_file)
+                done = len(docs) > 0
+            except Exception as err:
+                logging.warning(f"Could not partition {gs_file} locally, sending to UnstructuredAPIFileLoader: {str(err)}")
     
     if not done:
         try:
             logging.info(f"Sending {gs_file} to UnstructuredAPIFileLoader")
-            UNSTRUCTURED_URL = os.getenv("UNSTRUCTURED_URL", None)
-            if UNSTRUCTURED_URL is not None:
-                logging.debug(f"Found UNSTRUCTURED_URL: {UNSTRUCTURED_URL}")
-                the_endpoint = f"{UNSTRUCTURED_URL}/general/v0/general"
-                loader = UnstructuredAPIFileLoader(gs_file, url=the_endpoint)
-            else:
-                loader = UnstructuredAPIFileLoader(gs_file, api_key=UNSTRUCTURED_KEY)
+            from chunker.unstructured_client import make_loader, next_endpoint, partition_file
             
             if split:
                 # only supported for some file types
-                docs = loader.load_and_split()
+                docs = make_loader(gs_file, next_endpoint()).load_and_split()
             else:
                 start = time.time()
-                docs = loader.load() # this takes a long time 30m+ for big PDF files
+                # big PDFs are sent as concurrent page ranges spread over the UNSTRUCTURED_URL endpoints
+                docs = partition_file(gs_file)
                 end = time.time()
                 elapsed_time = round((end - start) / 60, 2)
                 logging.info(f"Loaded docs for {gs_file} from UnstructuredAPIFileLoader took {elapsed_time} mins")
@@ -208,6 +318,8 @@ def read_file_to_document(gs_file: pathlib.Path, split=False, metadata: dict = N
                     if txt_file is not None and os.path.exists(txt_file):
                         os.remove(txt_file)
 
+    parse_cache.put(gs_file, cache_variant, docs)
+
     for doc in docs:
         #doc.metadata["file_sha1"] = file_sha1
         logging.info(f"doc_content: {doc.page_content[:30]} - length: {len(doc.page_content)}")
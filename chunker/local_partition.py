@@ -0,0 +1,168 @@
+import os, sys
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+
+import time
+import shutil
+import pathlib
+import logging
+import tempfile
+import threading
+import importlib.util
+import multiprocessing
+
+from langchain.schema import Document
+
+# Partitions files with the installed unstructured[local-inference] in a pool of worker processes,
+# so small files skip the network hop to the Unstructured API and scanned PDFs are OCRed on every core.
+# A document that runs past LOCAL_PARTITION_TIMEOUT has its worker killed and the pool restarted,
+# and documents that were running alongside it are resubmitted once to the new pool.
+
+# auto picks local or remote per file, or set local / remote to force one
+PARTITION_BACKEND = os.getenv("PARTITION_BACKEND", "auto")
+LOCAL_SUFFIXES = tuple(os.getenv("LOCAL_PARTITION_SUFFIXES",
+                                 ".txt,.md,.html,.htm,.xml,.csv,.eml,.msg,.rtf,.docx,.pptx,.xlsx,.epub,.odt").split(","))
+LOCAL_MAX_BYTES = int(os.getenv("LOCAL_PARTITION_MAX_BYTES", 5 * 1024 * 1024))
+LOCAL_MAX_PDF_BYTES = int(os.getenv("LOCAL_PARTITION_MAX_PDF_BYTES", 200 * 1024 * 1024))
+PROCESSES = int(os.getenv("LOCAL_PARTITION_PROCESSES", os.cpu_count() or 1))
+TIMEOUT = float(os.getenv("LOCAL_PARTITION_TIMEOUT", 600))
+OCR_PAGES_PER_TASK = int(os.getenv("LOCAL_OCR_PAGES_PER_TASK", 4))
+
+# seconds between checks that a task's pool hasn't been restarted under it
+POLL_SECONDS = 0.5
+
+_pool = None
+# counts pool restarts, so a task only restarts the pool it ran in
+_generation = 0
+_pool_lock = threading.Lock()
+
+class PoolRestarted(Exception):
+    """The pool a task was running in was terminated because another document timed out"""
+
+def _installed(module: str):
+    return importlib.util.find_spec(module) is not None
+
+def choose_partition_backend(file_path):
+    """Returns "local" or "remote" for partitioning file_path"""
+    if PARTITION_BACKEND in ("local", "remote"):
+        return PARTITION_BACKEND
+
+    if not _installed("unstructured"):
+        return "remote"
+
+    suffix = pathlib.Path(file_path).suffix.lower()
+    size = os.path.getsize(file_path)
+    if suffix == ".pdf":
+        # PDFs only get here when pypdf found no text, so they need OCR
+        if _installed("pytesseract") and shutil.which("tesseract") and size <= LOCAL_MAX_PDF_BYTES:
+            return "local"
+        return "remote"
+
+    if suffix in LOCAL_SUFFIXES and size <= LOCAL_MAX_BYTES:
+        return "local"
+
+    return "remote"
+
+def _get_pool():
+    """Returns the pool and its generation"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            logging.info(f"Starting local partition pool with {PROCESSES} processes")
+            # spawn so workers don't inherit the chunker's gRPC threads, and are recycled to free model memory
+            _pool = multiprocessing.get_context("spawn").Pool(PROCESSES, maxtasksperchild=50)
+        return _pool, _generation
+
+def _terminate_pool(generation):
+    global _pool, _generation
+    with _pool_lock:
+        if generation != _generation or _pool is None:
+            # already restarted for a task that timed out first
+            return
+        pool, _pool = _pool, None
+        _generation += 1
+    pool.terminate()
+
+def _partition(file_path, strategy):
+    """Runs in a worker process, returns [(text, page_number)] for each element"""
+    from unstructured.partition.auto import partition
+    elements = partition(filename=file_path, strategy=strategy)
+    return [(str(element), getattr(element.metadata, "page_number", None)) for element in elements]
+
+def _wait(result, generation, deadline):
+    """result.get() until deadline, raising PoolRestarted as soon as the pool running it is terminated,
+    as a terminated pool never completes its results"""
+    while True:
+        remaining = deadline - time.time()
+        try:
+            return result.get(timeout=min(max(remaining, 0), POLL_SECONDS))
+        except multiprocessing.TimeoutError:
+            if generation != _generation:
+                raise PoolRestarted(f"Local partition pool {generation} was restarted")
+            if remaining <= POLL_SECONDS:
+                raise
+
+def _submit(pool, generation, task):
+    try:
+        return pool.apply_async(_partition, task)
+    except ValueError:
+        # terminated between _get_pool() and here
+        if generation != _generation:
+            raise PoolRestarted(f"Local partition pool {generation} was restarted")
+        raise
+
+def _map(tasks, timeout, what):
+    """Runs _partition(*task) for each of tasks in the pool, returning their results in order"""
+    deadline = time.time() + timeout
+    results = [None] * len(tasks)
+    todo = list(range(len(tasks)))
+    for attempt in range(2):
+        pool, generation = _get_pool()
+        try:
+            pending = [(i, _submit(pool, generation, tasks[i])) for i in todo]
+            for i, result in pending:
+                results[i] = _wait(result, generation, deadline)
+                todo.remove(i)
+            return results
+        except PoolRestarted:
+            if attempt > 0:
+                raise
+            logging.warning(f"Local partition pool restarted during {what}, resubmitting {len(todo)} task(s)")
+        except multiprocessing.TimeoutError:
+            logging.error(f"{what} took over {timeout} seconds, terminating its workers")
+            _terminate_pool(generation)
+            raise TimeoutError(f"{what} timed out after {timeout} seconds")
+
+def _run(file_path, strategy, timeout):
+    return _map([(str(file_path), strategy)], timeout, f"Local partition of {file_path}")[0]
+
+def _ocr_pdf(pdf_path, timeout):
+    from chunker.unstructured_client import split_pdf_ranges
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ranges = split_pdf_ranges(pdf_path, temp_dir, OCR_PAGES_PER_TASK)
+        logging.info(f"OCR of {pdf_path} as {len(ranges)} page ranges over {PROCESSES} processes")
+        results = _map([(range_path, "ocr_only") for _, _, range_path in ranges], timeout, f"OCR of {pdf_path}")
+
+        pages = {}
+        for (first_page, _, _), elements in zip(ranges, results):
+            for text, page_number in elements:
+                pages.setdefault((page_number or 1) + first_page - 1, []).append(text)
+
+    return [(page_number, "\n\n".join(texts)) for page_number, texts in sorted(pages.items())]
+
+def partition_locally(file_path, timeout: float=None):
+    """Partitions file_path in the local worker pool, returning Documents like UnstructuredFileLoader's
+    single mode, with one Document per page for PDFs"""
+    timeout = timeout or TIMEOUT
+    start = time.time()
+
+    if pathlib.Path(file_path).suffix.lower() == ".pdf":
+        docs = [Document(page_content=text, metadata={"source": str(file_path), "page_number": page_number})
+                for page_number, text in _ocr_pdf(file_path, timeout)]
+    else:
+        elements = _run(file_path, "auto", timeout)
+        docs = [Document(page_content="\n\n".join(text for text, _ in elements), metadata={"source": str(file_path)})]
+
+    logging.info(f"Partitioned {file_path} locally into {len(docs)} docs in {round(time.time() - start, 2)} seconds")
+    return docs
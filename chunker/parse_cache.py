@@ -0,0 +1,127 @@
+import os, sys
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+
+import gzip
+import json
+import hashlib
+import logging
+import tempfile
+from functools import lru_cache
+
+from langchain.schema import Document
+
+# Caches the Documents a file was parsed into, keyed by the sha1 of the file's content,
+# so redelivered pushes, batch retries and re-chunking skip parsing.
+# Set PARSE_CACHE_DIR to a local directory or a gs://bucket/prefix - the cache is off when unset.
+# Entries are gzipped JSON without the caller's metadata, which is applied after a hit.
+# Bump PARSE_CACHE_VERSION when a parser change should invalidate what is cached.
+
+PARSE_CACHE_DIR = os.getenv("PARSE_CACHE_DIR", None)
+PARSE_CACHE_VERSION = os.getenv("PARSE_CACHE_VERSION", "1")
+
+_stats = {"hits": 0, "misses": 0, "writes": 0, "errors": 0}
+
+def enabled():
+    return PARSE_CACHE_DIR is not None
+
+@lru_cache(maxsize=256)
+def _file_sha1(file_path, mtime_ns, size):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def file_sha1(file_path):
+    # memoized on the file's stat, as a lookup and the write after a miss both need it
+    stat = os.stat(file_path)
+    return _file_sha1(str(file_path), stat.st_mtime_ns, stat.st_size)
+
+def cache_key(file_path, variant: str):
+    """variant names the way the file was parsed, e.g. which loader and whether it was split"""
+    variant_hash = hashlib.sha1(f"{PARSE_CACHE_VERSION}:{variant}".encode("utf-8")).hexdigest()[:12]
+    return f"{file_sha1(file_path)}-{variant_hash}"
+
+def _gcs_blob(key):
+    from utils.transport import get_storage_client
+    bucket_name, _, prefix = PARSE_CACHE_DIR[5:].partition("/")
+    name = f"{prefix.rstrip('/')}/{key}.json.gz" if prefix else f"{key}.json.gz"
+    return get_storage_client().bucket(bucket_name).blob(name)
+
+def _read(key):
+    if PARSE_CACHE_DIR.startswith("gs://"):
+        from google.api_core.exceptions import NotFound
+        try:
+            return _gcs_blob(key).download_as_bytes()
+        except NotFound:
+            return None
+
+    path = os.path.join(PARSE_CACHE_DIR, f"{key}.json.gz")
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+def _write(key, data: bytes):
+    if PARSE_CACHE_DIR.startswith("gs://"):
+        _gcs_blob(key).upload_from_string(data, content_type="application/gzip")
+        return
+
+    os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+    # write then rename so a concurrent reader never sees half an entry
+    fd, tmp_path = tempfile.mkstemp(dir=PARSE_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, os.path.join(PARSE_CACHE_DIR, f"{key}.json.gz"))
+
+def get(file_path, variant: str, metadata: dict=None):
+    """Returns the cached Documents for file_path with metadata applied, or None on a miss"""
+    if not enabled():
+        return None
+    try:
+        key = cache_key(file_path, variant)
+        data = _read(key)
+    except Exception as err:
+        _stats["errors"] += 1
+        logging.warning(f"Could not read parse cache for {file_path}: {str(err)}")
+        return None
+
+    if data is None:
+        _stats["misses"] += 1
+        return None
+
+    try:
+        entry = json.loads(gzip.decompress(data).decode("utf-8"))
+    except Exception as err:
+        _stats["errors"] += 1
+        logging.warning(f"Ignoring unreadable parse cache entry for {file_path}: {str(err)}")
+        return None
+
+    docs = []
+    for doc in entry["docs"]:
+        if metadata is not None:
+            doc["metadata"].update(metadata)
+        docs.append(Document(page_content=doc["page_content"], metadata=doc["metadata"]))
+
+    _stats["hits"] += 1
+    logging.info(f"Parse cache hit for {file_path} ({variant}): {len(docs)} docs")
+    return docs
+
+def put(file_path, variant: str, docs: list):
+    """Caches docs as parsed from file_path - pass them before caller metadata is added"""
+    if not enabled() or not docs:
+        return
+    try:
+        entry = {"variant": variant, "version": PARSE_CACHE_VERSION,
+                 "docs": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]}
+        data = gzip.compress(json.dumps(entry, default=str).encode("utf-8"))
+        _write(cache_key(file_path, variant), data)
+        _stats["writes"] += 1
+        logging.info(f"Parse cache stored {len(docs)} docs for {file_path} ({variant}) in {len(data)} bytes")
+    except Exception as err:
+        _stats["errors"] += 1
+        logging.warning(f"Could not write parse cache for {file_path}: {str(err)}")
+
+def parse_cache_stats():
+    return dict(_stats)
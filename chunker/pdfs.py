@@ -4,61 +4,156 @@ sys.path.append(parent_dir)
 
 import pathlib
 import logging
+from collections import deque
+from contextlib import contextmanager
 
 def split_pdf_to_pages(pdf_path, temp_dir):
 
     logging.info(f"Splitting PDF {pdf_path} into pages...")
 
     pdf_path = pathlib.Path(pdf_path)
-    from pypdf import PdfReader, PdfWriter
-    pdf = PdfReader(pdf_path)
+    from pypdf import PdfWriter
 
-    logging.info(f"PDF file {pdf_path} contains {len(pdf.pages)} pages")
+    with open_pdf(pdf_path) as pdf:
 
-    # Get base name without extension
-    basename = os.path.splitext(os.path.basename(pdf_path))[0]
+        logging.info(f"PDF file {pdf_path} contains {len(pdf.pages)} pages")
 
-    page_files = []
-    
-    if len(pdf.pages) == 1:
-        logging.debug(f"Only one page in PDF {pdf_path} - sending back")
-        return [str(pdf_path)]
-    
-    for page in range(len(pdf.pages)):
-        pdf_writer = PdfWriter()
-        pdf_writer.add_page(pdf.pages[page])
+        # Get base name without extension
+        basename = os.path.splitext(os.path.basename(pdf_path))[0]
 
-        output_filename = pathlib.Path(temp_dir, f'{basename}_p{page}.pdf')
+        page_files = []
+        
+        if len(pdf.pages) == 1:
+            logging.debug(f"Only one page in PDF {pdf_path} - sending back")
+            return [str(pdf_path)]
+        
+        for page in range(len(pdf.pages)):
+            pdf_writer = PdfWriter()
+            pdf_writer.add_page(pdf.pages[page])
 
-        with open(output_filename, 'wb') as out:
-            pdf_writer.write(out)
+            output_filename = pathlib.Path(temp_dir, f'{basename}_p{page}.pdf')
 
-        logging.info(f'Created PDF page: {output_filename}')
-        page_files.append(str(output_filename))
+            with open(output_filename, 'wb') as out:
+                pdf_writer.write(out)
+
+            logging.info(f'Created PDF page: {output_filename}')
+            page_files.append(str(output_filename))
 
     logging.info(f"Split PDF {pdf_path} into {len(page_files)} pages...")
     return page_files
 
-def read_pdf_file(pdf_path, metadata):
-    from langchain.schema import Document
+# PDFs with more pages or bytes than these are split and sent back to GCS page by page,
+# smaller ones have their pages extracted in this process' pool
+PDF_FANOUT_PAGES = int(os.getenv("PDF_FANOUT_PAGES", 300))
+PDF_FANOUT_BYTES = int(os.getenv("PDF_FANOUT_BYTES", 50 * 1024 * 1024))
+# PDFs with fewer pages than this are extracted without the process pool
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 8))
+# pages extracted by each pool task, and how often the reader is reopened to drop the objects it has parsed
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 25))
+
+@contextmanager
+def open_pdf(pdf_path):
+    """A PdfReader over an open file, so pages are parsed from disk as they are used
+    rather than pypdf reading the whole file into memory as it does for a path"""
     from pypdf import PdfReader
-    logging.info(f"Reading PDF {pdf_path}...")
+    if hasattr(pdf_path, "read"):
+        # already a file-like object, e.g. a small PDF held in memory
+        pdf_path.seek(0)
+        yield PdfReader(pdf_path)
+        return
+    with open(pdf_path, "rb") as f:
+        yield PdfReader(f)
 
-    pdf_path = pathlib.Path(pdf_path)
-    
-    pdf = PdfReader(pdf_path)
+def pdf_page_count(pdf_path):
+    with open_pdf(pdf_path) as pdf:
+        return len(pdf.pages)
+
+def pdf_should_fan_out(pdf_path):
+    size = os.path.getsize(pdf_path)
+    if size > PDF_FANOUT_BYTES:
+        logging.info(f"PDF {pdf_path} is {size} bytes, over PDF_FANOUT_BYTES {PDF_FANOUT_BYTES}")
+        return True
+    pages = pdf_page_count(pdf_path)
+    if pages > PDF_FANOUT_PAGES:
+        logging.info(f"PDF {pdf_path} has {pages} pages, over PDF_FANOUT_PAGES {PDF_FANOUT_PAGES}")
+        return True
+    return False
+
+def extract_page_range(pdf_path, start, end):
+    """Returns [(page_number, text, error)] for pages start to end-1, with text None for pages that failed.
+    Runs in a worker process for parallel extraction."""
+    results = []
+    with open_pdf(pdf_path) as pdf:
+        for page in range(start, end):
+            try:
+                results.append((page + 1, pdf.pages[page].extract_text(), None))
+            except Exception as err:
+                results.append((page + 1, None, str(err)))
+    return results
+
+def _iter_page_ranges(pdf_path, page_count, workers):
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, page_count))
+              for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+
+    if page_count < PDF_PARALLEL_MIN_PAGES or workers < 2:
+        for start, end in ranges:
+            yield from extract_page_range(pdf_path, start, end)
+        return
+
+    from chunker.chunking import get_process_pool, discard_process_pool
+    pool = get_process_pool()
+    pending = deque()
+    try:
+        # at most two ranges per worker are held in memory before they are yielded
+        for start, end in ranges:
+            pending.append(pool.submit(extract_page_range, str(pdf_path), start, end))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    except Exception:
+        for future in pending:
+            future.cancel()
+        discard_process_pool()
+        raise
+
+def iter_pdf_pages(pdf_path, metadata=None, workers: int=None, stats: dict=None):
+    """Yields one Document per page of a PDF with page_number metadata, in page order.
+    Pages that fail to extract are logged and skipped rather than failing the whole PDF.
+    Pass a dict as stats to get the pages, failed and chars counts once iteration finishes."""
+    from langchain.schema import Document
+    from chunker.chunking import PROCESSES
+    logging.info(f"Reading PDF pages {pdf_path}...")
+
+    stats = stats if stats is not None else {}
+    stats.update({"pages": 0, "failed": 0, "chars": 0})
+
+    page_count = pdf_page_count(pdf_path)
+    for page_number, text, error in _iter_page_ranges(pdf_path, page_count, workers or PROCESSES):
+        if error is not None:
+            logging.warning(f"Could not extract page {page_number} of PDF {pdf_path} via pypdf ERROR - {error}")
+            stats["failed"] += 1
+            continue
+        stats["pages"] += 1
+        stats["chars"] += len(text)
 
+        page_metadata = dict(metadata or {})
+        page_metadata["page_number"] = page_number
+        yield Document(page_content=text, metadata=page_metadata)
+
+    logging.info(f"Read {stats['pages']} of {page_count} pages of PDF {pdf_path} - {stats['failed']} failed")
+
+def read_pdf_pages(pdf_path, metadata, workers: int=None):
+    """Reads a PDF into a list of per page Documents, or None if pypdf finds no text"""
+    stats = {}
     try:
-        text = ""
-        for page in pdf.pages:
-            text += page.extract_text() + "\n"
+        docs = list(iter_pdf_pages(pdf_path, metadata=metadata, workers=workers, stats=stats))
     except Exception as err:
         logging.warning(f"Could not extract PDF via pypdf ERROR - {str(err)}")
         return None
-    
-    if len(text) < 10:
-        logging.info(f"Could not read PDF {pdf_path} via pypdf - too short, only got {text}")
+
+    if stats["chars"] < 10:
+        logging.info(f"Could not read PDF {pdf_path} via pypdf - too short")
         return None
-    
-    logging.info(f"Successfully read PDF {pdf_path}...")
-    return Document(page_content=text, metadata=metadata)
\ No newline at end of file
+
+    return docs
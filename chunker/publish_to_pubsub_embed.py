@@ -5,24 +5,31 @@ import pathlib
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_dir)
 
-from google.cloud import storage
 import base64
 import datetime
 import logging
 from dotenv import load_dotenv
 import tempfile
 import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import langchain.text_splitter as text_splitter
 from langchain.schema import Document
 
 from qna.pubsub_manager import PubSubManager
+from utils.transport import get_storage_client
 import qna.database as database
+import qna.dedup as dedup
+import qna.ingest_jobs as ingest_jobs
 import chunker.loaders as loaders
-from chunker.pdfs import split_pdf_to_pages, read_pdf_file
+from chunker.git_ingest import GitRepoIngest
+from chunker.chunking import chunk_doc_to_docs, iter_chunk_docs
+from chunker.pdfs import split_pdf_to_pages, pdf_should_fan_out
 
 load_dotenv()
 
+PDF_BATCH_AFTER_ATTEMPTS = int(os.getenv("PDF_BATCH_AFTER_ATTEMPTS", 4))
+
 def contains_url(message_data):
     url_pattern = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
     if url_pattern.search(message_data):
@@ -36,18 +43,112 @@ def extract_urls(text):
     return urls
 
 def compute_sha1_from_file(file_path):
+    sha1 = hashlib.sha1()
     with open(file_path, "rb") as file:
-        bytes = file.read() 
-        readable_hash = hashlib.sha1(bytes).hexdigest()
-    return readable_hash
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
 
 def compute_sha1_from_content(content):
     readable_hash = hashlib.sha1(content).hexdigest()
     return readable_hash
 
-def add_file_to_gcs(filename: str, vector_name:str, bucket_name: str=None, metadata:dict=None):
+def object_resource(message_data: str):
+    """The object resource of a GCS object-change notification payload"""
+    try:
+        return json.loads(message_data)
+    except Exception:
+        return {}
+
+def object_md5_from_resource(message_data: str):
+    """The md5Hash of a GCS object-change notification payload, if there is one"""
+    return object_resource(message_data).get("md5Hash", None)
+
+# files over this size are uploaded in resumable chunks, and over the parallel size as concurrent parts
+GCS_UPLOAD_CHUNK_BYTES = int(os.getenv("GCS_UPLOAD_CHUNK_BYTES", 16 * 1024 * 1024))
+GCS_PARALLEL_UPLOAD_BYTES = int(os.getenv("GCS_PARALLEL_UPLOAD_BYTES", 256 * 1024 * 1024))
+GCS_UPLOAD_WORKERS = int(os.getenv("GCS_UPLOAD_WORKERS", 8))
+
+def compute_md5_from_file(file_path):
+    """The base64 md5 of a file, as GCS reports it in md5_hash"""
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            md5.update(block)
+    return base64.b64encode(md5.digest()).decode("utf-8")
+
+def _upload_blob(blob, filename: str):
+    size = os.path.getsize(filename)
+    if size > GCS_PARALLEL_UPLOAD_BYTES:
+        from utils.transport import is_local
+        if not is_local():
+            from google.cloud.storage import transfer_manager
+            from google.api_core.exceptions import PreconditionFailed
+            # the parallel upload can't take if_generation_match, so check first like the single upload would
+            if blob.exists():
+                raise PreconditionFailed(f"gs://{blob.bucket.name}/{blob.name} already exists")
+            # uploads parts concurrently and assembles them server side
+            transfer_manager.upload_chunks_concurrently(filename, blob, chunk_size=GCS_UPLOAD_CHUNK_BYTES * 2,
+                                                        worker_type=transfer_manager.THREAD,
+                                                        max_workers=GCS_UPLOAD_WORKERS)
+            return
+    if size > GCS_UPLOAD_CHUNK_BYTES:
+        # a chunked resumable upload only resends the chunk that failed
+        blob.chunk_size = GCS_UPLOAD_CHUNK_BYTES
+    # if_generation_match=0 makes the upload safe for the client to retry, and never overwrites an object
+    blob.upload_from_filename(filename, if_generation_match=0)
+
+def _add_one_file_to_gcs(bucket, filename: str, vector_name: str, metadata: dict, folder: str):
+    from google.api_core.exceptions import PreconditionFailed
+    bucket_name = bucket.name
+    md5 = compute_md5_from_file(filename)
+
+    uploaded = dedup.find_upload(vector_name, md5)
+    if uploaded is not None:
+        existing = bucket.get_blob(uploaded[len(f"gs://{bucket_name}/"):]) if uploaded.startswith(f"gs://{bucket_name}/") else None
+        if existing is not None and existing.md5_hash == md5:
+            logging.info(f"File {filename} already uploaded with the same md5 to {uploaded}")
+            return uploaded
+
+    the_metadata = {
+        "vector_name": vector_name,
+    }
+    if metadata is not None:
+        the_metadata.update(metadata)
 
-    storage_client = storage.Client()
+    basename = os.path.basename(filename)
+    stem, suffix = os.path.splitext(basename)
+    # a different file already at the path goes to one named after its md5 instead
+    md5_name = f"{stem}-{base64.b64decode(md5).hex()[:12]}{suffix}"
+    for name in [basename, md5_name]:
+        bucket_filepath = f"{vector_name}/{folder}/{name}"
+        gs_file = f"gs://{bucket_name}/{bucket_filepath}"
+        blob = bucket.blob(bucket_filepath)
+        blob.metadata = the_metadata
+        try:
+            _upload_blob(blob, filename)
+            logging.info(f"File {filename} uploaded to {gs_file}")
+        except PreconditionFailed:
+            existing = bucket.get_blob(bucket_filepath)
+            if existing is None or existing.md5_hash != md5:
+                logging.info(f"A different file already exists at {gs_file}, not overwriting it with {filename}")
+                continue
+            logging.info(f"File {filename} already exists with the same md5 in {gs_file}")
+        except Exception as err:
+            logging.error(f"Failed to upload file {filename} to {gs_file}: {str(err)}")
+            return None
+
+        dedup.record_upload(vector_name, md5, gs_file)
+        return gs_file
+
+    logging.error(f"Failed to upload file {filename}: different files already exist at its paths in gs://{bucket_name}")
+    return None
+
+def add_files_to_gcs(filenames: list, vector_name:str, bucket_name: str=None, metadata:dict=None, workers: int=None):
+    """Uploads files concurrently, returning their gs:// paths in the same order, or None for ones that failed.
+    Files whose md5 was already uploaded for vector_name return the existing object instead."""
+
+    storage_client = get_storage_client()
 
     bucket_name = bucket_name if bucket_name is not None else os.getenv('GCS_BUCKET', None)
     if bucket_name is None:
@@ -56,55 +157,17 @@ def add_file_to_gcs(filename: str, vector_name:str, bucket_name: str=None, metad
     if bucket_name.startswith("gs://"):
         bucket_name = bucket_name.removeprefix("gs://")
     
-    bucket = storage_client.get_bucket(bucket_name)
-    now = datetime.datetime.now()
-    year = now.strftime("%Y")
-    month = now.strftime("%m")
-    day = now.strftime("%d") 
-    hour = now.strftime("%H")
-    hour_prev = (now - datetime.timedelta(hours=1)).strftime("%H")
-
-    bucket_filepath = f"{vector_name}/{year}/{month}/{day}/{hour}/{os.path.basename(filename)}"
-    bucket_filepath_prev = f"{vector_name}/{year}/{month}/{day}/{hour_prev}/{os.path.basename(filename)}"
-
-    blob = bucket.blob(bucket_filepath)
-    blob_prev = bucket.blob(bucket_filepath_prev)
-
-    if blob.exists():
-        logging.info(f"File {filename} already exists in gs://{bucket_name}/{bucket_filepath}")
-        return f"gs://{bucket_name}/{bucket_filepath}"
-
-    if blob_prev.exists():
-        logging.info(f"File {filename} already exists in gs://{bucket_name}/{bucket_filepath_prev}")
-        return f"gs://{bucket_name}/{bucket_filepath_prev}"
-
-    logging.debug(f"File {filename} does not already exist in bucket {bucket_name}/{bucket_filepath}")
-
-    the_metadata = {
-        "vector_name": vector_name,
-    }
-    if metadata is not None:
-        the_metadata.update(metadata)
-
-    blob.metadata = the_metadata
-    
-    import time
-
-    max_retries = 5
-    base_delay = 1  # 1 second
-    for attempt in range(max_retries):
-        try:
-            blob.upload_from_filename(filename)
-            logging.info(f"File {filename} uploaded to gs://{bucket_name}/{bucket_filepath}")
-            break  # Success! Exit the loop.
-        except Exception as e:
-            # In case of an exception (timeout, etc.), wait and then retry
-            logging.warning(f"Upload attempt {attempt + 1} failed with error: {str(e)}. Retrying...")
-            time.sleep(base_delay * (2 ** attempt))  # Exponential backoff
+    bucket = storage_client.bucket(bucket_name)
+    folder = datetime.datetime.now().strftime("%Y/%m/%d/%H")
 
-    else:  # This block executes if the loop completes without breaking
-        logging.error(f"Failed to upload file {filename} to gs://{bucket_name}/{bucket_filepath} after {max_retries} attempts.")
+    start = time.time()
+    workers = min(workers or GCS_UPLOAD_WORKERS, max(len(filenames), 1))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gcs-upload") as executor:
+        gs_files = list(executor.map(
+            lambda filename: _add_one_file_to_gcs(bucket, filename, vector_name, metadata, folder), filenames))
 
+    logging.info(f"Uploaded {len([f for f in gs_files if f])} of {len(filenames)} files to gs://{bucket_name} "
+                 f"in {round(time.time() - start, 2)} seconds")
 
     # create pubsub topic and subscription if necessary to receive notifications from cloud storage 
     pubsub_manager = PubSubManager(vector_name, pubsub_topic=f"app_to_pubsub_{vector_name}")
@@ -117,77 +180,10 @@ def add_file_to_gcs(filename: str, vector_name:str, bucket_name: str=None, metad
         database.setup_database(vector_name)
         
 
-    return f"gs://{bucket_name}/{bucket_filepath}"
-
-def choose_splitter(extension: str, chunk_size: int=1024, chunk_overlap:int=0):
-    if extension == ".py":
-        return text_splitter.PythonCodeTextSplitter()
-    elif extension == ".md":
-        return text_splitter.MarkdownTextSplitter()
-    
-    return text_splitter.RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-
-def remove_whitespace(page_content: str):
-    return page_content.replace("\n", " ").replace("\r", " ").replace("\t", " ").replace("  ", " ")
-
-
-def chunk_doc_to_docs(documents: list, extension: str = ".md", min_size: int = 800):
-    """Turns a Document object into a list of many Document chunks.
-       If a document or chunk is smaller than min_size, it will be merged with adjacent documents or chunks."""
-
-    if documents is None:
-        return None
-
-    # Combine entire documents that are smaller than min_size
-    combined_documents_content = ""
-    combined_documents = []
-    for document in documents:
-        content = remove_whitespace(document.page_content)
-        if len(content) < min_size:
-            combined_documents_content += content + "\n"
-            logging.info(f"Appending document as its smaller than {min_size}: length {len(content)}")
-        else:
-            if combined_documents_content:
-                combined_documents.append(Document(page_content=combined_documents_content, metadata=document.metadata))
-                combined_documents_content = ""
-            combined_documents.append(document)
-
-    if combined_documents_content:
-        combined_documents.append(Document(page_content=combined_documents_content, metadata=documents[-1].metadata))
-
-    source_chunks = []
-    temporary_chunk = ""
-    for document in combined_documents:
-        splitter = choose_splitter(extension)
-        for chunk in splitter.split_text(document.page_content):
-            # If a chunk is smaller than the min_size, append it to temporary_chunk with a line break and continue
-            if len(chunk) < min_size:
-                temporary_chunk += chunk + "\n"
-                logging.info(f"Appending chunk as its smaller than {min_size}: length {len(chunk)}")
-                continue
-
-            # If there's content in temporary_chunk, append it to the current chunk
-            if temporary_chunk:
-                chunk = temporary_chunk + chunk
-                temporary_chunk = ""
-
-            # If the combined chunk is still less than the min_size, append to temporary_chunk with a line break and continue
-            if len(chunk) < min_size:
-                temporary_chunk += chunk + "\n"
-                logging.info(f"Appending chunk as its smaller than {min_size}: length {len(chunk)}")
-                continue
-
-            source_chunks.append(Document(page_content=chunk, metadata=document.metadata))
-
-        # If there's any remaining content in temporary_chunk, append it as a new chunk
-        if temporary_chunk:
-            source_chunks.append(Document(page_content=temporary_chunk, metadata=document.metadata))
-            temporary_chunk = ""
-
-    logging.info(f"Chunked into {len(source_chunks)} documents")
-    return source_chunks
-
+    return gs_files
 
+def add_file_to_gcs(filename: str, vector_name:str, bucket_name: str=None, metadata:dict=None):
+    return add_files_to_gcs([filename], vector_name=vector_name, bucket_name=bucket_name, metadata=metadata)[0]
 
 def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
     """Triggered from a message on a Cloud Pub/Sub topic.
@@ -203,6 +199,15 @@ def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
     logging.info(f"data_to_embed_pubsub was triggered by messageId {messageId} published at {publishTime}")
     logging.debug(f"data_to_embed_pubsub data: {message_data}")
 
+    # content hash of the whole file or message, to skip ones already ingested
+    object_hash = None
+    object_size = None
+    # git repos to mark as ingested at their current commit once their chunks are published
+    git_ingests = []
+    # {source: stage counts} of the ingest jobs this message started, see qna/ingest_jobs.py
+    jobs = {}
+    resource = {}
+
     # pubsub from a Google Cloud Storage push topic
     if attributes.get("eventType", None) is not None and attributes.get("payloadFormat", None) is not None:
         eventType = attributes.get("eventType")
@@ -219,11 +224,16 @@ def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
             if data.get('deliveryAttempt', None) is not None:
                 attempt = data.get('deliveryAttempt')
                 logging.info(f'deliveryAttempt detected for {objectId}: {attempt}')
-                if attempt > 2:
-                    logging.warning(f'deliveryAttempt > 2 for {objectId} - {attributes} - sending to batch job instead')
+                # PDFs are streamed page by page, so give them more attempts before the batch job
+                batch_after = PDF_BATCH_AFTER_ATTEMPTS if objectId.endswith(".pdf") else 2
+                if attempt > batch_after:
+                    logging.warning(f'deliveryAttempt > {batch_after} for {objectId} - {attributes} - sending to batch job instead')
                     batch = True
 
             # https://cloud.google.com/storage/docs/json_api/v1/objects#resource-representations
+            resource = object_resource(message_data)
+            object_hash = resource.get("md5Hash", None)
+            object_size = int(resource["size"]) if resource.get("size") else None
             message_data = 'gs://' + attributes.get("bucketId") + '/' + objectId
 
             if '/' in objectId:
@@ -247,17 +257,57 @@ def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
         bucket_name, file_name = message_data[5:].split("/", 1)
 
         # Create a client
-        storage_client = storage.Client()
+        storage_client = get_storage_client()
+
+        # bucket() makes no request, unlike get_bucket()
+        bucket = storage_client.bucket(bucket_name)
+        if object_hash is None:
+            # not from a bucket notification, so look up the md5 before downloading
+            blob = bucket.get_blob(file_name)
+            if blob is None:
+                raise ValueError(f"Could not find {message_data}")
+            object_hash = blob.md5_hash
+            object_size = blob.size
+        else:
+            blob = bucket.blob(file_name)
 
-        # Download the file from GCS
-        bucket = storage_client.get_bucket(bucket_name)
-        blob = bucket.blob(file_name)
+        if dedup.is_known_object(vector_name, object_hash):
+            logging.info(f"Skipping {message_data} as its content is already in {vector_name}")
+            return None
 
         file_name=pathlib.Path(file_name)
 
+        # pages of a fanned out PDF carry the source they were split from
+        parent = (resource.get("metadata") or {}).get("ingest_parent")
+        jobs = start_jobs(vector_name, [message_data], file_type=file_name.suffix, parent=parent)
+
+        the_metadata = {
+            "source": message_data,
+            "type": "file_load_gcs",
+            "bucket_name": bucket_name
+        }
+
+        # text is streamed and small PDFs held in memory, without a temp file download
+        if not batch and object_hash is not None:
+            blob_docs = loaders.iter_blob_documents(blob, size=object_size, metadata=metadata)
+            if blob_docs is not None:
+                metadata.update(the_metadata)
+                blob_docs = count_docs(blob_docs, jobs[message_data], "parsed")
+                stats = process_docs_chunks_vector_name(iter_chunk_docs(blob_docs, file_name.suffix), vector_name, metadata, jobs=jobs)
+                if stats["published"] > 0 and not stats["failed"]:
+                    dedup.record_object(vector_name, object_hash, message_data, source=metadata.get("source"))
+                return metadata
+
         with tempfile.TemporaryDirectory() as temp_dir:
             tmp_file_path = os.path.join(temp_dir, file_name.name)
             blob.download_to_filename(tmp_file_path)
+            ingest_jobs.record_stage(vector_name, message_data, "downloaded", os.path.getsize(tmp_file_path))
+            if object_hash is None:
+                # composite objects have no md5
+                object_hash = "sha1:" + compute_sha1_from_file(tmp_file_path)
+                if dedup.is_known_object(vector_name, object_hash):
+                    logging.info(f"Skipping {message_data} as its content is already in {vector_name}")
+                    return None
             if batch:
                 from chunker.batch import create_and_execute_batch_job
                 the_metadata = {
@@ -267,39 +317,45 @@ def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
                 }
                 metadata.update(the_metadata)
                 create_and_execute_batch_job(tmp_file_path, vector_name=vector_name, metadata=metadata)
+                # the batch job publishes no chunks here, so its job stays at batch
+                ingest_jobs.record_stage(vector_name, message_data, "batched", 1, status="batch")
                 return None
 
-            if file_name.suffix == ".pdf":
+            if file_name.suffix == ".pdf" and pdf_should_fan_out(tmp_file_path):
                 pages = split_pdf_to_pages(tmp_file_path, temp_dir)
                 if len(pages) > 1: # we send it back to GCS to parrallise the imports
                     logging.info(f"Got back {len(pages)} pages for file {tmp_file_path}")
-                    for pp in pages:
-                        gs_file = add_file_to_gcs(pp, vector_name=vector_name, bucket_name=bucket_name, metadata=metadata)
-                        logging.info(f"{gs_file} is now in bucket {bucket_name}")
+                    gs_files = add_files_to_gcs(pages, vector_name=vector_name, bucket_name=bucket_name,
+                                                metadata={**metadata, "ingest_parent": message_data})
+                    if None in gs_files:
+                        # a redelivery uploads the missing pages, the others are skipped by their md5
+                        error = f"Could not upload {gs_files.count(None)} split pages of {file_name.name}"
+                        ingest_jobs.fail_job(vector_name, message_data, error)
+                        raise ValueError(error)
                     logging.info(f"Sent split pages for {file_name.name} back to GCS to parrallise the imports")
+                    ingest_jobs.expect_parts(vector_name, message_data, gs_files)
+                    dedup.record_object(vector_name, object_hash, message_data)
                     return None
             else:
-                # just original temp file
+                # just original temp file, PDF pages are streamed by iter_file_documents
                 pages = [tmp_file_path]
 
-            the_metadata = {
-                "source": message_data,
-                "type": "file_load_gcs",
-                "bucket_name": bucket_name
-            }
             metadata.update(the_metadata)
 
-            docs = []
-            for page in pages:
-                logging.info(f"Sending file {page} to loaders.read_file_to_document {metadata}")
-                docs2 = loaders.read_file_to_document(page, metadata=metadata)
-                docs.extend(docs2)
+            # pages stream through the chunker to the publisher while the download is still on disk
+            page_docs = (doc for page in pages for doc in loaders.iter_file_documents(page, metadata=metadata))
+            page_docs = count_docs(page_docs, jobs[message_data], "parsed")
+            stats = process_docs_chunks_vector_name(iter_chunk_docs(page_docs, file_name.suffix), vector_name, metadata, jobs=jobs)
+
+        if stats["published"] > 0 and not stats["failed"]:
+            dedup.record_object(vector_name, object_hash, message_data, source=metadata.get("source"))
 
-            chunks = chunk_doc_to_docs(docs, file_name.suffix)
+        return metadata
 
     elif message_data.startswith("https://drive.google.com") or message_data.startswith("https://docs.google.com"):
         logging.info("Got google drive URL")
         urls = extract_urls(message_data)
+        jobs = start_jobs(vector_name, urls, file_type="gdrive")
 
         docs = []
         for url in urls:
@@ -310,6 +366,7 @@ def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
             if doc is None:
                 logging.info("Could not load any Google Drive docs")
             else:
+                jobs[url]["parsed"] = len(doc)
                 docs.extend(doc)
 
         chunks = chunk_doc_to_docs(docs)
@@ -327,24 +384,24 @@ def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
         
         logging.info(f"Using branch: {branch}")
 
-        docs = []
+        # chunks of each changed file go straight to the publisher as they are read
+        docs = None
+        jobs = start_jobs(vector_name, urls, file_type="git")
         for url in urls:
             metadata["source"] = url
             metadata["url"] = url
             metadata["type"] = "url_load"
-            doc = loaders.read_git_repo(url, branch=branch, metadata=metadata)
-            if doc is None:
-                logging.info("Could not load GitHub files")
-            else:
-                docs.extend(doc)
+            # only loads files changed since the commit last ingested into vector_name
+            git_ingests.append(GitRepoIngest(url, branch=branch, vector_name=vector_name, metadata=dict(metadata)))
 
-        chunks = chunk_doc_to_docs(docs)
+        chunks = (chunk for ingest in git_ingests for chunk in ingest.iter_chunks(chunk_doc_to_docs))
         
     elif message_data.startswith("http"):
         logging.info(f"Got http message: {message_data}")
 
         # just in case, extract the URL again
         urls = extract_urls(message_data)
+        jobs = start_jobs(vector_name, urls, file_type="url")
 
         docs = []
         for url in urls:
@@ -352,6 +409,7 @@ def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
             metadata["url"] = url
             metadata["type"] = "url_load"
             doc = loaders.read_url_to_document(url, metadata=metadata)
+            jobs[url]["parsed"] = len(doc)
             docs.extend(doc)
 
         chunks = chunk_doc_to_docs(docs)
@@ -371,13 +429,23 @@ def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
             logging.info("No content found")
             return {"metadata": "No content found"}
         
+        object_hash = "sha1:" + compute_sha1_from_content(the_content.encode('utf-8'))
+        if dedup.is_known_object(vector_name, object_hash):
+            logging.info(f"Skipping content as it is already in {vector_name}")
+            return None
+
         docs = [Document(page_content=the_content, metadata=metadata)]
 
         publish_if_urls(the_content, vector_name)
 
         chunks = chunk_doc_to_docs(docs)
 
-    process_docs_chunks_vector_name(chunks, vector_name, metadata)
+    stats = process_docs_chunks_vector_name(chunks, vector_name, metadata, jobs=jobs)
+    if stats is not None and stats["published"] > 0 and not stats["failed"]:
+        dedup.record_object(vector_name, object_hash, message_data, source=metadata.get("source"))
+    if stats is not None and not stats["failed"]:
+        for ingest in git_ingests:
+            ingest.mark_ingested()
 
     # summarisation of large docs, send them in too
     
@@ -396,23 +464,45 @@ def data_to_embed_pubsub(data: dict, vector_name: str, batch=False):
     return metadata
 
 
-def process_docs_chunks_vector_name(chunks, vector_name, metadata):
+def start_jobs(vector_name: str, sources: list, file_type: str=None, parent: str=None):
+    """Starts an ingest job for each source, returning their stage counts to pass as jobs below"""
+    for source in sources:
+        ingest_jobs.start_job(vector_name, source, file_type=file_type, parent=parent)
+    return {source: {} for source in sources}
+
+def count_docs(docs, counts: dict, stage: str):
+    for doc in docs:
+        counts[stage] = counts.get(stage, 0) + 1
+        yield doc
+
+def finish_jobs(vector_name: str, jobs: dict, published: dict, stats: dict):
+    """Records what each job chunked and published - it is complete once the embedder has stored as many chunks"""
+    for source, counts in jobs.items():
+        if stats is not None and stats["failed"]:
+            ingest_jobs.fail_job(vector_name, source, f"{stats['failed']} chunk messages failed to publish")
+            continue
+        published_counts = published.get(source, {"chunked": 0, "published": 0})
+        ingest_jobs.record_stages(vector_name, source, {**counts, **published_counts}, status="published")
+
+def process_docs_chunks_vector_name(chunks, vector_name, metadata, jobs: dict=None):
 
     pubsub_manager = PubSubManager(vector_name, pubsub_topic=f"pubsub_state_messages")
     if chunks is None:
         logging.info("No chunks found")
         pubsub_manager.publish_message(f"No chunks for: {metadata} to {vector_name} embedding")
+        if jobs:
+            finish_jobs(vector_name, jobs, {}, None)
         return None
         
-    publish_chunks(chunks, vector_name=vector_name)
+    stats = publish_chunks(chunks, vector_name=vector_name, jobs=jobs)
 
-    msg = f"data_to_embed_pubsub published chunks with metadata: {metadata}"
+    msg = f"data_to_embed_pubsub published chunks with metadata: {metadata} stats: {stats}"
 
     logging.info(msg)
     
-    pubsub_manager.publish_message(f"Sent doc chunks with metadata: {metadata} to {vector_name} embedding")
+    pubsub_manager.publish_message(f"Sent doc chunks with metadata: {metadata} to {vector_name} embedding - {stats}")
 
-    return metadata    
+    return stats
 
 def publish_if_urls(the_content, vector_name):
     """
@@ -427,30 +517,119 @@ def publish_if_urls(the_content, vector_name):
             publish_text(url, vector_name)
 
 
-def publish_chunks(chunks: list[Document], vector_name: str):
-    logging.info("Publishing chunks to embed_chunk")
-    
-    pubsub_manager = PubSubManager(vector_name, pubsub_topic=f"embed_chunk_{vector_name}")
+class ChunkPublisher:
+    """
+    Publishes chunks to embed_chunk_{vector_name} using batched, flow-controlled Pub/Sub publishing.
+    Optionally packs chunks_per_message chunks into one {"chunks": [...]} message envelope.
+    Call flush() before returning from a request so no publishes are left in flight.
+    """
+    def __init__(self, vector_name: str, chunks_per_message: int=None, timeout: float=None):
+        from google.cloud import pubsub_v1
+        self.vector_name = vector_name
+        self.chunks_per_message = chunks_per_message or int(os.getenv("PUBSUB_CHUNKS_PER_MESSAGE", 1))
+        self.timeout = timeout or float(os.getenv("PUBSUB_PUBLISH_TIMEOUT", 300))
+        self.pubsub_manager = PubSubManager(
+            vector_name, 
+            pubsub_topic=f"embed_chunk_{vector_name}",
+            batch_settings=pubsub_v1.types.BatchSettings(max_messages=100, max_bytes=1024*1024, max_latency=0.05),
+            flow_control=pubsub_v1.types.PublishFlowControl(
+                message_limit=1000, byte_limit=10*1024*1024,
+                limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK))
+        self._ensure_subscription()
+        # {source: {"chunked": n, "published": n}} from chunk metadata, for the ingest job ledger
+        self.sources = {}
+        self._envelope = []
+        self._futures = []
+        self._latencies = []
+        self.start = time.time()
+        self.stats = {"chunks": 0, "messages": 0, "published": 0, "failed": 0, "skipped": 0}
     
-    sub_name = f"pubsub_chunk_to_store_{vector_name}"
+    def _ensure_subscription(self):
+        sub_name = f"pubsub_chunk_to_store_{self.vector_name}"
 
-    sub_exists = pubsub_manager.subscription_exists(sub_name)
-    
-    if not sub_exists:
-        embed_url = os.getenv("EMBED_URL",None)
-        if embed_url is None:
-            raise ValueError("No EMDED_URL env var has been set")
-        pubsub_manager.create_subscription(sub_name,
-                                           push_endpoint=f"{embed_url}/pubsub_chunk_to_store/{vector_name}")
+        sub_exists = self.pubsub_manager.subscription_exists(sub_name)
         
-    for chunk in chunks:
-        # Convert chunk to string, as Pub/Sub messages must be strings or bytes
-        chunk_str = chunk.json()
-        if len(chunk_str) < 10:
-            logging.warning("Not publishing {chunk_str} as too small < 10 chars")
-            continue
-        logging.info(f"Publishing chunk: {chunk_str}")
-        pubsub_manager.publish_message(chunk_str)
+        if not sub_exists:
+            embed_url = os.getenv("EMBED_URL",None)
+            if embed_url is None:
+                raise ValueError("No EMDED_URL env var has been set")
+            self.pubsub_manager.create_subscription(sub_name,
+                                                    push_endpoint=f"{embed_url}/pubsub_chunk_to_store/{self.vector_name}")
+
+    def publish(self, chunks):
+        for chunk in chunks:
+            source_counts = self.sources.setdefault(chunk.metadata.get("source"), {"chunked": 0, "published": 0})
+            source_counts["chunked"] += 1
+            # Convert chunk to string, as Pub/Sub messages must be strings or bytes
+            chunk_str = chunk.json()
+            if len(chunk_str) < 10:
+                logging.warning(f"Not publishing {chunk_str} as too small < 10 chars")
+                self.stats["skipped"] += 1
+                continue
+            logging.info(f"Publishing chunk: {chunk_str}")
+            self.stats["chunks"] += 1
+            source_counts["published"] += 1
+            if self.chunks_per_message > 1:
+                self._envelope.append(chunk_str)
+                if len(self._envelope) >= self.chunks_per_message:
+                    self._publish_envelope()
+            else:
+                self._send(chunk_str)
+
+    def _publish_envelope(self):
+        if self._envelope:
+            self._send('{"chunks": [' + ",".join(self._envelope) + ']}')
+            self._envelope = []
+
+    def _send(self, message: str):
+        sent_at = time.time()
+        future = self.pubsub_manager.publish_message(message)
+        if future is None:
+            self.stats["failed"] += 1
+            return
+        future.add_done_callback(lambda _: self._latencies.append(time.time() - sent_at))
+        self._futures.append(future)
+        self.stats["messages"] += 1
+
+    def flush(self):
+        """Waits for all publishes to complete and returns the publishing stats"""
+        self._publish_envelope()
+        deadline = time.time() + self.timeout
+        for future in self._futures:
+            try:
+                future.result(timeout=max(deadline - time.time(), 0))
+                self.stats["published"] += 1
+            except Exception as err:
+                logging.error(f"Failed to publish chunk message to embed_chunk_{self.vector_name}: {str(err)}")
+                self.stats["failed"] += 1
+        self._futures = []
+
+        if self._latencies:
+            self.stats["latency_mean"] = round(sum(self._latencies) / len(self._latencies), 3)
+            self.stats["latency_max"] = round(max(self._latencies), 3)
+        self.stats["seconds"] = round(time.time() - self.start, 2)
+        logging.info(f"Published chunks to embed_chunk_{self.vector_name}: {self.stats}")
+
+        return self.stats
+
+def publish_chunks(chunks: list[Document], vector_name: str, jobs: dict=None):
+    logging.info("Publishing chunks to embed_chunk")
+    
+    publisher = ChunkPublisher(vector_name)
+    try:
+        publisher.publish(chunks)
+    except Exception as err:
+        # e.g. a document that failed to read part way through, what was published so far is incomplete
+        publisher.flush()
+        for source in jobs or {}:
+            ingest_jobs.fail_job(vector_name, source, str(err))
+        raise
+    stats = publisher.flush()
+
+    if jobs:
+        finish_jobs(vector_name, jobs, publisher.sources, stats)
+
+    return stats
     
 
 def publish_text(text:str, vector_name: str):
@@ -0,0 +1,121 @@
+import os, sys
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+
+import time
+import random
+import pathlib
+import logging
+import tempfile
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain.document_loaders.unstructured import UnstructuredAPIFileLoader
+
+# Sends files to one or more Unstructured API endpoints, set as a comma separated UNSTRUCTURED_URL.
+# Big PDFs are cut into page ranges that are partitioned concurrently, each range retried on its own
+# against the next endpoint, and the resulting documents merged back in page order.
+
+UNSTRUCTURED_KEY = os.getenv('UNSTRUCTURED_KEY')
+PAGES_PER_REQUEST = int(os.getenv("UNSTRUCTURED_PAGES_PER_REQUEST", 20))
+RETRIES = int(os.getenv("UNSTRUCTURED_RETRIES", 3))
+
+_endpoints = None
+_endpoints_lock = threading.Lock()
+
+def endpoints():
+    """The Unstructured endpoints to use, or [None] for the hosted API with UNSTRUCTURED_KEY"""
+    global _endpoints
+    with _endpoints_lock:
+        if _endpoints is None:
+            urls = [url.strip().rstrip("/") for url in os.getenv("UNSTRUCTURED_URL", "").split(",") if url.strip()]
+            _endpoints = (urls or [None], itertools.cycle(urls or [None]))
+    return _endpoints[0]
+
+def next_endpoint():
+    endpoints()
+    with _endpoints_lock:
+        return next(_endpoints[1])
+
+def make_loader(file_path, endpoint=None, **kwargs):
+    if endpoint is not None:
+        logging.debug(f"Using Unstructured endpoint: {endpoint}")
+        return UnstructuredAPIFileLoader(str(file_path), url=f"{endpoint}/general/v0/general", **kwargs)
+    return UnstructuredAPIFileLoader(str(file_path), api_key=UNSTRUCTURED_KEY, **kwargs)
+
+def _is_retryable(err):
+    # unsupported file types won't work on any endpoint, the caller handles those
+    return "file type is not supported in partition" not in str(err)
+
+def load_with_retries(file_path, retries: int=None):
+    """Loads a file via the next endpoint, moving on to the next one each time it fails"""
+    retries = RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        endpoint = next_endpoint()
+        try:
+            start = time.time()
+            docs = make_loader(file_path, endpoint).load()
+            logging.info(f"Partitioned {file_path} via {endpoint or 'Unstructured API'} in {round(time.time() - start, 2)} seconds")
+            return docs
+        except Exception as err:
+            if attempt == retries or not _is_retryable(err):
+                raise
+            delay = min(2 ** attempt, 30) + random.random()
+            logging.warning(f"Partitioning {file_path} via {endpoint} failed, retrying in {round(delay, 1)}s: {str(err)}")
+            time.sleep(delay)
+
+def split_pdf_ranges(pdf_path, temp_dir, pages_per_range: int):
+    """Writes the PDF as files of pages_per_range pages, returning [(first_page, last_page, path)]"""
+    from pypdf import PdfWriter
+    from chunker.pdfs import open_pdf
+
+    basename = pathlib.Path(pdf_path).stem
+    ranges = []
+    with open_pdf(pdf_path) as pdf:
+        page_count = len(pdf.pages)
+        for start in range(0, page_count, pages_per_range):
+            end = min(start + pages_per_range, page_count)
+            writer = PdfWriter()
+            for page in range(start, end):
+                writer.add_page(pdf.pages[page])
+            range_path = pathlib.Path(temp_dir, f"{basename}_p{start + 1}-{end}.pdf")
+            with open(range_path, "wb") as out:
+                writer.write(out)
+            ranges.append((start + 1, end, str(range_path)))
+    return ranges
+
+def partition_file(file_path, workers: int=None, pages_per_range: int=None):
+    """Returns the Documents Unstructured makes from file_path. PDFs longer than pages_per_range
+    are partitioned as concurrent page ranges spread over the endpoints."""
+    pages_per_range = pages_per_range or PAGES_PER_REQUEST
+    if pathlib.Path(file_path).suffix != ".pdf":
+        return load_with_retries(file_path)
+
+    from chunker.pdfs import pdf_page_count
+    page_count = pdf_page_count(file_path)
+    if page_count <= pages_per_range:
+        return load_with_retries(file_path)
+
+    workers = workers or int(os.getenv("UNSTRUCTURED_WORKERS", len(endpoints()) * 4))
+    start = time.time()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ranges = split_pdf_ranges(file_path, temp_dir, pages_per_range)
+        logging.info(f"Partitioning {file_path} as {len(ranges)} page ranges over {len(endpoints())} endpoint(s) with {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="unstructured") as executor:
+            # map keeps the ranges in page order
+            results = list(executor.map(lambda page_range: load_with_retries(page_range[2]), ranges))
+
+    docs = []
+    for (first_page, last_page, _), range_docs in zip(ranges, results):
+        for doc in range_docs:
+            doc.metadata["source"] = str(file_path)
+            doc.metadata["page_range"] = f"{first_page}-{last_page}"
+            # a page_number from an elements partition is relative to its range,
+            # a single mode doc has none and spans the whole range
+            if doc.metadata.get("page_number") is not None:
+                doc.metadata["page_number"] += first_page - 1
+            docs.append(doc)
+
+    logging.info(f"Partitioned {page_count} pages of {file_path} into {len(docs)} docs in {round(time.time() - start, 2)} seconds")
+    return docs
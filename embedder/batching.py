@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+import qna.rate_limit as rate_limit
+
+# phrases providers use when a single embedding request carries too many texts or tokens
+BATCH_LIMIT_ERRORS = ["maximum context length", "too many tokens", "token limit", "too many inputs",
+                      "too many instances", "input token count", "payload size exceeds", "batch size"]
+
+def _status_code(err):
+    # openai errors have http_status or status_code, google api_core errors code, requests errors a response
+    for attr in ["status_code", "http_status", "code"]:
+        code = getattr(err, attr, None)
+        if isinstance(code, int):
+            return code
+    return getattr(getattr(err, "response", None), "status_code", None)
+
+def is_batch_limit_error(err):
+    if _status_code(err) == 413:
+        return True
+    msg = str(err).lower()
+    return any(phrase in msg for phrase in BATCH_LIMIT_ERRORS)
+
+def add_documents_splitting(vector_store, docs, on_stored=None, rate_limit_name=None):
+    """Adds docs in one embed + insert call, halving the batch when the provider rejects its size.
+    Returns a list with None for each stored doc, or the error message for docs that could not be stored.
+    on_stored(docs, ids) is called for each part of the batch that was stored.
+    Calls wait for the rate_limit_name quota, see qna/rate_limit.py, but aren't retried as the insert
+    may already have happened - failed docs are returned as errors and counted as failed in their ingest job."""
+    try:
+        ids = rate_limit.call(rate_limit_name, vector_store.add_documents, docs,
+                              tokens=rate_limit.estimate_tokens(*[doc.page_content for doc in docs]), retries=0)
+        if on_stored is not None:
+            on_stored(docs, ids)
+        return [None] * len(docs)
+    except Exception as err:
+        if len(docs) > 1 and is_batch_limit_error(err):
+            mid = len(docs) // 2
+            logging.warning(f"Batch of {len(docs)} docs was too big for the embedding provider, splitting it: {str(err)}")
+            return add_documents_splitting(vector_store, docs[:mid], on_stored, rate_limit_name) + \
+                add_documents_splitting(vector_store, docs[mid:], on_stored, rate_limit_name)
+
+        logging.error(f"Could not add {len(docs)} document(s) to vector store: {str(err)} traceback: {traceback.format_exc()}")
+        return [str(err)] * len(docs)
+
+
+class ChunkBatcher:
+    """
+    Accumulates chunks per vector_name from concurrent push requests and stores them together
+    once max_size chunks have arrived or max_wait seconds have passed since the first one.
+    Each request waits on its Future, so all messages in a batch are acked together when it lands.
+    """
+    def __init__(self, store_fn, max_size: int=50, max_wait: float=2.0):
+        self.store_fn = store_fn
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, vector_name: str, doc) -> Future:
+        future = Future()
+        to_flush = None
+        with self._lock:
+            batch = self._pending.setdefault(vector_name, [])
+            batch.append((doc, future))
+            if len(batch) == 1:
+                timer = threading.Timer(self.max_wait, self._flush_if_pending, args=(vector_name, batch))
+                timer.daemon = True
+                timer.start()
+            if len(batch) >= self.max_size:
+                to_flush = self._pending.pop(vector_name)
+
+        if to_flush is not None:
+            self._store(vector_name, to_flush)
+
+        return future
+
+    def _flush_if_pending(self, vector_name, batch):
+        with self._lock:
+            if self._pending.get(vector_name) is not batch:
+                # already flushed for being full
+                return
+            self._pending.pop(vector_name)
+        self._store(vector_name, batch)
+
+    def _store(self, vector_name, batch):
+        docs = [doc for doc, _ in batch]
+        start = time.time()
+        try:
+            results = self.store_fn(vector_name, docs)
+        except Exception as err:
+            logging.error(f"Could not store batch of {len(docs)} for {vector_name}: {str(err)}")
+            results = [str(err)] * len(docs)
+
+        logging.info(f"Stored batch of {len(docs)} chunks for {vector_name} in {round(time.time() - start, 2)} seconds")
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -1,5 +1,5 @@
 # imports
-import traceback
+import os
 
 import base64
 import json
@@ -7,17 +7,16 @@ import datetime
 
 from langchain.schema import Document
 import logging
-from qna.llm import pick_llm
-from qna.llm import pick_vectorstore
+from qna.profiles import get_profile
+import qna.dedup as dedup
+import qna.ingest_jobs as ingest_jobs
+from qna.rate_limit import provider_for
+from embedder.batching import ChunkBatcher, add_documents_splitting
 
-def from_pubsub_to_vectorstore(data: dict, vector_name:str):
-    """Triggered from a message on a Cloud Pub/Sub topic "embed_chunk" topic
-    Will only attempt to send one chunk to vectorstore.  For bigger documents use pubsub_to_store.py
-    Args:
-         data JSON
-    """
-
-    logging.debug(f"vectorstore: {vector_name}")
+def parse_chunk_message(data: dict, dropped: list=None):
+    """Turns a Pub/Sub push of one chunk, or a {"chunks": [...]} envelope of several,
+    into a list of Documents, or returns a string saying why it was skipped.
+    The metadata source of each chunk too small to store is appended to dropped."""
 
     #file_sha = data['message']['data']
 
@@ -37,33 +36,110 @@ def from_pubsub_to_vectorstore(data: dict, vector_name:str):
     if not isinstance(the_json, dict):
         raise ValueError(f"Could not parse message_data from json to a dict: got {message_data} or type: {type(the_json)}")
 
+    if "chunks" in the_json:
+        docs = [chunk_to_document(chunk) for chunk in the_json["chunks"]]
+        if dropped is not None:
+            dropped.extend((chunk.get("metadata") or {}).get("source")
+                           for chunk, doc in zip(the_json["chunks"], docs) if isinstance(doc, str))
+        docs = [doc for doc in docs if not isinstance(doc, str)]
+        if not docs:
+            return "No chunks with enough page content"
+        return docs
+
+    doc = chunk_to_document(the_json)
+    if isinstance(doc, str):
+        if dropped is not None:
+            dropped.append((the_json.get("metadata") or {}).get("source"))
+        return doc
+
+    return [doc]
+
+def chunk_to_document(the_json: dict):
+
     page_content = the_json.get("page_content", None)
     if page_content is None:
         return "No page content"
     if len(page_content) < 100:
-        logging.warning(f"too little page content to add: {message_data}")
+        logging.warning(f"too little page content to add: {the_json}")
         return "Too little characters"
-    
+
     logging.info(f"embedding page_content: {page_content}")
-    
+
     metadata = the_json.get("metadata", None)
 
     if 'eventTime' not in metadata:
         metadata['eventTime'] = datetime.datetime.utcnow().isoformat(timespec='microseconds') + "Z"
 
+    return Document(page_content=page_content, metadata=metadata)
+
+def store_documents(vector_name: str, docs: list):
+    # skip embedding chunks whose exact content is already in the vectorstore
+    new_docs, hashes = dedup.filter_new_chunks(vector_name, docs)
+    results = dict.fromkeys(map(id, docs), None)
+    if new_docs:
+        sha1_of = {id(doc): the_hash for doc, the_hash in zip(new_docs, hashes)}
+
+        def record(stored_docs, ids):
+            dedup.record_chunks(vector_name, stored_docs, [sha1_of[id(doc)] for doc in stored_docs], ids)
+
+        # the embeddings client and vector store are reused across requests via the brain profile
+        vector_store = get_profile(vector_name).vectorstore
+        errors = add_documents_splitting(vector_store, new_docs, on_stored=record,
+                                         rate_limit_name=provider_for(vector_name, embeddings=True))
+        results.update(zip(map(id, new_docs), errors))
+
+    logging.info(f"Dedup stats: {dedup.dedup_stats()}")
+    errors = [results[id(doc)] for doc in docs]
+    record_ingest_jobs(vector_name, docs, errors, skipped={id(doc) for doc in docs} - {id(doc) for doc in new_docs})
+    return errors
+
+def record_ingest_jobs(vector_name: str, docs: list, errors: list, skipped: set=frozenset()):
+    # queued, so the ledger is updated once per source per flush rather than per message
+    counts = {}
+    for doc, error in zip(docs, errors):
+        stage = "skipped" if id(doc) in skipped else "stored" if error is None else "failed"
+        source_counts = counts.setdefault(doc.metadata.get("source"), {})
+        source_counts[stage] = source_counts.get(stage, 0) + 1
+    for source, source_counts in counts.items():
+        ingest_jobs.queue_stages(vector_name, source, source_counts)
+
+# EMBED_BATCH_SIZE > 1 turns on micro-batching: needs Cloud Run concurrency > 1 so pushes can accumulate
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 1))
+EMBED_BATCH_WAIT = float(os.getenv("EMBED_BATCH_WAIT", 2.0))
+batcher = ChunkBatcher(store_documents, max_size=EMBED_BATCH_SIZE, max_wait=EMBED_BATCH_WAIT)
 
-    doc = Document(page_content=page_content, metadata=metadata)
-
-    # init embedding and vector store
-    _, embeddings, _ = pick_llm(vector_name)
-    vector_store = pick_vectorstore(vector_name, embeddings=embeddings)
+def from_pubsub_to_vectorstore(data: dict, vector_name:str):
+    """Triggered from a message on a Cloud Pub/Sub topic "embed_chunk" topic
+    Will only attempt to send the chunk(s) in the message to vectorstore.  For bigger documents use pubsub_to_store.py
+    With EMBED_BATCH_SIZE set the chunks wait to be embedded and inserted together with others.
+    Args:
+         data JSON
+    """
 
-    logging.debug("Adding single document to vector store")
-    try:
-        vector_store.add_documents([doc])
-        logging.info(f"Added doc with metadata: {metadata}")
-    except Exception as err:
-        error_message = traceback.format_exc()
-        logging.error(f"Could not add document {doc} to vector store: {str(err)} traceback: {error_message}")
+    logging.debug(f"vectorstore: {vector_name}")
 
-    return metadata
+    dropped = []
+    docs = parse_chunk_message(data, dropped=dropped)
+    # published chunks that won't be stored, so their ingest jobs shouldn't wait for them
+    for source in set(dropped):
+        ingest_jobs.queue_stages(vector_name, source, {"skipped": dropped.count(source)})
+    if isinstance(docs, str):
+        return docs
+
+    if EMBED_BATCH_SIZE > 1:
+        logging.debug(f"Adding {len(docs)} document(s) to {vector_name} batch")
+        # returning only once the batch is stored means Pub/Sub redelivers it if the container dies first
+        futures = [batcher.submit(vector_name, doc) for doc in docs]
+        errors = [future.result() for future in futures]
+    else:
+        logging.debug(f"Adding {len(docs)} document(s) to vector store")
+        errors = store_documents(vector_name, docs)
+
+    for doc, error in zip(docs, errors):
+        if error is None:
+            logging.info(f"Added doc with metadata: {doc.metadata}")
+
+    if len(docs) == 1:
+        return docs[0].metadata
+    
+    return [doc.metadata for doc in docs]
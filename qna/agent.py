@@ -7,12 +7,11 @@ from langchain.tools.python.tool import PythonREPLTool
 from langchain import LLMMathChain
 from langchain.chains import RetrievalQA
 
-from httpx import ReadTimeout
+import qna.rate_limit as rate_limit
 
 import logging
-import traceback
 
-def activate_agent(question, llm_chat, chat_history, retriever, calendar_retriever=None):
+def activate_agent(question, llm_chat, chat_history, retriever, calendar_retriever=None, vector_name=None):
 
     logging.info(f"Activating agent {question}")
 
@@ -96,46 +95,17 @@ If there are no memories of events, reply saying there were no events found. Nev
 
     agent_kwargs = {'prefix': f'You are an assistant to another AI. You have access to the following tools:'}
 
-    max_retries=1
-    initial_delay = 5
-    import time
-    for retry in range(max_retries):
-        try:
-            agent_chain = initialize_agent(tools, 
-                                           llm=llm_chat, 
-                                           agent=AgentType.OPENAI_FUNCTIONS, 
-                                           agent_kwargs=agent_kwargs, 
-                                           verbose=True)
-            result = agent_chain.run(input=question)
-        except ReadTimeout as err:
-            delay = initial_delay * (retry + 1)
-            logging.warning(f"Read timeout while asking: {question} - trying again after {delay} seconds. Error: {str(err)}")
-            time.sleep(delay)
-            try:
-                agent_chain = initialize_agent(tools, 
-                                               llm=llm_chat, 
-                                               agent=AgentType.OPENAI_FUNCTIONS,
-                                               agent_kwargs=agent_kwargs, 
-                                               verbose=True)
-                result = agent_chain.run(input=question)
-            except ReadTimeout:
-                if retry == max_retries - 1:
-                    raise
-        except Exception as err:
-            delay = initial_delay * (retry + 1)
-            logging.error(f"General error: {traceback.format_exc()}")
-            time.sleep(delay)
-            try:
-                agent_chain = initialize_agent(tools, 
-                                               llm=llm_chat, 
-                                               agent=AgentType.OPENAI_FUNCTIONS, 
-                                               agent_kwargs=agent_kwargs,
-                                               verbose=True)
-                result = agent_chain.run(input=question)
+    def run_agent():
+        agent_chain = initialize_agent(tools, 
+                                       llm=llm_chat, 
+                                       agent=AgentType.OPENAI_FUNCTIONS, 
+                                       agent_kwargs=agent_kwargs, 
+                                       verbose=True)
+        return agent_chain.run(input=question)
 
-            except Exception:
-                if retry == max_retries - 1:
-                    raise
+    # the agent makes several llm calls, counted as a few requests against the provider's quota
+    provider = rate_limit.provider_for(vector_name) if vector_name else None
+    result = rate_limit.call(provider, run_agent, tokens=rate_limit.estimate_tokens(question), requests=3, retries=1)
 
     logging.info(f"Agent answer: {result}")
 
@@ -14,13 +14,10 @@ import logging
 app = Flask(__name__)
 app.config['TRAP_HTTP_EXCEPTIONS'] = True
 
-from google.cloud import storage
+from utils.config_watcher import ConfigWatcher
 
 app = Flask(__name__)
 
-# Initialize Google Cloud Storage client
-storage_client = storage.Client()
-
 # The name of your bucket and the file you want to check
 bucket_name = os.environ.get('GCS_BUCKET')
 if bucket_name:
@@ -30,44 +27,39 @@ else:
 
 blob_name = 'local_config.json'
 
-# Global variable to store the last modification time
-last_mod_time = None
-
-
-def fetch_config():
-    global last_mod_time
-
-    bucket = storage_client.bucket(bucket_name)
-    blob = storage.Blob(blob_name, bucket)
-
-    # Check if the file exists
-    if not blob.exists():
-        logging.info(f"The blob {blob_name} does not exist in the bucket {bucket_name}")
-        return None
-
-    # Download the file to a local file
-    blob.download_to_filename('config.com')
-
-    # Get the blob's updated time
-    updated_time = blob.updated
-
-    return updated_time
-
-
-@app.before_request
-def before_request():
-    global last_mod_time
-    
-    # Fetch the current modification time from Cloud Storage
-    current_mod_time = fetch_config()
-    
-    if current_mod_time:
-        # Compare the modification times
-        if last_mod_time is None or last_mod_time < current_mod_time:
-            last_mod_time = current_mod_time
-            logging.info("Configuration file updated, reloaded the new configuration.")
-        else:
-            logging.info("Configuration file not modified.")
+# polls the blob generation in the background instead of downloading it on every request
+config_watcher = ConfigWatcher(bucket_name, blob_name, 
+                               poll_seconds=int(os.environ.get('CONFIG_POLL_SECONDS', 60))).start()
+
+@app.route('/config/status', methods=['GET'])
+def config_status():
+    from utils.config import config_cache_stats
+    status = config_watcher.status()
+    status["cache"] = config_cache_stats()
+    return jsonify(status)
+
+@app.route('/pubsub/config_changed', methods=['POST'])
+def config_changed():
+    """Push endpoint for a GCS object-change notification on the config bucket"""
+    data = request.get_json(silent=True) or {}
+    attributes = data.get('message', {}).get('attributes', {})
+    if attributes.get('objectId', blob_name) == blob_name:
+        logging.info(f"Got change notification for {blob_name} - refreshing config")
+        config_watcher.refresh_now()
+    return 'ok', 200
+
+@app.route('/warmup', methods=['GET', 'POST'])
+def warmup():
+    """Builds the brain profiles for every vector_name in config.json, or those POSTed as a list"""
+    from qna.profiles import warm_profiles
+    data = request.get_json(silent=True) or {}
+    return jsonify(warm_profiles(data.get('vector_names', None)))
+
+if os.environ.get('WARMUP_ON_START', 'true').lower() == 'true':
+    # build brain profiles at container start without holding up the first requests
+    import threading
+    from qna.profiles import warm_profiles
+    threading.Thread(target=warm_profiles, name="warmup", daemon=True).start()
 
 def document_to_dict(document):
     return {
@@ -1,9 +1,13 @@
 import psycopg2
-from psycopg2.extensions import adapt
+import psycopg2.extensions
+import psycopg2.pool
 import logging
 import os
 import time
 import math
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 
 logging.basicConfig(level=logging.INFO)
 
@@ -44,103 +48,275 @@ def get_vector_size(vector_name: str):
     logging.debug(f'vector size: {vector_size}')
     return vector_size
 
+# (version, sql file) applied in order to each namespace.  
+# To ship a new version of a SQL function, add its file with the next version number.
+SCHEMA_MIGRATIONS = [
+    (1, "sql/sb/setup.sql"),
+    (1, "sql/sb/create_table.sql"),
+    (1, "sql/sb/create_function.sql"),
+    (2, "sql/sb/create_dedup_ledger.sql"),
+    (3, "sql/sb/create_git_ingest_state.sql"),
+    (4, "sql/sb/create_ingest_jobs.sql"),
+]
+SCHEMA_VERSION = max(version for version, _ in SCHEMA_MIGRATIONS)
+
+# (connection_env, vector_name) already at SCHEMA_VERSION in this process
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+def get_schema_version(vector_name:str, connection_env:str):
+    execute_sql_from_file("sql/sb/create_schema_versions.sql", {}, connection_env=connection_env)
+    rows = do_sql("SELECT version FROM edmonbrain_schema_versions WHERE namespace = %(namespace)s",
+                  sql_params={'namespace': vector_name}, return_rows=True, connection_env=connection_env)
+    if rows is None:
+        return 0
+    return rows[0][0]
+
+def set_schema_version(vector_name:str, version:int, connection_env:str):
+    do_sql("""INSERT INTO edmonbrain_schema_versions (namespace, version) VALUES (%(namespace)s, %(version)s)
+              ON CONFLICT (namespace) DO UPDATE SET version = EXCLUDED.version, updated_at = NOW()""",
+           sql_params={'namespace': vector_name, 'version': version}, connection_env=connection_env)
+
 def setup_database(vector_name:str, verbose:bool=False):
 
     connection_env = lookup_connection_env(vector_name)
-    
-    params = {'vector_name': vector_name, 'vector_size': get_vector_size(vector_name)}
+    if (connection_env, vector_name) in _migrated:
+        return True
 
-    execute_sql_from_file("sql/sb/setup.sql", params, verbose=verbose, connection_env=connection_env)
-    execute_sql_from_file("sql/sb/create_table.sql", params, verbose=verbose, connection_env=connection_env)
-    execute_sql_from_file("sql/sb/create_function.sql", params, verbose=verbose, connection_env=connection_env)
+    with _migrate_lock:
+        if (connection_env, vector_name) in _migrated:
+            return True
+        
+        migrate_database(vector_name, connection_env=connection_env, verbose=verbose)
+        _migrated.add((connection_env, vector_name))
 
-    if verbose: print("Ran all setup SQL statements")
-    
     return True
 
-def return_sources_last24(vector_name:str):
-    params = {'vector_name': vector_name, 'time_period':'1 day'}
-    return execute_sql_from_file("sql/sb/return_sources.sql", params, return_rows=True, 
-                                 connection_env=lookup_connection_env(vector_name))
-
-def delete_row_from_source(source: str, vector_name:str):
-    # adapt the user input and decode from bytes to string to protect against sql injection
-    source = adapt(source).getquoted().decode()
-    sql_params = {'source_delete': source}
-    sql = f"""
-        DELETE FROM {vector_name}
-        WHERE metadata->>'source' = %(source_delete)s
-    """
+def migrate_database(vector_name:str, connection_env:str, verbose:bool=False):
+    """Runs the SCHEMA_MIGRATIONS newer than the version recorded for vector_name"""
+    current_version = get_schema_version(vector_name, connection_env=connection_env)
+    if current_version >= SCHEMA_VERSION:
+        logging.debug(f"Database for {vector_name} already at schema version {current_version}")
+        return current_version
 
-    do_sql(sql, sql_params=sql_params, connection_env=lookup_connection_env(vector_name))
+    params = {'vector_name': vector_name, 'vector_size': get_vector_size(vector_name)}
 
+    for version, sql_file in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        logging.info(f"Migrating {vector_name} to schema version {version}: {sql_file}")
+        execute_sql_from_file(sql_file, params, verbose=verbose, connection_env=connection_env)
 
+    set_schema_version(vector_name, SCHEMA_VERSION, connection_env=connection_env)
 
-def do_sql(sql, sql_params=None, return_rows=False, verbose=False, connection_env='DB_CONNECTION_STRING', max_retries=5):
+    if verbose: print(f"Ran all setup SQL statements up to schema version {SCHEMA_VERSION}")
+    
+    return SCHEMA_VERSION
 
-    if connection_env is None:
-        raise ValueError("Need to specify connection_env to connect to DB")
+def return_sources_last24(vector_name:str):
+    return execute_prepared_from_file("sql/sb/return_sources.sql", f"return_sources_{vector_name}",
+                                      params={'vector_name': vector_name}, arg_types=["text"], 
+                                      args=['1 day'], return_rows=True,
+                                      connection_env=lookup_connection_env(vector_name))
 
-    rows = []
+def delete_row_from_source(source: str, vector_name:str):
+    # the source is sent as a bound parameter of the prepared statement so is safe from sql injection
+    execute_prepared_from_file("sql/sb/delete_source_row.sql", f"delete_source_{vector_name}",
+                               params={'vector_name': vector_name}, arg_types=["text"], 
+                               args=[source], connection_env=lookup_connection_env(vector_name))
+
+    # so the same content can be ingested again
+    from qna.dedup import forget_source
+    forget_source(source, vector_name)
+
+def delete_rows_from_file(url: str, file_path: str, vector_name:str):
+    """Deletes the rows loaded from one file of a git repository, returning their ids"""
+    rows = execute_prepared_from_file("sql/sb/delete_file_rows.sql", f"delete_file_{vector_name}",
+                                      params={'vector_name': vector_name}, arg_types=["text", "text"],
+                                      args=[url, file_path], return_rows=True,
+                                      connection_env=lookup_connection_env(vector_name))
+    ids = [row[0] for row in rows] if rows else []
+
+    # so unchanged chunks of the file are embedded again
+    from qna.dedup import forget_refs
+    forget_refs(ids, vector_name)
+
+    return ids
+
+def get_git_commit(repo: str, branch: str, vector_name: str):
+    setup_database(vector_name)
+    rows = do_sql(f"SELECT commit_sha FROM {vector_name}_git_ingest_state WHERE repo = %(repo)s AND branch = %(branch)s",
+                  sql_params={'repo': repo, 'branch': branch}, return_rows=True,
+                  connection_env=lookup_connection_env(vector_name))
+    if rows is None:
+        return None
+    return rows[0][0]
+
+def set_git_commit(repo: str, branch: str, commit_sha: str, vector_name: str):
+    do_sql(f"""INSERT INTO {vector_name}_git_ingest_state (repo, branch, commit_sha) VALUES (%(repo)s, %(branch)s, %(commit_sha)s)
+               ON CONFLICT (repo, branch) DO UPDATE SET commit_sha = EXCLUDED.commit_sha, updated_at = NOW()""",
+           sql_params={'repo': repo, 'branch': branch, 'commit_sha': commit_sha},
+           connection_env=lookup_connection_env(vector_name))
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """A connection that remembers which statements have been PREPAREd in its session"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+# one pool per connection env: {(connection_env, connection_string): (pool, semaphore)}
+_pools = {}
+_pools_lock = threading.Lock()
+
+# SQLSTATE classes worth retrying: connection exceptions, transaction rollbacks (serialization/deadlock),
+# insufficient resources, operator intervention (e.g. admin shutdown, statement timeout) and internal errors
+TRANSIENT_PGCODE_CLASSES = ('08', '40', '53', '57', 'XX')
+
+def is_transient_error(error):
+    pgcode = getattr(error, 'pgcode', None)
+    if pgcode:
+        return pgcode[:2] in TRANSIENT_PGCODE_CLASSES
+    # no SQLSTATE means the error came from the connection itself e.g. a dropped socket
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+def get_pool(connection_env:str):
     connection_string = os.getenv(connection_env, None)
     if connection_string is None:
         raise ValueError("No connection string")
 
-    for attempt in range(max_retries):
+    key = (connection_env, connection_string)
+    if key not in _pools:
+        with _pools_lock:
+            if key not in _pools:
+                max_connections = int(os.getenv('DB_POOL_SIZE', 5))
+                logging.info(f"Creating PostgreSQL connection pool for {connection_env} of size {max_connections}")
+                the_pool = psycopg2.pool.ThreadedConnectionPool(0, max_connections, 
+                                                                dsn=connection_string, 
+                                                                connection_factory=PreparingConnection)
+                # the pool raises when exhausted, so make callers wait for a free connection instead
+                _pools[key] = (the_pool, threading.BoundedSemaphore(max_connections))
+    
+    return _pools[key]
+
+@contextmanager
+def pooled_connection(connection_env:str):
+    """Borrows a connection from the pool, discarding it if it broke while in use"""
+    the_pool, semaphore = get_pool(connection_env)
+    with semaphore:
+        connection = the_pool.getconn()
         try:
-            connection = psycopg2.connect(connection_string)
-            cursor = connection.cursor()
+            yield connection
+        except Exception as error:
+            broken = connection.closed or is_transient_error(error)
+            if not connection.closed:
+                try:
+                    connection.rollback()
+                    if connection.prepared:
+                        # don't rely on PREPAREs made in a failed transaction - start the session afresh
+                        with connection.cursor() as cursor:
+                            cursor.execute("DEALLOCATE ALL")
+                        connection.commit()
+                        connection.prepared.clear()
+                except psycopg2.Error:
+                    broken = True
+            the_pool.putconn(connection, close=broken)
+            raise
+        else:
+            the_pool.putconn(connection)
+
+def run_with_retries(fn, connection_env:str, max_retries:int=5, verbose=False):
+    """Runs fn(connection) on a pooled connection, retrying transient errors with exponential backoff"""
 
-            if verbose:
-                logging.info(f"SQL: {sql}")
-            else:
-                pass
-            # execute the SQL - raise the error if already found
-            cursor.execute(sql, sql_params)
-
-            # commit the transaction to save changes to the database
-            connection.commit()
+    if connection_env is None:
+        raise ValueError("Need to specify connection_env to connect to DB")
 
-            if return_rows:
-                rows = cursor.fetchall()
-            logging.debug("SQL successfully fetched")
-            break  # If all operations were successful, break the loop
+    for attempt in range(max_retries):
+        try:
+            with pooled_connection(connection_env) as connection:
+                return fn(connection)
 
         except (psycopg2.errors.DuplicateObject, 
                 psycopg2.errors.DuplicateTable, 
                 psycopg2.errors.DuplicateFunction) as e:
+            # setup statements that have already run
             logging.debug(str(e))
             if verbose:
                 print(str(e))
-            continue
+            return None
+
+        except psycopg2.Error as error:
+            if not is_transient_error(error):
+                logging.error(f"PostgreSQL error that will not succeed on retry: {str(error)}")
+                raise
+            if attempt + 1 == max_retries:
+                raise Exception("Maximum number of retries exceeded") from error
+            delay = math.pow(2, attempt)
+            logging.warning(f"Transient PostgreSQL error, retrying in {delay}s... Attempt {attempt+1} out of {max_retries}: {str(error)}")
+            time.sleep(delay)  # Exponential backoff
 
-        except psycopg2.errors.InternalError as error:
-            logging.error(f"InternalError, retrying... Attempt {attempt+1} out of {max_retries}")
-            time.sleep(math.pow(2, attempt))  # Exponential backoff
-            continue  # Go to the next iteration of the loop to retry the operation
+def do_sql(sql, sql_params=None, return_rows=False, verbose=False, connection_env='DB_CONNECTION_STRING', max_retries=5):
 
-        except (Exception, psycopg2.Error) as error:
-            logging.error(f"Error while connecting to PostgreSQL: {str(error)}", exc_info=True)
-            continue
+    def run(connection):
+        with connection.cursor() as cursor:
+            if verbose:
+                logging.info(f"SQL: {sql}")
+            # execute the SQL - raise the error if already found
+            cursor.execute(sql, sql_params)
 
-        finally:
-            if connection:
-                cursor.close()
-                connection.close()
-                logging.debug("PostgreSQL connection is closed")
-    
-        # If we've exhausted all retries and still haven't succeeded, raise an error
-        if attempt + 1 == max_retries:
-            raise Exception("Maximum number of retries exceeded")
+            rows = cursor.fetchall() if return_rows else []
+
+        # commit the transaction to save changes to the database
+        connection.commit()
+        logging.debug("SQL successfully fetched")
+        return rows
+
+    rows = run_with_retries(run, connection_env=connection_env, max_retries=max_retries, verbose=verbose)
 
     if rows:
         return rows
     
     return None
 
+def do_prepared_sql(name:str, sql:str, arg_types:list, args:list, return_rows=False, verbose=False, 
+                    connection_env='DB_CONNECTION_STRING', max_retries=5):
+    """Executes sql as a server-side prepared statement, preparing it once per pooled connection.
+    sql uses $1, $2... for its arguments. Set DB_PREPARED_STATEMENTS=false when going through a
+    transaction-mode pooler such as pgbouncer, which can't keep prepared statements."""
+
+    if os.getenv('DB_PREPARED_STATEMENTS', 'true').lower() != 'true':
+        plain_sql = sql
+        for i in reversed(range(len(args))):
+            plain_sql = plain_sql.replace(f"${i+1}", f"%(arg{i})s")
+        return do_sql(plain_sql, sql_params={f"arg{i}": arg for i, arg in enumerate(args)}, 
+                      return_rows=return_rows, verbose=verbose, 
+                      connection_env=connection_env, max_retries=max_retries)
+
+    placeholders = ", ".join(["%s"] * len(args))
+
+    def run(connection):
+        with connection.cursor() as cursor:
+            if name not in connection.prepared:
+                if verbose:
+                    logging.info(f"PREPARE {name}: {sql}")
+                cursor.execute(f"PREPARE {name}({', '.join(arg_types)}) AS {sql}")
+                connection.prepared.add(name)
+
+            cursor.execute(f"EXECUTE {name}({placeholders})", args)
+            rows = cursor.fetchall() if return_rows else []
+
+        connection.commit()
+        return rows
 
-def execute_sql_from_file(filepath, params, return_rows=False, verbose=False, connection_env=None):
+    rows = run_with_retries(run, connection_env=connection_env, max_retries=max_retries, verbose=verbose)
+
+    if rows:
+        return rows
+    
+    return None
 
+@lru_cache(maxsize=None)
+def read_sql_file(filepath):
      # Get the directory of this Python script
     dir_path = os.path.dirname(os.path.realpath(__file__))
     # Build the full filepath by joining the directory with the filename
@@ -148,10 +324,12 @@ def execute_sql_from_file(filepath, params, return_rows=False, verbose=False, co
 
     # read the SQL file
     with open(filepath, 'r') as file:
-        sql = file.read()
+        return file.read()
+
+def execute_sql_from_file(filepath, params, return_rows=False, verbose=False, connection_env=None):
 
     # substitute placeholders in the SQL
-    sql = sql.format(**params)
+    sql = read_sql_file(filepath).format(**params)
     rows = do_sql(sql, return_rows=return_rows, verbose=verbose, connection_env=connection_env)
     
     if return_rows:
@@ -160,6 +338,17 @@ def execute_sql_from_file(filepath, params, return_rows=False, verbose=False, co
     
     return True
 
+def execute_prepared_from_file(filepath, name, params, arg_types, args, return_rows=False, verbose=False, connection_env=None):
+
+    sql = read_sql_file(filepath).format(**params)
+    rows = do_prepared_sql(name, sql, arg_types=arg_types, args=args, return_rows=return_rows, 
+                           verbose=verbose, connection_env=connection_env)
+
+    if return_rows:
+        return rows
+    
+    return True
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Setup a database",
@@ -0,0 +1,211 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import qna.database as database
+import qna.ingest_jobs as ingest_jobs
+
+logging.basicConfig(level=logging.INFO)
+
+# Content-addressed ledger of what each vector_name has already ingested, at three levels:
+#  'upload' - local files keyed by their md5, with the gs:// path they were uploaded to
+#  'object' - whole files keyed by their GCS md5, checked before downloading
+#  'chunk'  - chunks keyed by the sha1 of page_content, checked before embedding
+# Entries live in the {vector_name}_dedup_ledger table, with an in-process LRU in front of it.
+# If the database can't be reached the ledger only remembers what this process has seen.
+# An object is recorded once its chunks are published, but with the ingest job ledger on it only
+# counts as known once its job is complete, so a file whose chunks failed to store is ingested again.
+
+DEDUP_ENABLED = os.getenv("DEDUP_LEDGER", "true").lower() == "true"
+MEMORY_SIZE = int(os.getenv("DEDUP_MEMORY_SIZE", 100000))
+
+_memory = {}
+_lock = threading.Lock()
+_stats = {"object_hits": 0, "object_misses": 0, "chunk_hits": 0, "chunk_misses": 0}
+
+def sha1_text(text: str):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def _remembered(vector_name, kind):
+    key = (vector_name, kind)
+    if key not in _memory:
+        _memory[key] = OrderedDict()
+    return _memory[key]
+
+def _remember(vector_name, kind, hashes):
+    with _lock:
+        memory = _remembered(vector_name, kind)
+        for the_hash in hashes:
+            memory[the_hash] = True
+            memory.move_to_end(the_hash)
+        while len(memory) > MEMORY_SIZE:
+            memory.popitem(last=False)
+
+_LEDGER_SQL = "SELECT hash FROM {vector_name}_dedup_ledger WHERE kind = %(kind)s AND hash = ANY(%(hashes)s)"
+# entries without a job, e.g. recorded before the job ledger existed, still count
+_COMPLETED_OBJECTS_SQL = """SELECT ledger.hash FROM {vector_name}_dedup_ledger ledger
+    LEFT JOIN {vector_name}_ingest_jobs job ON job.source = ledger.source
+    WHERE ledger.kind = %(kind)s AND ledger.hash = ANY(%(hashes)s)
+        AND (job.source IS NULL OR job.status = 'complete')"""
+
+def _known(vector_name, kind, hashes, sql=_LEDGER_SQL):
+    with _lock:
+        memory = _remembered(vector_name, kind)
+        known = {the_hash for the_hash in hashes if the_hash in memory}
+
+    unknown = [the_hash for the_hash in hashes if the_hash not in known]
+    if not unknown:
+        return known
+
+    try:
+        database.setup_database(vector_name)
+        rows = database.do_sql(
+            sql.format(vector_name=vector_name),
+            sql_params={'kind': kind, 'hashes': unknown}, return_rows=True,
+            connection_env=database.lookup_connection_env(vector_name))
+    except Exception as err:
+        logging.warning(f"Could not read dedup ledger for {vector_name}, using in-process memory only: {str(err)}")
+        return known
+
+    if rows:
+        found = [row[0] for row in rows]
+        _remember(vector_name, kind, found)
+        known.update(found)
+
+    return known
+
+def _record(vector_name, kind, hashes, refs, sources, remember=True):
+    if remember:
+        _remember(vector_name, kind, hashes)
+    try:
+        database.do_sql(
+            f"""INSERT INTO {vector_name}_dedup_ledger (kind, hash, ref, source)
+                SELECT %(kind)s, unnest(%(hashes)s::text[]), unnest(%(refs)s::text[]), unnest(%(sources)s::text[])
+                ON CONFLICT (kind, hash) DO NOTHING""",
+            sql_params={'kind': kind, 'hashes': list(hashes), 'refs': list(refs), 'sources': list(sources)},
+            connection_env=database.lookup_connection_env(vector_name))
+    except Exception as err:
+        logging.warning(f"Could not write dedup ledger for {vector_name}: {str(err)}")
+
+def is_known_object(vector_name: str, md5: str):
+    """True if a file with this GCS md5 has already been ingested into vector_name"""
+    if not DEDUP_ENABLED or not md5:
+        return False
+    sql = _COMPLETED_OBJECTS_SQL if ingest_jobs.INGEST_JOBS_ENABLED else _LEDGER_SQL
+    known = md5 in _known(vector_name, 'object', [md5], sql=sql)
+    _stats["object_hits" if known else "object_misses"] += 1
+    if known:
+        logging.info(f"Dedup ledger: object with md5 {md5} already ingested into {vector_name}")
+    return known
+
+def record_object(vector_name: str, md5: str, gs_file: str, source: str=None):
+    if not DEDUP_ENABLED or not md5:
+        return
+    # remembered in-process only once a lookup finds its job complete
+    _record(vector_name, 'object', [md5], [gs_file], [source or gs_file],
+            remember=not ingest_jobs.INGEST_JOBS_ENABLED)
+
+def find_upload(vector_name: str, md5: str):
+    """The gs:// path a file with this md5 was uploaded to for vector_name, or None"""
+    if not DEDUP_ENABLED or not md5:
+        return None
+    with _lock:
+        gs_file = _remembered(vector_name, 'upload').get(md5)
+    if gs_file is not None:
+        return gs_file
+
+    try:
+        database.setup_database(vector_name)
+        rows = database.do_sql(
+            f"SELECT ref FROM {vector_name}_dedup_ledger WHERE kind = 'upload' AND hash = %(hash)s",
+            sql_params={'hash': md5}, return_rows=True,
+            connection_env=database.lookup_connection_env(vector_name))
+    except Exception as err:
+        logging.warning(f"Could not read dedup ledger for {vector_name}: {str(err)}")
+        return None
+
+    return rows[0][0] if rows else None
+
+def record_upload(vector_name: str, md5: str, gs_file: str):
+    if not DEDUP_ENABLED or not md5:
+        return
+    with _lock:
+        _remembered(vector_name, 'upload')[md5] = gs_file
+    try:
+        # a file uploaded again because its earlier object is gone points at the new object
+        database.do_sql(
+            f"""INSERT INTO {vector_name}_dedup_ledger (kind, hash, ref, source)
+                VALUES ('upload', %(hash)s, %(ref)s, %(ref)s)
+                ON CONFLICT (kind, hash) DO UPDATE SET ref = EXCLUDED.ref, source = EXCLUDED.source""",
+            sql_params={'hash': md5, 'ref': gs_file},
+            connection_env=database.lookup_connection_env(vector_name))
+    except Exception as err:
+        logging.warning(f"Could not write dedup ledger for {vector_name}: {str(err)}")
+
+def filter_new_chunks(vector_name: str, docs: list):
+    """Returns the docs whose page_content is not already stored in vector_name and their sha1s"""
+    hashes = [sha1_text(doc.page_content) for doc in docs]
+    if not DEDUP_ENABLED:
+        return docs, hashes
+
+    known = _known(vector_name, 'chunk', list(set(hashes)))
+
+    new_docs, new_hashes = [], []
+    for doc, the_hash in zip(docs, hashes):
+        # also skip a repeat within the same batch
+        if the_hash in known:
+            continue
+        known.add(the_hash)
+        new_docs.append(doc)
+        new_hashes.append(the_hash)
+
+    _stats["chunk_hits"] += len(docs) - len(new_docs)
+    _stats["chunk_misses"] += len(new_docs)
+    if len(new_docs) < len(docs):
+        logging.info(f"Dedup ledger: skipping {len(docs) - len(new_docs)} of {len(docs)} chunks already in {vector_name}")
+
+    return new_docs, new_hashes
+
+def record_chunks(vector_name: str, docs: list, hashes: list, ids: list=None):
+    if not DEDUP_ENABLED or not docs:
+        return
+    ids = ids or [None] * len(docs)
+    sources = [doc.metadata.get("source") for doc in docs]
+    _record(vector_name, 'chunk', hashes, [str(the_id) if the_id is not None else None for the_id in ids], sources)
+
+def forget_source(source: str, vector_name: str):
+    with _lock:
+        _memory.pop((vector_name, 'object'), None)
+        _memory.pop((vector_name, 'chunk'), None)
+    if not DEDUP_ENABLED:
+        return
+    try:
+        database.do_sql(f"DELETE FROM {vector_name}_dedup_ledger WHERE source = %(source)s",
+                        sql_params={'source': source},
+                        connection_env=database.lookup_connection_env(vector_name))
+    except Exception as err:
+        logging.warning(f"Could not clear dedup ledger for {source} in {vector_name}: {str(err)}")
+
+def forget_refs(refs: list, vector_name: str):
+    """Removes chunk entries for vectorstore rows that have been deleted"""
+    if not refs:
+        return
+    with _lock:
+        _memory.pop((vector_name, 'chunk'), None)
+    if not DEDUP_ENABLED:
+        return
+    try:
+        database.do_sql(f"DELETE FROM {vector_name}_dedup_ledger WHERE kind = 'chunk' AND ref = ANY(%(refs)s)",
+                        sql_params={'refs': [str(ref) for ref in refs]},
+                        connection_env=database.lookup_connection_env(vector_name))
+    except Exception as err:
+        logging.warning(f"Could not clear dedup ledger for {len(refs)} rows in {vector_name}: {str(err)}")
+
+def dedup_stats():
+    stats = dict(_stats)
+    for kind in ['object', 'chunk']:
+        total = stats[f"{kind}_hits"] + stats[f"{kind}_misses"]
+        stats[f"{kind}_hit_rate"] = round(stats[f"{kind}_hits"] / total, 3) if total else None
+    return stats
@@ -0,0 +1,187 @@
+import os
+import json
+import atexit
+import logging
+import threading
+
+import qna.database as database
+
+logging.basicConfig(level=logging.INFO)
+
+# Job ledger of each ingested source in {vector_name}_ingest_jobs, keyed by the chunks' metadata source.
+# The chunker starts a job and counts what it downloads, parses, chunks and publishes,
+# the embedder counts what it embeds and stores, and a job is complete once every published
+# chunk is stored, skipped as a duplicate or failed. A PDF fanned out to page files is complete
+# once all its page jobs are. Ledger errors are logged and never stop an ingest.
+
+INGEST_JOBS_ENABLED = os.getenv("INGEST_JOBS", "true").lower() == "true"
+# counts passed to queue_stages() are written at most this many seconds later, one update per source
+FLUSH_SECONDS = float(os.getenv("INGEST_JOBS_FLUSH_SECONDS", 2.0))
+
+_queued = {}
+_queued_lock = threading.Lock()
+_flush_timer = None
+
+def _sql(vector_name, sql, sql_params, return_rows=False):
+    if not INGEST_JOBS_ENABLED or not vector_name:
+        return None
+    try:
+        database.setup_database(vector_name)
+        return database.do_sql(sql.format(vector_name=vector_name), sql_params=sql_params, return_rows=return_rows,
+                               connection_env=database.lookup_connection_env(vector_name))
+    except Exception as err:
+        logging.warning(f"Could not update ingest job ledger for {vector_name}: {str(err)}")
+        return None
+
+def start_job(vector_name: str, source: str, file_type: str=None, parent: str=None):
+    """Starts (or restarts, for a redelivery) the job for source"""
+    if not source:
+        return
+    _sql(vector_name,
+         """INSERT INTO {vector_name}_ingest_jobs (source, parent, file_type) VALUES (%(source)s, %(parent)s, %(file_type)s)
+            ON CONFLICT (source) DO UPDATE SET
+                parent = COALESCE(EXCLUDED.parent, {vector_name}_ingest_jobs.parent),
+                file_type = EXCLUDED.file_type, status = 'running', counts = '{{}}', timings = '{{}}',
+                parts = NULL, done_parts = 0, error = NULL,
+                started_at = NOW(), updated_at = NOW(), finished_at = NULL""",
+         {'source': source, 'parent': parent, 'file_type': file_type})
+
+def _total(stage):
+    # the stage's count once this update's counts are added
+    return f"(COALESCE((counts->>'{stage}')::bigint, 0) + COALESCE((%(counts)s::jsonb->>'{stage}')::bigint, 0))"
+
+def record_stages(vector_name: str, source: str, counts: dict, status: str=None):
+    """Adds counts per stage to the job for source, marking when each stage was last updated.
+    A published job is completed in the same update once every published chunk is stored, skipped or failed -
+    the chunker and the embedder both update it, as chunks can be stored before publishing finishes."""
+    if not source or not counts:
+        return
+    timings_sql = " || ".join(
+        [f"jsonb_build_object(%(stage{i})s, round(EXTRACT(EPOCH FROM NOW() - started_at)::numeric, 2))"
+         for i in range(len(counts))])
+    complete_sql = (f"COALESCE(%(status)s, status) = 'published' AND "
+                    f"{_total('stored')} + {_total('skipped')} + {_total('failed')} >= {_total('published')}")
+    params = {'source': source, 'counts': json.dumps(counts), 'status': status}
+    params.update({f"stage{i}": stage for i, stage in enumerate(counts)})
+    rows = _sql(vector_name,
+                f"""UPDATE {{vector_name}}_ingest_jobs SET
+                       counts = counts || (SELECT jsonb_object_agg(key, COALESCE((counts->>key)::bigint, 0) + value::bigint)
+                                           FROM jsonb_each_text(%(counts)s::jsonb)),
+                       timings = timings || {timings_sql} || CASE WHEN {complete_sql}
+                           THEN jsonb_build_object('complete', round(EXTRACT(EPOCH FROM NOW() - started_at)::numeric, 2))
+                           ELSE '{{{{}}}}'::jsonb END,
+                       status = CASE WHEN {complete_sql} THEN 'complete' ELSE COALESCE(%(status)s, status) END,
+                       finished_at = CASE WHEN {complete_sql} THEN NOW() ELSE finished_at END,
+                       updated_at = NOW()
+                    WHERE source = %(source)s
+                    RETURNING status, parent""",
+                params, return_rows=True)
+    if rows and rows[0][0] == 'complete' and rows[0][1]:
+        _count_parts(vector_name, rows[0][1])
+
+def queue_stages(vector_name: str, source: str, counts: dict):
+    """Like record_stages, but adds counts to those queued for source, so a stream of single chunks
+    makes one ledger update per source every FLUSH_SECONDS rather than one per chunk"""
+    global _flush_timer
+    if not INGEST_JOBS_ENABLED or not vector_name or not source or not counts:
+        return
+    with _queued_lock:
+        queued = _queued.setdefault((vector_name, source), {})
+        for stage, count in counts.items():
+            queued[stage] = queued.get(stage, 0) + count
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(FLUSH_SECONDS, flush_stages)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+def flush_stages():
+    """Writes the counts queued by queue_stages"""
+    global _queued, _flush_timer
+    with _queued_lock:
+        queued, _queued = _queued, {}
+        _flush_timer = None
+    for (vector_name, source), counts in queued.items():
+        record_stages(vector_name, source, counts)
+
+# so counts queued when the server shuts down aren't lost
+atexit.register(flush_stages)
+
+def record_stage(vector_name: str, source: str, stage: str, count: int=1, status: str=None):
+    record_stages(vector_name, source, {stage: count}, status=status)
+
+def fail_job(vector_name: str, source: str, error: str):
+    if not source:
+        return
+    _sql(vector_name,
+         """UPDATE {vector_name}_ingest_jobs SET status = 'failed', error = %(error)s, updated_at = NOW(), finished_at = NOW()
+            WHERE source = %(source)s""",
+         {'source': source, 'error': str(error)[:1000]})
+
+def expect_parts(vector_name: str, source: str, parts: list):
+    """Marks source as fanned out into the parts sources, complete once all of them are.
+    Parts that were already ingested, e.g. pages skipped as duplicate uploads, count as done."""
+    _sql(vector_name,
+         """UPDATE {vector_name}_ingest_jobs SET status = 'fanned_out', parts = %(parts)s, updated_at = NOW()
+            WHERE source = %(source)s""",
+         {'source': source, 'parts': list(parts)})
+    _count_parts(vector_name, source)
+
+def _count_parts(vector_name, source):
+    # recounted rather than incremented, so parts finishing while the parent fans out aren't counted twice
+    rows = _sql(vector_name,
+                """UPDATE {vector_name}_ingest_jobs AS job SET
+                       done_parts = done.parts,
+                       status = CASE WHEN done.parts >= cardinality(job.parts) THEN 'complete' ELSE job.status END,
+                       finished_at = CASE WHEN done.parts >= cardinality(job.parts) THEN NOW() END,
+                       timings = CASE WHEN done.parts >= cardinality(job.parts)
+                           THEN job.timings || jsonb_build_object('complete', round(EXTRACT(EPOCH FROM NOW() - job.started_at)::numeric, 2))
+                           ELSE job.timings END,
+                       updated_at = NOW()
+                   FROM (SELECT count(*) AS parts FROM {vector_name}_ingest_jobs part, {vector_name}_ingest_jobs fanned
+                         WHERE fanned.source = %(source)s AND part.source = ANY(fanned.parts) AND part.status = 'complete') AS done
+                   WHERE job.source = %(source)s AND job.status = 'fanned_out'
+                   RETURNING job.status, job.parent""",
+                {'source': source}, return_rows=True)
+    if rows and rows[0][0] == 'complete' and rows[0][1]:
+        _count_parts(vector_name, rows[0][1])
+
+def _job_dict(row):
+    source, parent, file_type, status, counts, timings, parts, done_parts, error, started_at, finished_at = row
+    stored_seconds = timings.get("stored")
+    return {
+        "source": source, "parent": parent, "file_type": file_type, "status": status,
+        "counts": counts, "timings": timings,
+        "chunks_per_second": round(counts.get("stored", 0) / stored_seconds, 2) if stored_seconds else None,
+        "parts": len(parts) if parts is not None else None, "done_parts": done_parts, "error": error,
+        "started_at": started_at.isoformat() if started_at else None,
+        "finished_at": finished_at.isoformat() if finished_at else None,
+    }
+
+def get_jobs(vector_name: str, source: str=None, limit: int=20):
+    """The latest jobs, or the job for source and its parts, newest first"""
+    columns = "source, parent, file_type, status, counts, timings, parts, done_parts, error, started_at, finished_at"
+    if source:
+        rows = _sql(vector_name,
+                    f"""SELECT {columns} FROM {{vector_name}}_ingest_jobs WHERE source = %(source)s OR parent = %(source)s
+                        ORDER BY started_at DESC LIMIT %(limit)s""",
+                    {'source': source, 'limit': limit}, return_rows=True)
+    else:
+        rows = _sql(vector_name,
+                    f"""SELECT {columns} FROM {{vector_name}}_ingest_jobs WHERE parent IS NULL
+                        ORDER BY started_at DESC LIMIT %(limit)s""",
+                    {'limit': limit}, return_rows=True)
+    return [_job_dict(row) for row in rows or []]
+
+def job_summary(vector_name: str, hours: int=24):
+    """Count and mean seconds to complete per file type and status, over the last hours"""
+    rows = _sql(vector_name,
+                """SELECT COALESCE(file_type, ''), status, count(*),
+                          round(avg(EXTRACT(EPOCH FROM finished_at - started_at))::numeric, 2),
+                          COALESCE(sum((counts->>'published')::bigint), 0)
+                   FROM {vector_name}_ingest_jobs
+                   WHERE started_at > NOW() - make_interval(hours => %(hours)s)
+                   GROUP BY 1, 2 ORDER BY 1, 2""",
+                {'hours': hours}, return_rows=True)
+    return [{"file_type": file_type, "status": status, "jobs": jobs,
+             "mean_seconds": float(mean_seconds) if mean_seconds is not None else None, "chunks": chunks}
+            for file_type, status, jobs, mean_seconds, chunks in rows or []]
@@ -140,14 +140,33 @@ def pick_vectorstore(vector_name, embeddings):
 
     return vectorstore
 
-def pick_retriever(vector_name, embeddings):
-    vectorstore = pick_vectorstore(vector_name, embeddings=embeddings)
+def pick_retriever(vector_name, embeddings, vectorstore=None, llm=None):
+    base_retriever, compressor = pick_retriever_stages(vector_name, embeddings, vectorstore=vectorstore, llm=llm)
+    return combine_retriever_stages(base_retriever, compressor)
+
+def combine_retriever_stages(base_retriever, compressor=None):
+    if compressor is None:
+        return base_retriever
+
+    from langchain.retrievers import ContextualCompressionRetriever
+    retriever = ContextualCompressionRetriever(
+        base_compressor=compressor, base_retriever=base_retriever, 
+        k=2)
+
+    return retriever
+
+def pick_retriever_stages(vector_name, embeddings, vectorstore=None, llm=None):
+    """Returns (base_retriever, compressor) - compressor is None when there is only one retriever,
+    otherwise it filters redundant documents from the merged retrievers"""
+    if vectorstore is None:
+        vectorstore = pick_vectorstore(vector_name, embeddings=embeddings)
 
     vs_str = load_config_key("vectorstore", vector_name)
     
     if vs_str == 'supabase' and load_config_key("self_query", vector_name):
         from qna.self_query import get_self_query_retriever
-        llm, _, _ = pick_llm(vector_name)
+        if llm is None:
+            llm, _, _ = pick_llm(vector_name)
 
         sq_retriever = get_self_query_retriever(llm, vectorstore)
     else:
@@ -161,7 +180,7 @@ def pick_retriever(vector_name, embeddings):
     # early return if only one retriever is available
     if (not rt_list or len(rt_list) == 0) and sq_retriever is None:
         logging.info(f"Only one retriever available - vector store {vs_str}")
-        return vs_retriever
+        return vs_retriever, None
     
     if sq_retriever is not None:
         all_retrievers = [vs_retriever, sq_retriever]
@@ -170,7 +189,7 @@ def pick_retriever(vector_name, embeddings):
 
     from langchain.retrievers import MergerRetriever
     from langchain.retrievers import GoogleCloudEnterpriseSearchRetriever
-    _, filter_embeddings, _ = pick_llm(vector_name)
+    filter_embeddings = embeddings
 
     if rt_list.get('GoogleCloudEnterpriseSearchRetriever', None) is not None:
         from utils.gcp import get_gcp_project
@@ -207,15 +226,11 @@ def pick_retriever(vector_name, embeddings):
         EmbeddingsClusteringFilter,
     )
     from langchain.retrievers.document_compressors import DocumentCompressorPipeline
-    from langchain.retrievers import ContextualCompressionRetriever
 
     filter = EmbeddingsRedundantFilter(embeddings=filter_embeddings)
     pipeline = DocumentCompressorPipeline(transformers=[filter])
-    retriever = ContextualCompressionRetriever(
-        base_compressor=pipeline, base_retriever=lotr, 
-        k=2)
 
-    return retriever
+    return lotr, pipeline
 
 
 def get_chat_history(inputs, vector_name, last_chars=1000, summary_chars=1500) -> str:
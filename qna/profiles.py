@@ -0,0 +1,129 @@
+import logging
+import threading
+
+from utils.config import load_config, config_version
+from qna.llm import pick_llm, pick_vectorstore, pick_retriever_stages, combine_retriever_stages, pick_agent, pick_chat_buddy
+
+logging.basicConfig(level=logging.INFO)
+
+class BrainProfile:
+    """
+    The resolved llm clients, vectorstore and retriever for one vector_name at one config version.
+    Each part is built the first time it is asked for, then reused by every request.
+    """
+    def __init__(self, vector_name: str, version: int):
+        self.vector_name = vector_name
+        self.version = version
+        self._parts = {}
+        self._lock = threading.RLock()
+
+    def _get(self, name, build):
+        if name not in self._parts:
+            with self._lock:
+                if name not in self._parts:
+                    logging.info(f"Building {name} for brain profile {self.vector_name} v{self.version}")
+                    self._parts[name] = build()
+        return self._parts[name]
+
+    @property
+    def models(self):
+        """Returns (llm, embeddings, llm_chat) as pick_llm does"""
+        return self._get("models", lambda: pick_llm(self.vector_name))
+
+    @property
+    def llm(self):
+        return self.models[0]
+
+    @property
+    def embeddings(self):
+        return self.models[1]
+
+    @property
+    def llm_chat(self):
+        return self.models[2]
+
+    @property
+    def vectorstore(self):
+        return self._get("vectorstore",
+                         lambda: pick_vectorstore(self.vector_name, embeddings=self.embeddings))
+
+    @property
+    def retriever_stages(self):
+        """Returns (base_retriever, compressor) as pick_retriever_stages does"""
+        return self._get("retriever_stages",
+                         lambda: pick_retriever_stages(self.vector_name,
+                                                       embeddings=self.embeddings,
+                                                       vectorstore=self.vectorstore,
+                                                       llm=self.llm))
+
+    @property
+    def retriever(self):
+        return self._get("retriever", lambda: combine_retriever_stages(*self.retriever_stages))
+
+    @property
+    def calendar_retriever(self):
+        from qna.self_query import get_self_query_retriever
+        return self._get("calendar_retriever",
+                         lambda: get_self_query_retriever(self.llm, vectorstore=self.vectorstore))
+
+    @property
+    def is_agent(self):
+        return self._get("is_agent", lambda: pick_agent(self.vector_name))
+
+    @property
+    def chat_buddy(self):
+        """Returns (chat_buddy, buddy_description) as pick_chat_buddy does"""
+        return self._get("chat_buddy", lambda: pick_chat_buddy(self.vector_name))
+
+    def warm(self):
+        self.retriever
+        self.chat_buddy
+        if self.is_agent:
+            self.calendar_retriever
+        return self
+
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+def get_profile(vector_name: str) -> BrainProfile:
+    """Returns the profile for vector_name, replacing it if config.json has changed since it was built"""
+    version = config_version()
+    profile = _profiles.get(vector_name)
+    if profile is not None and profile.version == version:
+        return profile
+
+    with _profiles_lock:
+        profile = _profiles.get(vector_name)
+        if profile is None or profile.version != version:
+            if profile is not None:
+                logging.info(f"Config changed from v{profile.version} to v{version} - rebuilding brain profile {vector_name}")
+            profile = BrainProfile(vector_name, version)
+            _profiles[vector_name] = profile
+
+    return profile
+
+def clear_profiles():
+    with _profiles_lock:
+        _profiles.clear()
+
+def configured_vector_names():
+    config = load_config("config.json")
+    return [key for key, value in config.items() if isinstance(value, dict) and value.get("llm") is not None]
+
+def warm_profiles(vector_names=None):
+    """Builds profiles ahead of requests. Returns a dict of vector_name: 'ok' or the error"""
+    if vector_names is None:
+        vector_names = configured_vector_names()
+
+    results = {}
+    for vector_name in vector_names:
+        try:
+            get_profile(vector_name).warm()
+            results[vector_name] = "ok"
+        except Exception as err:
+            logging.error(f"Could not warm brain profile {vector_name}: {str(err)}")
+            results[vector_name] = str(err)
+
+    logging.info(f"Warmed brain profiles: {results}")
+    return results
@@ -1,33 +1,70 @@
 from google.cloud import pubsub_v1
 from google.api_core.exceptions import NotFound
 from google.api_core.exceptions import AlreadyExists
-from google.auth import default
+import utils.transport as transport
 
 import json
 import os
 import logging
+import threading
+import time
 
 logging.basicConfig(level=logging.INFO)
 
+# Process-wide clients and existence checks, so repeated PubSubManagers for a topic cost nothing
+_project_id = None
+_publishers = {}
+_clients_lock = threading.Lock()
+
+# topic/subscription name: expiry time of the last confirmation it exists
+_known_to_exist = {}
+KNOWN_TO_EXIST_TTL = int(os.getenv('PUBSUB_EXISTS_TTL', 600))
+
+def get_default_project_id():
+    global _project_id
+    if _project_id is None:
+        _project_id = transport.get_default_project_id()
+    return _project_id
+
+def get_publisher(batch_settings=None, flow_control=None):
+    """Returns a shared PublisherClient for each distinct batch_settings/flow_control combination"""
+    key = (batch_settings, flow_control)
+    if key not in _publishers:
+        with _clients_lock:
+            if key not in _publishers:
+                _publishers[key] = transport.new_publisher_client(batch_settings, flow_control)
+    return _publishers[key]
+
+def get_subscriber():
+    return transport.get_subscriber_client()
+
+def is_known_to_exist(name:str):
+    expiry = _known_to_exist.get(name)
+    return expiry is not None and expiry > time.time()
+
+def remember_exists(name:str):
+    _known_to_exist[name] = time.time() + KNOWN_TO_EXIST_TTL
+
 class PubSubManager:
     """
     Creates a new PubSub topic is necessary and sends pubsub messages to it
     """
-    def __init__(self, memory_namespace: str, pubsub_topic: str=None, project_id: str=None, verbose:bool=False):
+    def __init__(self, memory_namespace: str, pubsub_topic: str=None, project_id: str=None, verbose:bool=False,
+                 batch_settings=None, flow_control=None):
+        """batch_settings and flow_control are pubsub_v1.types.BatchSettings and PublishFlowControl
+        for publishers that send many messages at once"""
         self.project_id = project_id
         self.pubsub_topic = pubsub_topic
         self.publisher = None
         self.verbose = verbose
         self.memory_namespace = memory_namespace
 
-        # Get the project ID from the default Google Cloud settings or the environment variable
-        _, project_id = default()
-        self.project_id = project_id or os.environ.get('GOOGLE_CLOUD_PROJECT')
+        self.project_id = get_default_project_id()
 
         if self.project_id:
             logging.debug(f"Project ID: {self.project_id}")
             # Create the Pub/Sub topic based on the project ID and memory_namespace
-            self.publisher = pubsub_v1.PublisherClient()
+            self.publisher = get_publisher(batch_settings, flow_control)
             self.pubsub_topic = f"projects/{self.project_id}/topics/{pubsub_topic}" or \
                                 f"projects/{self.project_id}/topics/chat-messages-{memory_namespace}"
             self._create_pubsub_topic_if_not_exists()
@@ -38,12 +75,16 @@ class PubSubManager:
 
     def _create_pubsub_topic_if_not_exists(self):
         """Creates the Pub/Sub topic if it doesn't already exist."""
+        if is_known_to_exist(self.pubsub_topic):
+            return
         try:
             # Check if the topic exists
             self.publisher.get_topic(request={"topic": self.pubsub_topic})
+            remember_exists(self.pubsub_topic)
         except NotFound:
             # If the topic does not exist, create it
             self.publisher.create_topic(request={"name": self.pubsub_topic})
+            remember_exists(self.pubsub_topic)
             logging.info(f"Created Pub/Sub topic: {self.pubsub_topic}")
             if self.verbose:
                 print(f"Created Pub/Sub topic: {self.pubsub_topic}")
@@ -51,8 +92,10 @@ class PubSubManager:
     def subscription_exists(self, subscription_name:str):
 
         full_subscription_name = f"projects/{self.project_id}/subscriptions/{subscription_name}"
-        # Create a subscriber client
-        subscriber = pubsub_v1.SubscriberClient()
+        if is_known_to_exist(full_subscription_name):
+            return True
+
+        subscriber = get_subscriber()
 
         logging.debug(f"Checking subscription exists: {full_subscription_name}")
         
@@ -60,10 +103,12 @@ class PubSubManager:
         try:
             subscriber.get_subscription(full_subscription_name)
             logging.debug(f"Subscription {full_subscription_name} already exists.")
+            remember_exists(full_subscription_name)
             return True
         except NotFound:
             return False
         except AlreadyExists:
+            remember_exists(full_subscription_name)
             return True
         except Exception as e:
             logging.debug(f"Failed to get subscription: {e}")
@@ -92,8 +137,7 @@ class PubSubManager:
                         logging.info("push_endpoint must start with / e.g. /pubsub_to_sink")
                         return
 
-            # Create a subscriber client
-            subscriber = pubsub_v1.SubscriberClient()
+            subscriber = get_subscriber()
             
             # Create a push configuration
             push_config = pubsub_v1.types.PushConfig()
@@ -102,14 +146,15 @@ class PubSubManager:
             # Check if the subscription already exists
             exists = self.subscription_exists(subscription_name)
 
+            full_subscription_name = f"projects/{self.project_id}/subscriptions/{subscription_name}"
             if not exists:
-                full_subscription_name = f"projects/{self.project_id}/subscriptions/{subscription_name}"
                 logging.debug(f"Creating subscription {full_subscription_name}")
                 try:
                     subscriber.create_subscription(name=full_subscription_name, 
                                                    topic=self.pubsub_topic, 
                                                    ack_deadline_seconds=600,
                                                    push_config=push_config)
+                    remember_exists(full_subscription_name)
                     logging.info(f"Created push subscription: {full_subscription_name}")
                     if self.verbose:
                         print(f"Created push subscription: {full_subscription_name}")
@@ -128,7 +173,7 @@ class PubSubManager:
             logging.error(f"Failed to publish message: {e}")
 
     def publish_message(self, message:str, verbose=False):
-        """Publishes the given data to Google Pub/Sub."""
+        """Publishes the given data to Google Pub/Sub. Returns the publish future, or None if not published"""
 
         if verbose or self.verbose:
             verbose = True
@@ -141,4 +186,7 @@ class PubSubManager:
             attr = "namespace:" + str(self.memory_namespace)
             future = self.publisher.publish(self.pubsub_topic, message_bytes, attrs=attr)
             future.add_done_callback(self._callback)
+            return future
+        
+        return None
 
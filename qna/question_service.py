@@ -1,94 +1,105 @@
+import os
 import logging
 import traceback
 import time
+import random
 
-from qna.llm import pick_llm
-from qna.llm import pick_retriever
 from qna.llm import pick_prompt
-from qna.llm import pick_agent
-
-from httpcore import ReadTimeout
-from httpx import ReadTimeout
-from openai.error import InvalidRequestError
+from qna.profiles import get_profile
+import qna.rate_limit as rate_limit
 
+from langchain.chains import LLMChain
+from langchain.chains.question_answering import load_qa_chain
 #https://python.langchain.com/en/latest/modules/chains/index_examples/chat_vector_db.html
-from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
 
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
-def qna(question: str, 
-        vector_name: str, 
-        chat_history=[], 
-        max_retries=1, 
-        initial_delay=5, 
+
+# seconds a question may take, including retries of its stages
+QNA_DEADLINE = float(os.getenv("QNA_DEADLINE", 120))
+
+def run_stage(name: str, fn, deadline: float, max_retries: int, initial_delay: float):
+    """Runs one stage of answering a question, retrying only it with jittered backoff until the deadline"""
+    for attempt in range(max_retries + 1):
+        start = time.time()
+        try:
+            result = fn()
+            logging.info(f"qna stage {name} took {round(time.time() - start, 2)} seconds")
+            return result
+        except Exception as err:
+            delay = min(initial_delay * 2 ** attempt, 30) * (0.5 + random.random())
+            if attempt == max_retries or time.time() + delay > deadline:
+                logging.error(f"qna stage {name} failed after {attempt + 1} attempt(s): {traceback.format_exc()}")
+                raise
+            logging.warning(f"qna stage {name} failed, retrying in {round(delay, 1)} seconds: {str(err)}")
+            time.sleep(delay)
+
+def qna(question: str,
+        vector_name: str,
+        chat_history=[],
+        max_retries=1,
+        initial_delay=5,
         stream_llm=None,
-        message_author=None):
+        message_author=None,
+        deadline=None):
 
     logging.debug("Calling qna")
 
-    llm, embeddings, llm_chat = pick_llm(vector_name)
-    retriever = pick_retriever(vector_name, embeddings=embeddings)
+    profile = get_profile(vector_name)
+    llm, llm_chat = profile.llm, profile.llm_chat
+    retriever = profile.retriever
 
     # override llm to one that supports streaming
     if stream_llm:
         llm_chat=stream_llm
 
-    is_agent = pick_agent(vector_name)
-    if is_agent:
+    if profile.is_agent:
         from qna.agent import activate_agent
-        from qna.llm import pick_chat_buddy
-        from qna.self_query import get_self_query_retriever
-        from qna.llm import pick_vectorstore
-        calendar = get_self_query_retriever(llm, vectorstore=pick_vectorstore(vector_name, embeddings=embeddings))
-        result = activate_agent(question, llm_chat, chat_history, 
-                                retriever=retriever, calendar_retriever=calendar)
+        result = activate_agent(question, llm_chat, chat_history,
+                                retriever=retriever, calendar_retriever=profile.calendar_retriever,
+                                vector_name=vector_name)
         if result is not None:
             logging.info(f"agent result: {result}")
-            chat_buddy, buddy_description = pick_chat_buddy(vector_name)
+            chat_buddy, buddy_description = profile.chat_buddy
             if chat_buddy == message_author:
                 result['answer'] = f"{chat_buddy} {result['answer']}"
             else:
                 logging.info(f"No chat buddy found for {message_author} from {vector_name}")
 
             return result
-        
+
         return {'answer':"Agent couldn't help", 'source_documents': []}
 
     prompt = pick_prompt(vector_name, chat_history)
+    base_retriever, compressor = profile.retriever_stages
+    provider = rate_limit.provider_for(vector_name)
+    deadline = time.time() + (deadline or QNA_DEADLINE)
 
-    qa = ConversationalRetrievalChain.from_llm(llm_chat,
-                                               retriever=retriever, 
-                                               chain_type="stuff",
-                                               return_source_documents=True,
-                                               verbose=True,
-                                               output_key='answer',
-                                               combine_docs_chain_kwargs={'prompt': prompt},
-                                               condense_question_llm=llm)
-    
-    for retry in range(max_retries):
-        try:
-            return qa({"question": question, "chat_history": chat_history})
-        except ReadTimeout as err:
-            delay = initial_delay * (retry + 1)
-            logging.warning(f"Read timeout while asking: {question} - trying again after {delay} seconds. Error: {str(err)}")
-            time.sleep(delay)
-            try:
-                result = qa({"question": question, "chat_history": chat_history})
-                result["answer"] = result["answer"] + " (Sorry for delay, brain was a bit slow - should be quicker next time)"
-                return result
-            except ReadTimeout:
-                if retry == max_retries - 1:
-                    raise
-        except Exception as err:
-            delay = initial_delay * (retry + 1)
-            logging.error(f"General error: {traceback.format_exc()}")
-            time.sleep(delay)
-            try:
-                result = qa({"question": question, "chat_history": chat_history})
-                result["answer"] = result["answer"] + " (Sorry for delay, had to warm up the brain - should be quicker next time)"
-                return result
-            except Exception:
-                if retry == max_retries - 1:
-                    raise
-
-    raise Exception(f"Max retries exceeded for question: {question}")
+    def stage(name, fn):
+        return run_stage(name, fn, deadline=deadline, max_retries=max_retries, initial_delay=initial_delay)
+
+    # the same stages as ConversationalRetrievalChain, so a failure only repeats the stage that failed
+    standalone_question = question
+    if chat_history:
+        condense_chain = LLMChain(llm=llm, prompt=CONDENSE_QUESTION_PROMPT, verbose=True)
+        chat_history_str = _get_chat_history(chat_history)
+        standalone_question = stage("condense", lambda: rate_limit.call(
+            provider, condense_chain.run, question=question, chat_history=chat_history_str,
+            tokens=rate_limit.estimate_tokens(question, chat_history_str), retries=0))
+
+    docs = stage("retrieve", lambda: base_retriever.get_relevant_documents(standalone_question))
+
+    if compressor is not None:
+        docs = stage("compress", lambda: compressor.compress_documents(docs, standalone_question))
+
+    qa_chain = load_qa_chain(llm_chat, chain_type="stuff", prompt=prompt, verbose=True)
+    answer = stage("generate", lambda: rate_limit.call(
+        provider, qa_chain.run, input_documents=docs, question=standalone_question,
+        tokens=rate_limit.estimate_tokens(standalone_question, *[doc.page_content for doc in docs]), retries=0))
+
+    return {"question": question,
+            "chat_history": chat_history,
+            "answer": answer,
+            "source_documents": docs}
@@ -0,0 +1,249 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO)
+
+# Per-provider limits on LLM and embedding calls, shared by every thread of a process:
+#  requests and tokens per minute as token buckets, set with RATE_LIMIT_{NAME}_RPM / _TPM
+#  concurrent calls adapted AIMD style, growing by one per window of successes and halving on a 429,
+#  up to RATE_LIMIT_{NAME}_CONCURRENCY
+# NAME is the provider, e.g. OPENAI or VERTEX, or OPENAI_EMBEDDINGS for its embeddings quota.
+# Limits that aren't set aren't enforced. Set RATE_LIMIT_REDIS_URL (needs the redis package) to share
+# the buckets between instances - if Redis can't be reached each process falls back to its own buckets,
+# trying Redis again after RATE_LIMIT_REDIS_RETRY_SECONDS.
+
+REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", None)
+RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", 3))
+MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", 120))
+REDIS_RETRY_SECONDS = float(os.getenv("RATE_LIMIT_REDIS_RETRY_SECONDS", 30))
+# a burst of 429s from calls already in flight only halves the concurrency once
+DECREASE_INTERVAL = 2.0
+
+RATE_LIMIT_ERRORS = re.compile(r"\b429\b|rate ?limit|quota|resource ?exhausted|too many requests|overloaded")
+TRANSIENT_ERRORS = re.compile(r"\b50[0234]\b|timeout|timed out|unavailable|connection reset")
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_redis = None
+# monotonic time until which Redis is skipped after a failure, shared by every bucket
+_redis_down_until = 0
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+def is_rate_limit_error(err):
+    return RATE_LIMIT_ERRORS.search(f"{type(err).__name__} {str(err)}".lower()) is not None
+
+def is_retryable_error(err):
+    return is_rate_limit_error(err) or TRANSIENT_ERRORS.search(f"{type(err).__name__} {str(err)}".lower()) is not None
+
+def estimate_tokens(*texts):
+    # about four characters a token for English, without loading a tokenizer
+    return sum(len(text) for text in texts) // 4 + 1
+
+
+class TokenBucket:
+    """Holds up to per_minute tokens, refilled continuously"""
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_take(self, cost: int):
+        """Takes cost tokens and returns 0, or returns the seconds until they will be there"""
+        cost = min(cost, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0
+            return (cost - self.tokens) / self.rate
+
+
+# the same bucket as TokenBucket, kept in a Redis hash and updated atomically
+_REDIS_TAKE = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = math.min(tonumber(ARGV[3]), capacity)
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], 120)
+return tostring(wait)
+"""
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+        client = redis.Redis.from_url(REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+        _redis = (client, client.register_script(_REDIS_TAKE))
+    return _redis
+
+
+class RedisTokenBucket(TokenBucket):
+    """A TokenBucket shared through Redis by every process using key"""
+    def __init__(self, key: str, per_minute: int):
+        super().__init__(per_minute)
+        self.key = key
+
+    def try_take(self, cost: int):
+        global _redis_down_until
+        if time.monotonic() < _redis_down_until:
+            return super().try_take(cost)
+        try:
+            _, take = _get_redis()
+            return float(take(keys=[self.key], args=[self.capacity, self.rate, cost]).decode("utf-8"))
+        except Exception as err:
+            # so every call doesn't wait on the socket timeout while Redis is down
+            _redis_down_until = time.monotonic() + REDIS_RETRY_SECONDS
+            logging.warning(f"Could not reach rate limit store, using local buckets for {REDIS_RETRY_SECONDS} seconds: {str(err)}")
+            return super().try_take(cost)
+
+
+class AdaptiveConcurrency:
+    """Caps calls in flight, adding one to the cap per cap's worth of successes and halving it when throttled"""
+    def __init__(self, max_limit: int, min_limit: int=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: float=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout=timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, throttled: bool=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                now = time.monotonic()
+                if now - self.last_decrease > DECREASE_INTERVAL:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.last_decrease = now
+                    logging.warning(f"Throttled, lowering concurrency limit to {int(self.limit)}")
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class ProviderLimiter:
+    """The request, token and concurrency limits of one provider's quota"""
+    def __init__(self, name: str):
+        self.name = name
+        env = f"RATE_LIMIT_{name.upper()}"
+        rpm = os.getenv(f"{env}_RPM", None)
+        tpm = os.getenv(f"{env}_TPM", None)
+        self.requests = self._bucket("rpm", int(rpm)) if rpm else None
+        self.tokens = self._bucket("tpm", int(tpm)) if tpm else None
+        self.concurrency = AdaptiveConcurrency(int(os.getenv(f"{env}_CONCURRENCY", os.getenv("RATE_LIMIT_CONCURRENCY", 32))))
+        self.stats = {"calls": 0, "throttled": 0, "waited": 0.0}
+
+    def _bucket(self, kind, per_minute):
+        if REDIS_URL:
+            return RedisTokenBucket(f"rate_limit:{self.name}:{kind}", per_minute)
+        return TokenBucket(per_minute)
+
+    def _take(self, bucket, cost, deadline):
+        while True:
+            wait = bucket.try_take(cost)
+            if wait == 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimitTimeout(f"Waited over {MAX_WAIT} seconds for {self.name} rate limit")
+            # short steps, so callers waiting on the same bucket take turns as it refills
+            pause = min(wait, 1.0) * (1 + random.random() * 0.1)
+            self.stats["waited"] += pause
+            time.sleep(pause)
+
+    @contextmanager
+    def slot(self, tokens: int=1, requests: int=1, max_wait: float=None):
+        """Waits until a call making requests that cost tokens fits the limits,
+        then holds a concurrency slot while it runs"""
+        start = time.monotonic()
+        deadline = start + (max_wait or MAX_WAIT)
+        if self.requests is not None:
+            self._take(self.requests, requests, deadline)
+        if self.tokens is not None:
+            self._take(self.tokens, tokens, deadline)
+        if not self.concurrency.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            raise RateLimitTimeout(f"Waited over {MAX_WAIT} seconds for a {self.name} concurrency slot")
+        self.stats["calls"] += 1
+        if time.monotonic() - start > 1:
+            logging.info(f"Waited {round(time.monotonic() - start, 2)} seconds for {self.name} rate limit")
+
+        throttled = False
+        try:
+            yield
+        except Exception as err:
+            throttled = is_rate_limit_error(err)
+            if throttled:
+                self.stats["throttled"] += 1
+            raise
+        finally:
+            self.concurrency.release(throttled=throttled)
+
+
+def get_limiter(name: str):
+    if name not in _limiters:
+        with _limiters_lock:
+            if name not in _limiters:
+                _limiters[name] = ProviderLimiter(name)
+    return _limiters[name]
+
+def provider_for(vector_name: str, embeddings: bool=False):
+    """The quota a vector_name's llm config uses, e.g. openai or vertex_embeddings"""
+    from utils.config import load_config_key
+    llm_str = load_config_key("llm", vector_name)
+    # codey models are served from the Vertex AI quota
+    provider = "vertex" if llm_str == "codey" else llm_str
+    return f"{provider}_embeddings" if embeddings else provider
+
+def call(name: str, fn, *args, tokens: int=1, requests: int=1, retries: int=None, **kwargs):
+    """Runs fn(*args, **kwargs) within the limits of name, retrying rate limit and transient errors
+    with jittered backoff. Pass requests for a chain that makes several LLM calls.
+    With name None only the retries apply."""
+    retries = RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            if name is None:
+                return fn(*args, **kwargs)
+            with get_limiter(name).slot(tokens=tokens, requests=requests):
+                return fn(*args, **kwargs)
+        except RateLimitTimeout:
+            raise
+        except Exception as err:
+            if attempt == retries or not is_retryable_error(err):
+                raise
+            delay = min(2 ** attempt, 60) * (0.5 + random.random())
+            logging.warning(f"{name} call failed, retrying in {round(delay, 1)}s, attempt {attempt + 1} of {retries}: {str(err)}")
+            time.sleep(delay)
+
+def rate_limit_stats():
+    return {name: {**limiter.stats, "concurrency_limit": int(limiter.concurrency.limit)}
+            for name, limiter in _limiters.items()}
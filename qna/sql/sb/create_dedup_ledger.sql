@@ -0,0 +1,9 @@
+-- Content hashes already ingested, so repeat uploads skip downloading and embedding
+CREATE TABLE IF NOT EXISTS {vector_name}_dedup_ledger (
+    kind text NOT NULL, -- 'object' for whole files (GCS md5), 'chunk' for chunk page_content sha1
+    hash text NOT NULL,
+    ref text, -- gs:// path for objects, vectorstore row id for chunks
+    source text, -- metadata source, so deleting a source clears its entries
+    created_at timestamptz NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (kind, hash)
+);
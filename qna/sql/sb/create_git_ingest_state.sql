@@ -0,0 +1,8 @@
+-- The last commit ingested for each git repository and branch
+CREATE TABLE IF NOT EXISTS {vector_name}_git_ingest_state (
+    repo text NOT NULL,
+    branch text NOT NULL,
+    commit_sha text NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (repo, branch)
+);
@@ -0,0 +1,17 @@
+-- Progress of each ingested source through the pipeline
+CREATE TABLE IF NOT EXISTS {vector_name}_ingest_jobs (
+    source text PRIMARY KEY,
+    parent text, -- source of the job that fanned out into this one
+    file_type text,
+    status text NOT NULL DEFAULT 'running', -- running, batch, fanned_out, published, complete, failed
+    counts jsonb NOT NULL DEFAULT '{{}}', -- per stage: downloaded (bytes), parsed (docs), published, stored, skipped, failed (chunks)
+    timings jsonb NOT NULL DEFAULT '{{}}', -- seconds from started_at to the latest update of each stage
+    parts text[], -- sources of the fan-out parts to wait for before a fanned_out job is complete
+    done_parts int NOT NULL DEFAULT 0,
+    error text,
+    started_at timestamptz NOT NULL DEFAULT NOW(),
+    updated_at timestamptz NOT NULL DEFAULT NOW(),
+    finished_at timestamptz
+);
+CREATE INDEX IF NOT EXISTS {vector_name}_ingest_jobs_parent ON {vector_name}_ingest_jobs (parent);
+CREATE INDEX IF NOT EXISTS {vector_name}_ingest_jobs_started_at ON {vector_name}_ingest_jobs (started_at);
@@ -0,0 +1,6 @@
+-- Records which SCHEMA_MIGRATIONS version each vectorstore namespace is at
+CREATE TABLE IF NOT EXISTS edmonbrain_schema_versions (
+    namespace text PRIMARY KEY,
+    version int NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,3 @@
+DELETE FROM {vector_name}
+    WHERE metadata->>'url' = $1 AND metadata->>'file_path' = $2
+    RETURNING id
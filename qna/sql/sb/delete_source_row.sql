@@ -1,2 +1,2 @@
 DELETE FROM {vector_name}
-    WHERE metadata->>'source' = '{source_delete}'
\ No newline at end of file
+    WHERE metadata->>'source' = $1
\ No newline at end of file
@@ -1,6 +1,7 @@
 import threading
 import logging
 import json
+import queue
 import re
 
 from typing import Any, Dict, List, Union
@@ -11,22 +12,44 @@ from qna.archive import archive_qa
 
 logging.basicConfig(level=logging.INFO)
 
+# a newline followed by a numbered list item, where the stream is cut so each item is sent on its own
+NUMBERED_LIST = re.compile(r'\n(\d+\.\s)')
+
 class ContentBuffer:
+    """
+    Segments of the streamed answer, written by the LLM callback thread and read by the response generator.
+    close() marks the end of the stream.
+    """
+    _END = object()
+
     def __init__(self):
-        self.content = ""
+        self.queue = queue.Queue()
         logging.debug("Content buffer initialized")
     
     def write(self, text: str):
-        self.content += text
-        logging.debug(f"Written {text} to buffer")
-    
-    def read(self) -> str:
-        logging.debug(f"Read content from buffer")    
-        return self.content
-
-    def clear(self):
-        logging.debug(f"Clearing content buffer")
-        self.content = ""
+        if text:
+            self.queue.put(text)
+            logging.debug(f"Written {text} to buffer")
+
+    def close(self):
+        self.queue.put(self._END)
+
+    def get(self, timeout: float=None):
+        """Waits for the next segments, returning all that have arrived joined together,
+        None once the stream is closed, or raises queue.Empty after timeout seconds"""
+        segments = [self.queue.get(timeout=timeout)]
+        while segments[-1] is not self._END:
+            try:
+                segments.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if segments[-1] is self._END:
+            # keep the end marker for the next get
+            segments.pop()
+            self.queue.put(self._END)
+            if not segments:
+                return None
+        return "".join(segments)
     
 
 class BufferStreamingStdOutCallbackHandler(StreamingStdOutCallbackHandler):
@@ -36,6 +59,8 @@ class BufferStreamingStdOutCallbackHandler(StreamingStdOutCallbackHandler):
 
         self.tokens = tokens
         self.buffer = ""
+        # where in buffer the next search for a numbered list starts
+        self.searched = 0
         self.stream_finished = threading.Event()
         self.in_code_block = False
         self.in_question_block = False
@@ -45,44 +70,55 @@ class BufferStreamingStdOutCallbackHandler(StreamingStdOutCallbackHandler):
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         logging.debug(f"token: {token}")
 
+        # a ``` delimiter may be split across tokens
+        tail = self.buffer[-2:]
         self.buffer += token
 
-        # Toggle the code block flag if the delimiter is encountered
-        if '```' in token:
+        # Toggle the code block flag for each delimiter encountered
+        for _ in range((tail + token).count('```') - tail.count('```')):
             self.in_code_block = not self.in_code_block
 
         # Process the buffer if not inside a code block
         if not self.in_code_block:
             self._process_buffer()
 
+    def _write(self, end: int):
+        self.content_buffer.write(self.buffer[:end])
+        self.buffer = self.buffer[end:]
+        self.searched = 0
+
     def _process_buffer(self):
+        # a numbered list not searched yet ends in the new text, so it starts at the newline
+        # before the digits and full stops that end what was already searched
+        search_from = self.searched
+        while search_from > 0 and (self.buffer[search_from - 1].isdigit() or self.buffer[search_from - 1] == "."):
+            search_from -= 1
+        search_from = max(search_from - 1, 0)
+        self.searched = len(self.buffer)
 
         # Check for the last occurrence of a newline followed by a numbered list pattern
-        matches = list(re.finditer(r'\n(\d+\.\s)', self.buffer))
-        if matches:
+        last_match = None
+        for last_match in NUMBERED_LIST.finditer(self.buffer, search_from):
+            pass
+        if last_match is not None:
             # If found, write up to the start of the last match, and leave the rest in the buffer
-            last_match = matches[-1]
             start_of_last_match = last_match.start() + 1  # Include the newline in the split
-            self.content_buffer.write(self.buffer[:start_of_last_match])
-            self.buffer = self.buffer[start_of_last_match:]
-        else:
+            # the rest is searched again, as the matches found may have hidden an overlapping one
+            self._write(start_of_last_match)
+        elif self.buffer.endswith(tuple(self.tokens)):
             # If not found, and the buffer ends with one of the specified ending tokens, write the entire buffer
-            if any(self.buffer.endswith(t) for t in self.tokens):
-                self.content_buffer.write(self.buffer)
-                self.buffer = ""
+            self._write(len(self.buffer))
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
 
         if self.buffer:
             # Process the remaining buffer content
-            self.content_buffer.write(self.buffer)
-            self.buffer = "" # Clear the remaining buffer
+            self._write(len(self.buffer))
             logging.info("Flushing reamaining LLM response buffer")
 
         self.stream_finished.set() # Set the flag to signal that the stream has finished
         logging.info("Streaming LLM response ended successfully")
 
-
 from langchain.chat_models import ChatOpenAI
 
 import time
@@ -96,9 +132,10 @@ def start_streaming_chat(question,
                          message_author=None,
                          wait_time=5,
                          timeout=120): # Timeout in seconds (2 minutes)
-    from threading import Thread, Event
+    """Yields each segment of the answer as soon as it is complete, then the JSON of the full answer and sources.
+    wait_time is how often a heartbeat is logged while waiting for the LLM."""
+    from threading import Thread
     from queue import Queue
-    from qna.streaming import ContentBuffer, BufferStreamingStdOutCallbackHandler
 
     # Initialize the chat
     content_buffer = ContentBuffer()
@@ -114,52 +151,52 @@ def start_streaming_chat(question,
     )
 
     result_queue = Queue()
-    stop_event = Event()
 
     # Start the chat in a separate thread
-    def start_chat(stop_event, result_queue):
+    def start_chat(result_queue):
         from qna.question_service import qna
-        final_result = qna(question, vector_name, chat_history, stream_llm=llm_stream, message_author=message_author)
-        result_queue.put(final_result)
-
-    chat_thread = Thread(target=start_chat, args=(stop_event,result_queue))
+        try:
+            final_result = qna(question, vector_name, chat_history, stream_llm=llm_stream, message_author=message_author)
+            result_queue.put(final_result)
+        except Exception as err:
+            result_queue.put(err)
+        finally:
+            content_buffer.close()
+
+    chat_thread = Thread(target=start_chat, args=(result_queue,))
     chat_thread.start()
 
     start = time.time()
-    while not chat_callback_handler.stream_finished.is_set() and not stop_event.is_set():
-        time.sleep(wait_time) # Wait for x seconds
-        logging.info(f"heartbeat - {round(time.time() - start, 2)} seconds")
-        content_to_send = content_buffer.read()
-
-        if content_to_send:
-            logging.info(f"==\n{content_to_send}")
-            yield content_to_send
-            content_buffer.clear()
-        else:
-            logging.info("No content to send")
-
-        elapsed_time = time.time() - start
-        if elapsed_time > timeout: # If the elapsed time exceeds the timeout
-            logging.warning("Content production has timed out after 2 minutes")
+    first_byte = None
+    while True:
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            logging.warning(f"Content production has timed out after {timeout} seconds")
             break
-    else:
-        logging.info(f"Stream has ended after {round(time.time() - start, 2)} seconds")
-        logging.info(f"Sending final full message plus sources...")
-        
-    
-    # if  you need it to stop it elsewhere use 
-    # stop_event.set()
-    content_to_send = content_buffer.read()
-    if content_to_send:
+        try:
+            content_to_send = content_buffer.get(timeout=min(wait_time, remaining))
+        except queue.Empty:
+            logging.info(f"heartbeat - {round(time.time() - start, 2)} seconds")
+            continue
+
+        if content_to_send is None:
+            logging.info(f"Stream has ended after {round(time.time() - start, 2)} seconds")
+            logging.info(f"Sending final full message plus sources...")
+            break
+
+        if first_byte is None:
+            first_byte = time.time() - start
+            logging.info(f"Time to first byte: {round(first_byte, 2)} seconds")
         logging.info(f"==\n{content_to_send}")
         yield content_to_send
-        content_buffer.clear()
 
     # Stop the stream thread
     chat_thread.join()
 
     # the json object with full response in 'answer' and the 'sources' array
     final_result = result_queue.get()
+    if isinstance(final_result, Exception):
+        raise final_result
 
     # TODO: only discord for now - slack? gchat?
 
@@ -2,6 +2,7 @@ from langchain.chains.summarize import load_summarize_chain
 from langchain.schema import Document
 
 from qna.llm import pick_llm
+import qna.rate_limit as rate_limit
 from chunker.publish_to_pubsub_embed import chunk_doc_to_docs
 import logging
 
@@ -17,9 +18,6 @@ SUMMARY:"""
 MAP_PROMPT = PromptTemplate(template=prompt_template, input_variables=["text"])
 
 
-import time
-import random
-
 def summarise_docs(docs, vector_name, skip_if_less=10000):
     llm, _, _ = pick_llm(vector_name)
     chain = load_summarize_chain(llm, chain_type="map_reduce", verbose=True,
@@ -48,22 +46,14 @@ def summarise_docs(docs, vector_name, skip_if_less=10000):
         metadata = doc.metadata
         chunks = chunk_doc_to_docs([doc])
 
-        # Initial delay
-        delay = 1.0  # 1 second, for example
-        max_delay = 300.0  # Maximum delay, adjust as needed
-
-        for attempt in range(5):  # Attempt to summarize 5 times
-            try:
-                summary = chain.run(chunks)
-                break  # If the summary was successful, break the loop
-            except Exception as e:
-                logging.error(f"Error while summarizing on attempt {attempt+1}: {e}")
-                print(f"Failure, waiting {delay} seconds before retrying...")
-                time.sleep(delay)  # Wait for the delay period
-                delay = min(delay * 2 + random.uniform(0, 1), max_delay)  # Exponential backoff with jitter
-        else:
-            logging.error(f"Failed to summarize after 5 attempts")
-            continue  # If we've failed after 5 attempts, move on to the next document
+        # waits for the provider's quota, and retries rate limit and transient errors with backoff
+        try:
+            summary = rate_limit.call(rate_limit.provider_for(vector_name), chain.run, chunks,
+                                      tokens=rate_limit.estimate_tokens(*[chunk.page_content for chunk in chunks]),
+                                      requests=len(chunks) + 1, retries=4)
+        except Exception as e:
+            logging.error(f"Failed to summarize, moving on to the next document: {e}")
+            continue
 
         
         metadata["type"] = "summary"
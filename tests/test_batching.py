@@ -0,0 +1,133 @@
+import time
+import threading
+
+from embedder.batching import ChunkBatcher, add_documents_splitting
+
+
+class RecordingStore:
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+        self.stored = threading.Event()
+
+    def __call__(self, vector_name, docs):
+        self.batches.append((vector_name, list(docs)))
+        self.stored.set()
+        if self.error is not None:
+            raise self.error
+        return [None] * len(docs)
+
+def test_flushes_when_full():
+    store = RecordingStore()
+    batcher = ChunkBatcher(store, max_size=3, max_wait=60)
+    futures = [batcher.submit("vn", doc) for doc in ["a", "b", "c"]]
+    # the third submit stores the batch without waiting for the timer
+    assert [future.result(timeout=1) for future in futures] == [None, None, None]
+    assert store.batches == [("vn", ["a", "b", "c"])]
+
+def test_flushes_after_max_wait():
+    store = RecordingStore()
+    batcher = ChunkBatcher(store, max_size=100, max_wait=0.2)
+    start = time.time()
+    futures = [batcher.submit("vn", doc) for doc in ["a", "b"]]
+    assert not futures[0].done()
+    assert [future.result(timeout=5) for future in futures] == [None, None]
+    assert time.time() - start >= 0.2
+    assert store.batches == [("vn", ["a", "b"])]
+
+def test_timer_of_a_full_batch_does_not_flush_the_next_one():
+    store = RecordingStore()
+    batcher = ChunkBatcher(store, max_size=2, max_wait=0.2)
+    first = [batcher.submit("vn", doc) for doc in ["a", "b"]]
+    second = batcher.submit("vn", "c")
+    assert [future.result(timeout=1) for future in first] == [None, None]
+    assert second.result(timeout=5) is None
+    assert store.batches == [("vn", ["a", "b"]), ("vn", ["c"])]
+
+def test_batches_per_vector_name():
+    store = RecordingStore()
+    batcher = ChunkBatcher(store, max_size=2, max_wait=60)
+    futures = [batcher.submit("one", "a"), batcher.submit("two", "b"),
+               batcher.submit("one", "c"), batcher.submit("two", "d")]
+    assert [future.result(timeout=1) for future in futures] == [None] * 4
+    assert sorted(store.batches) == [("one", ["a", "c"]), ("two", ["b", "d"])]
+
+def test_store_error_fails_every_doc_in_the_batch():
+    store = RecordingStore(error=RuntimeError("vector store down"))
+    batcher = ChunkBatcher(store, max_size=2, max_wait=60)
+    futures = [batcher.submit("vn", doc) for doc in ["a", "b"]]
+    assert [future.result(timeout=1) for future in futures] == ["vector store down"] * 2
+
+
+class Doc:
+    def __init__(self, page_content):
+        self.page_content = page_content
+
+class LimitedVectorStore:
+    """Rejects batches of more than max_docs like an embedding provider's batch limit"""
+    def __init__(self, max_docs):
+        self.max_docs = max_docs
+        self.calls = []
+
+    def add_documents(self, docs):
+        self.calls.append(len(docs))
+        if len(docs) > self.max_docs:
+            raise ValueError("Too many inputs in the request")
+        return list(range(len(docs)))
+
+def test_add_documents_splitting_halves_too_big_batches():
+    vector_store = LimitedVectorStore(max_docs=2)
+    stored = []
+    docs = [Doc(str(i)) for i in range(5)]
+    errors = add_documents_splitting(vector_store, docs, on_stored=lambda docs, ids: stored.extend(docs))
+    assert errors == [None] * 5
+    assert stored == docs
+    assert vector_store.calls == [5, 2, 3, 1, 2]
+
+class FailingVectorStore:
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def add_documents(self, docs):
+        self.calls += 1
+        raise self.error
+
+def test_add_documents_splitting_does_not_retry_inserts(monkeypatch):
+    # a transient error may come after the insert, so retrying could store the docs twice
+    import qna.rate_limit as rate_limit
+    monkeypatch.setattr(rate_limit.time, "sleep", lambda seconds: None)
+    vector_store = FailingVectorStore(ValueError("503 Service Unavailable"))
+    errors = add_documents_splitting(vector_store, [Doc("a"), Doc("b")])
+    assert errors == ["503 Service Unavailable"] * 2
+    assert vector_store.calls == 1
+
+class StatusError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+def test_add_documents_splitting_does_not_split_other_errors():
+    # e.g. a row too big for a Postgres index, which splitting can't fix
+    vector_store = FailingVectorStore(ValueError("index row size 3000 exceeds maximum 2712 for index"))
+    errors = add_documents_splitting(vector_store, [Doc(str(i)) for i in range(8)])
+    assert errors == ["index row size 3000 exceeds maximum 2712 for index"] * 8
+    assert vector_store.calls == 1
+
+def test_add_documents_splitting_splits_on_413_status():
+    vector_store = LimitedVectorStore(max_docs=2)
+
+    def add_documents(docs):
+        vector_store.calls.append(len(docs))
+        if len(docs) > vector_store.max_docs:
+            raise StatusError("Request Entity Too Large", status_code=413)
+        return list(range(len(docs)))
+
+    vector_store.add_documents = add_documents
+    assert add_documents_splitting(vector_store, [Doc(str(i)) for i in range(4)]) == [None] * 4
+    assert vector_store.calls == [4, 2, 2]
+
+def test_413_in_message_is_not_a_batch_limit():
+    from embedder.batching import is_batch_limit_error
+    assert not is_batch_limit_error(ValueError("Document 413 could not be parsed"))
+    assert is_batch_limit_error(ValueError("This model's maximum context length is 8191 tokens"))
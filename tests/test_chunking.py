@@ -0,0 +1,102 @@
+import random
+import logging
+
+import pytest
+
+pytest.importorskip("langchain")
+from langchain.schema import Document
+
+from chunker import chunking
+
+
+def old_chunk_doc_to_docs(documents: list, extension: str = ".md", min_size: int = 800):
+    # chunk_doc_to_docs as it was before chunks were streamed, to check their output hasn't changed
+    combined_documents_content = ""
+    combined_documents = []
+    for document in documents:
+        content = chunking.remove_whitespace(document.page_content)
+        if len(content) < min_size:
+            combined_documents_content += content + "\n"
+        else:
+            if combined_documents_content:
+                combined_documents.append(Document(page_content=combined_documents_content, metadata=document.metadata))
+                combined_documents_content = ""
+            combined_documents.append(document)
+
+    if combined_documents_content:
+        combined_documents.append(Document(page_content=combined_documents_content, metadata=documents[-1].metadata))
+
+    source_chunks = []
+    temporary_chunk = ""
+    for document in combined_documents:
+        splitter = chunking.choose_splitter(extension)
+        for chunk in splitter.split_text(document.page_content):
+            if len(chunk) < min_size:
+                temporary_chunk += chunk + "\n"
+                continue
+
+            if temporary_chunk:
+                chunk = temporary_chunk + chunk
+                temporary_chunk = ""
+
+            if len(chunk) < min_size:
+                temporary_chunk += chunk + "\n"
+                continue
+
+            source_chunks.append(Document(page_content=chunk, metadata=document.metadata))
+
+        if temporary_chunk:
+            source_chunks.append(Document(page_content=temporary_chunk, metadata=document.metadata))
+            temporary_chunk = ""
+
+    return source_chunks
+
+def random_text(rng, length):
+    words = ["the", "brain", "vector", "store", "chunk", "of", "a", "longer", "document", "1.", "#", "-"]
+    separators = [" ", " ", " ", " ", "\n", "\n\n", ". ", "\t"]
+    parts = []
+    size = 0
+    while size < length:
+        part = rng.choice(words) + rng.choice(separators)
+        parts.append(part)
+        size += len(part)
+    return "".join(parts)
+
+def random_docs(rng):
+    # a mix of documents smaller and larger than min_size
+    return [Document(page_content=random_text(rng, rng.choice([50, 300, 900, 3000, 12000])),
+                     metadata={"source": f"doc{i}"})
+            for i in range(rng.randint(1, 8))]
+
+def as_tuples(docs):
+    return [(doc.page_content, doc.metadata) for doc in docs]
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    logging.disable(logging.INFO)
+    yield
+    logging.disable(logging.NOTSET)
+
+@pytest.mark.parametrize("extension", [".md", ".py", ".txt"])
+def test_chunks_match_old_chunker(extension):
+    rng = random.Random(extension)
+    for _ in range(50):
+        docs = random_docs(rng)
+        assert as_tuples(chunking.chunk_doc_to_docs(docs, extension=extension)) == \
+            as_tuples(old_chunk_doc_to_docs(docs, extension=extension))
+
+def test_iter_chunk_docs_takes_a_generator():
+    rng = random.Random(0)
+    docs = random_docs(rng)
+    assert as_tuples(chunking.iter_chunk_docs(doc for doc in docs)) == as_tuples(old_chunk_doc_to_docs(docs))
+
+def test_shard_text_cuts_at_boundaries():
+    text = random_text(random.Random(1), 100000)
+    shards = chunking.shard_text(text, 10000)
+    assert "".join(shards) == text
+    assert all(len(shard) <= 10000 for shard in shards)
+    assert all(shard.endswith(tuple(chunking.SHARD_BOUNDARIES)) for shard in shards[:-1])
+
+def test_shard_text_without_boundaries():
+    text = "x" * 2500
+    assert chunking.shard_text(text, 1000) == ["x" * 1000, "x" * 1000, "x" * 500]
@@ -0,0 +1,107 @@
+import logging
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+loaders = pytest.importorskip("chunker.loaders")
+from chunker import chunking, pdfs
+
+PAGE_TEXT = "some text on the page "
+
+
+def extract_page_range(pdf_path, start, end):
+    return [(page + 1, PAGE_TEXT, None) for page in range(start, end)]
+
+class BreakingPool:
+    """Breaks like a pool whose worker died while extracting the range starting at break_at"""
+    def __init__(self, break_at):
+        self.break_at = break_at
+        self.discarded = False
+
+    def submit(self, fn, pdf_path, start, end):
+        future = Future()
+        if start == self.break_at:
+            future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+        else:
+            future.set_result(extract_page_range(pdf_path, start, end))
+        return future
+
+@pytest.fixture
+def fallback(monkeypatch):
+    # a 60 page PDF read as three ranges of 25, 25 and 10 pages
+    monkeypatch.setattr(pdfs, "pdf_page_count", lambda pdf_path: 60)
+    monkeypatch.setattr(pdfs, "extract_page_range", extract_page_range)
+    monkeypatch.setattr(chunking, "PROCESSES", 2)
+    monkeypatch.setattr(loaders.parse_cache, "get", lambda *args, **kwargs: None)
+    monkeypatch.setattr(loaders.parse_cache, "enabled", lambda: False)
+    calls = []
+
+    def read_file_to_document(gs_file, metadata=None, try_pypdf=True):
+        calls.append(gs_file)
+        return [loaders.Document(page_content="read by unstructured", metadata={})]
+
+    monkeypatch.setattr(loaders, "read_file_to_document", read_file_to_document)
+    return calls
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    logging.disable(logging.WARNING)
+    yield
+    logging.disable(logging.NOTSET)
+
+def use_pool(monkeypatch, pool):
+    monkeypatch.setattr(chunking, "get_process_pool", lambda: pool)
+    monkeypatch.setattr(chunking, "discard_process_pool", lambda: setattr(pool, "discarded", True))
+
+def test_pool_breaking_part_way_through_a_pdf_fails_it(monkeypatch, fallback):
+    pool = BreakingPool(break_at=25)
+    use_pool(monkeypatch, pool)
+    docs = []
+    with pytest.raises(loaders.PartialDocumentError):
+        for doc in loaders.iter_file_documents("file.pdf", metadata={"source": "file.pdf"}):
+            docs.append(doc)
+    assert len(docs) == 25
+    assert pool.discarded
+    # the first pages mustn't be passed off as the whole PDF by another parser
+    assert fallback == []
+
+def test_pool_breaking_before_any_page_falls_back(monkeypatch, fallback):
+    use_pool(monkeypatch, BreakingPool(break_at=0))
+    docs = list(loaders.iter_file_documents("file.pdf"))
+    assert [doc.page_content for doc in docs] == ["read by unstructured"]
+    assert fallback == ["file.pdf"]
+
+def test_reads_every_range(monkeypatch, fallback):
+    use_pool(monkeypatch, BreakingPool(break_at=None))
+    docs = list(loaders.iter_file_documents("file.pdf"))
+    assert [doc.metadata["page_number"] for doc in docs] == list(range(1, 61))
+    assert fallback == []
+
+class Blob:
+    name = "vn/file.pdf"
+
+    def download_as_bytes(self):
+        return b"%PDF-1.4"
+
+def breaking_extract_page_range(break_at):
+    def extract(pdf_path, start, end):
+        if start == break_at:
+            raise ValueError("Stream has ended unexpectedly")
+        return extract_page_range(pdf_path, start, end)
+    return extract
+
+def test_blob_pdf_failing_part_way_through_fails_it(monkeypatch, fallback):
+    monkeypatch.setattr(pdfs, "extract_page_range", breaking_extract_page_range(break_at=25))
+    docs = []
+    with pytest.raises(loaders.PartialDocumentError):
+        for doc in loaders.iter_blob_documents(Blob(), size=100):
+            docs.append(doc)
+    assert len(docs) == 25
+    assert fallback == []
+
+def test_blob_pdf_failing_before_any_page_falls_back(monkeypatch, fallback):
+    monkeypatch.setattr(pdfs, "extract_page_range", breaking_extract_page_range(break_at=0))
+    docs = list(loaders.iter_blob_documents(Blob(), size=100))
+    assert [doc.page_content for doc in docs] == ["read by unstructured"]
+    assert len(fallback) == 1
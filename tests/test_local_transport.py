@@ -0,0 +1,71 @@
+import os
+import base64
+import hashlib
+
+import pytest
+
+pytest.importorskip("google.api_core")
+from google.api_core.exceptions import PreconditionFailed
+
+import utils.local_transport as local_transport
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    monkeypatch.delenv("LOCAL_GCS_NOTIFY_TOPIC", raising=False)
+    return local_transport.LocalStorageClient(root=str(tmp_path)).get_bucket("test-bucket")
+
+def md5_of(data: bytes):
+    return base64.b64encode(hashlib.md5(data).digest()).decode("utf-8")
+
+def test_upload_then_get_blob(bucket):
+    blob = bucket.blob("vn/2023/file.txt")
+    blob.metadata = {"vector_name": "vn"}
+    blob.upload_from_string("hello world", if_generation_match=0)
+
+    found = bucket.get_blob("vn/2023/file.txt")
+    assert found.md5_hash == md5_of(b"hello world")
+    assert found.size == 11
+    assert found.metadata == {"vector_name": "vn"}
+    assert found.generation == blob.generation
+    assert found.download_as_text() == "hello world"
+    assert found.download_as_bytes(start=6, end=10) == b"world"
+
+def test_upload_from_filename(bucket, tmp_path):
+    filename = tmp_path / "page.pdf"
+    filename.write_bytes(b"%PDF-1.4 page")
+    bucket.blob("vn/page.pdf").upload_from_filename(str(filename), if_generation_match=0)
+
+    found = bucket.get_blob("vn/page.pdf")
+    assert found.md5_hash == md5_of(b"%PDF-1.4 page")
+    downloaded = tmp_path / "downloaded.pdf"
+    found.download_to_filename(str(downloaded))
+    assert downloaded.read_bytes() == b"%PDF-1.4 page"
+
+def test_generation_match_zero_does_not_overwrite(bucket):
+    bucket.blob("vn/file.txt").upload_from_string("first", if_generation_match=0)
+    with pytest.raises(PreconditionFailed):
+        bucket.blob("vn/file.txt").upload_from_string("second", if_generation_match=0)
+
+    assert bucket.get_blob("vn/file.txt").download_as_text() == "first"
+    # no temp files left behind next to the blob or its meta
+    assert os.listdir(os.path.join(bucket.path, "vn")) == ["file.txt"]
+    assert os.listdir(os.path.join(bucket.path, ".meta", "vn")) == ["file.txt.json"]
+
+def test_upload_without_precondition_overwrites(bucket):
+    bucket.blob("vn/file.txt").upload_from_string("first")
+    bucket.blob("vn/file.txt").upload_from_string("second")
+    found = bucket.get_blob("vn/file.txt")
+    assert found.download_as_text() == "second"
+    assert found.md5_hash == md5_of(b"second")
+
+def test_get_missing_blob(bucket):
+    assert bucket.get_blob("vn/missing.txt") is None
+
+def test_upload_notifies_topic(tmp_path):
+    local_transport.reset()
+    local_transport.LocalPublisherClient().create_topic({"name": "app_to_pubsub_vn"})
+    client = local_transport.LocalStorageClient(root=str(tmp_path), notify_topic="app_to_pubsub_{vector_name}")
+    client.get_bucket("test-bucket").blob("vn/file.txt").upload_from_string("hello", if_generation_match=0)
+    assert local_transport.delivery_stats()["published"] == 1
+    local_transport.reset()
@@ -0,0 +1,132 @@
+import pytest
+
+import qna.rate_limit as rate_limit
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    return clock
+
+def test_token_bucket_refills_over_time(clock):
+    bucket = rate_limit.TokenBucket(per_minute=60)
+    assert bucket.try_take(60) == 0
+    assert bucket.try_take(1) == pytest.approx(1.0)
+    clock.now += 0.5
+    assert bucket.try_take(1) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_take(1) == 0
+
+def test_token_bucket_holds_at_most_a_minute_of_tokens(clock):
+    bucket = rate_limit.TokenBucket(per_minute=60)
+    clock.now += 3600
+    assert bucket.try_take(60) == 0
+    assert bucket.try_take(1) > 0
+
+def test_token_bucket_caps_cost_at_capacity(clock):
+    # a call costing more than a minute's tokens waits for a full bucket rather than forever
+    bucket = rate_limit.TokenBucket(per_minute=60)
+    assert bucket.try_take(1000) == 0
+
+def test_concurrency_halves_once_per_burst_of_throttles(clock):
+    concurrency = rate_limit.AdaptiveConcurrency(max_limit=16)
+    for _ in range(3):
+        assert concurrency.acquire(timeout=0)
+    concurrency.release(throttled=True)
+    concurrency.release(throttled=True)
+    assert int(concurrency.limit) == 8
+    clock.now += rate_limit.DECREASE_INTERVAL + 1
+    concurrency.release(throttled=True)
+    assert int(concurrency.limit) == 4
+
+def test_concurrency_never_drops_below_min_limit(clock):
+    concurrency = rate_limit.AdaptiveConcurrency(max_limit=4, min_limit=2)
+    for _ in range(5):
+        clock.now += rate_limit.DECREASE_INTERVAL + 1
+        concurrency.acquire(timeout=0)
+        concurrency.release(throttled=True)
+    assert int(concurrency.limit) == 2
+
+def test_concurrency_grows_back_by_one_per_window_of_successes(clock):
+    concurrency = rate_limit.AdaptiveConcurrency(max_limit=8)
+    concurrency.acquire(timeout=0)
+    concurrency.release(throttled=True)
+    assert int(concurrency.limit) == 4
+    # each success adds 1/limit, so a little over a window of 4 gets to 5
+    for _ in range(5):
+        concurrency.acquire(timeout=0)
+        concurrency.release()
+    assert int(concurrency.limit) == 5
+    for _ in range(100):
+        concurrency.acquire(timeout=0)
+        concurrency.release()
+    assert concurrency.limit == 8
+
+def test_concurrency_blocks_at_the_limit():
+    concurrency = rate_limit.AdaptiveConcurrency(max_limit=2)
+    assert concurrency.acquire(timeout=0)
+    assert concurrency.acquire(timeout=0)
+    assert not concurrency.acquire(timeout=0.05)
+    concurrency.release()
+    assert concurrency.acquire(timeout=0)
+
+def test_redis_failure_uses_local_bucket_until_retry(clock, monkeypatch):
+    calls = []
+
+    def take(keys, args):
+        calls.append(keys)
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(rate_limit, "_redis", (None, take))
+    monkeypatch.setattr(rate_limit, "_redis_down_until", 0)
+    bucket = rate_limit.RedisTokenBucket("rate_limit:test:rpm", per_minute=60)
+    assert bucket.try_take(1) == 0
+    assert bucket.try_take(1) == 0
+    assert len(calls) == 1
+    clock.now += rate_limit.REDIS_RETRY_SECONDS + 1
+    assert bucket.try_take(1) == 0
+    assert len(calls) == 2
+
+@pytest.mark.parametrize("message,retryable", [
+    ("429 Too Many Requests", True),
+    ("Rate limit reached for requests", True),
+    ("503 Service Unavailable", True),
+    ("Request timed out", True),
+    ("This model's maximum context length is 5000 tokens", False),
+    ("Invalid API key", False),
+])
+def test_retryable_errors(message, retryable):
+    assert rate_limit.is_retryable_error(ValueError(message)) == retryable
+
+def test_call_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(rate_limit.time, "sleep", lambda seconds: None)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ValueError("503 Service Unavailable")
+        return "ok"
+
+    assert rate_limit.call(None, flaky, retries=3) == "ok"
+    assert len(attempts) == 3
+
+def test_call_does_not_retry_other_errors(monkeypatch):
+    monkeypatch.setattr(rate_limit.time, "sleep", lambda seconds: None)
+    attempts = []
+
+    def broken():
+        attempts.append(1)
+        raise ValueError("Invalid API key")
+
+    with pytest.raises(ValueError):
+        rate_limit.call(None, broken, retries=3)
+    assert len(attempts) == 1
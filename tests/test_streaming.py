@@ -0,0 +1,79 @@
+import re
+import random
+import logging
+
+import pytest
+
+streaming = pytest.importorskip("qna.streaming")
+
+
+def old_segments(tokens, end_tokens=".?!\n"):
+    # how answers were segmented before the buffer was searched incrementally
+    segments = []
+    buffer = ""
+    in_code_block = False
+    for token in tokens:
+        buffer += token
+        if '```' in token:
+            in_code_block = not in_code_block
+        if in_code_block:
+            continue
+        matches = list(re.finditer(r'\n(\d+\.\s)', buffer))
+        if matches:
+            start_of_last_match = matches[-1].start() + 1
+            segments.append(buffer[:start_of_last_match])
+            buffer = buffer[start_of_last_match:]
+        elif any(buffer.endswith(t) for t in end_tokens):
+            segments.append(buffer)
+            buffer = ""
+    if buffer:
+        segments.append(buffer)
+    # empty segments were never sent
+    return [segment for segment in segments if segment]
+
+class RecordingBuffer(streaming.ContentBuffer):
+    def __init__(self):
+        super().__init__()
+        self.segments = []
+
+    def write(self, text: str):
+        if text:
+            self.segments.append(text)
+
+def new_segments(tokens):
+    content_buffer = RecordingBuffer()
+    handler = streaming.BufferStreamingStdOutCallbackHandler(content_buffer=content_buffer, tokens=".?!\n")
+    for token in tokens:
+        handler.on_llm_new_token(token)
+    handler.on_llm_end(None)
+    return content_buffer.segments
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    logging.disable(logging.INFO)
+    yield
+    logging.disable(logging.NOTSET)
+
+def test_segments_match_old_handler_without_code_fences():
+    rng = random.Random(0)
+    alphabet = ["a", " ", ".", "\n", "1", "2", ". ", "!", "?", "x y", "\n3. ", "10", "\n12", ".\t", "1234567"]
+    for _ in range(2000):
+        tokens = [rng.choice(alphabet) for _ in range(rng.randint(0, 150))]
+        assert new_segments(tokens) == old_segments(tokens), tokens
+
+def test_numbered_list_items_are_sent_separately():
+    tokens = ["Steps", ":", "\n1", ". Install", " it", "\n2", ". Run", "\n123", "4567", ". Done"]
+    assert new_segments(tokens) == ["Steps:\n", "1. Install it\n", "2. Run\n", "1234567. Done"]
+
+def test_code_block_split_across_tokens_is_sent_whole():
+    tokens = ["See:\n", "``", "`py\nx = 1.\n", "y = 2\n`", "``", "\n"]
+    assert new_segments(tokens) == ["See:\n", "```py\nx = 1.\ny = 2\n```\n"]
+
+def test_content_buffer_get_joins_waiting_segments():
+    content_buffer = streaming.ContentBuffer()
+    content_buffer.write("One. ")
+    content_buffer.write("Two.")
+    content_buffer.close()
+    assert content_buffer.get(timeout=1) == "One. Two."
+    assert content_buffer.get(timeout=1) is None
+    assert content_buffer.get(timeout=1) is None
@@ -1,19 +1,78 @@
 import logging, os, json
+import threading
 
-def load_config(filename):
-    
+# parsed config files keyed by absolute path: {path: (signature, version, config)}
+_config_cache = {}
+_config_lock = threading.Lock()
+_config_stats = {"hits": 0, "misses": 0, "reloads": 0}
+
+def _config_path(filename):
     # Get the directory of the current script
     script_dir = os.path.dirname(os.path.realpath(__file__))
     parent_dir = os.path.dirname(script_dir)
 
     # Join the script directory with the filename
-    config_path = os.path.join(parent_dir, filename)
-    logging.info(f"Loading config file: {config_path}")
+    return os.path.join(parent_dir, filename)
+
+def _file_signature(config_path):
+    # mtime_ns, inode and size change whenever the file is rewritten or swapped in via os.replace
+    stat = os.stat(config_path)
+    return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+def load_config(filename):
+    """Returns the parsed config file, only re-reading it from disk when it has changed.
+
+    The parsed dict is shared across the process, so callers must treat it as read-only.
+    """
+    config_path = _config_path(filename)
+    signature = _file_signature(config_path)
+
+    cached = _config_cache.get(config_path)
+    if cached is not None and cached[0] == signature:
+        _config_stats["hits"] += 1
+        return cached[2]
+
+    with _config_lock:
+        # another thread may have reloaded it while we waited for the lock
+        cached = _config_cache.get(config_path)
+        if cached is not None and cached[0] == signature:
+            _config_stats["hits"] += 1
+            return cached[2]
+
+        logging.info(f"Loading config file: {config_path}")
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+
+        version = cached[1] + 1 if cached is not None else 1
+        # swap in the whole entry at once so readers never see a half-updated config
+        _config_cache[config_path] = (signature, version, config)
+        _config_stats["misses"] += 1
+        if cached is not None:
+            _config_stats["reloads"] += 1
+            logging.info(f"Config file {config_path} changed - now at version {version}")
 
-    with open(config_path, 'r') as f:
-        config = json.load(f)
     return config
 
+def write_config(filename, content: bytes):
+    """Validates and atomically replaces a config file, then swaps it into the cache"""
+    json.loads(content) # raise before touching the file if the new config is not valid json
+
+    config_path = _config_path(filename)
+    tmp_path = f"{config_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, config_path)
+
+    return load_config(filename)
+
+def config_version(filename="config.json"):
+    """Returns an integer that increments each time the config file content is reloaded"""
+    load_config(filename)
+    return _config_cache[_config_path(filename)][1]
+
+def config_cache_stats():
+    return dict(_config_stats)
+
 def load_config_key(key, vector_name):
     config = load_config("config.json")
     llm_config = config.get(vector_name, None)
@@ -21,5 +80,5 @@ def load_config_key(key, vector_name):
         raise ValueError("No llm_config was found")
     logging.debug(f'llm_config: {llm_config} for {vector_name}')
     key_str = llm_config.get(key, None)
-    
-    return key_str
\ No newline at end of file
+
+    return key_str
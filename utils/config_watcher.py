@@ -0,0 +1,90 @@
+import os, sys
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(parent_dir)
+
+import logging
+import threading
+import time
+
+from utils.config import write_config
+
+class ConfigWatcher:
+    """
+    Keeps a local config file in sync with a blob in Cloud Storage from a background thread.
+    Only downloads when the blob generation changes, so requests never wait on storage.
+    Call refresh_now() e.g. from a GCS object-change Pub/Sub push to reload immediately.
+    """
+    def __init__(self, bucket_name: str, blob_name: str, filename: str="config.json",
+                 poll_seconds: int=60, storage_client=None):
+        self.bucket_name = bucket_name.replace('gs://', '')
+        self.blob_name = blob_name
+        self.filename = filename
+        self.poll_seconds = poll_seconds
+        self.storage_client = storage_client
+        self.generation = None
+        self.last_checked = None
+        self.last_updated = None
+        self.last_error = None
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _client(self):
+        if self.storage_client is None:
+            from utils.transport import get_storage_client
+            self.storage_client = get_storage_client()
+        return self.storage_client
+
+    def check(self):
+        """Fetches the blob only if its generation differs from the one already loaded"""
+        bucket = self._client().bucket(self.bucket_name)
+        blob = bucket.get_blob(self.blob_name)
+        self.last_checked = time.time()
+
+        if blob is None:
+            logging.info(f"The blob {self.blob_name} does not exist in the bucket {self.bucket_name}")
+            return False
+
+        if blob.generation == self.generation:
+            logging.debug(f"Configuration {self.blob_name} not modified")
+            return False
+
+        # pin the generation so a concurrent overwrite doesn't give us a mismatched version
+        content = blob.download_as_bytes(if_generation_match=blob.generation)
+        write_config(self.filename, content)
+
+        self.generation = blob.generation
+        self.last_updated = time.time()
+        logging.info(f"Configuration file updated to generation {self.generation}, reloaded the new configuration.")
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+                self.last_error = None
+            except Exception as err:
+                self.last_error = str(err)
+                logging.error(f"Could not refresh config from gs://{self.bucket_name}/{self.blob_name}: {str(err)}")
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def refresh_now(self):
+        self._wake.set()
+
+    def status(self):
+        now = time.time()
+        return {
+            "blob": f"gs://{self.bucket_name}/{self.blob_name}",
+            "generation": self.generation,
+            "poll_seconds": self.poll_seconds,
+            # how long since we last confirmed the in-memory config matches the bucket
+            "staleness_seconds": round(now - self.last_checked, 2) if self.last_checked else None,
+            "seconds_since_update": round(now - self.last_updated, 2) if self.last_updated else None,
+            "last_error": self.last_error
+        }
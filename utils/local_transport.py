@@ -0,0 +1,344 @@
+"""
+In-process stand-ins for Pub/Sub push subscriptions and Cloud Storage, used when EDMONBRAIN_TRANSPORT=local.
+Lets the chunker -> embed_chunk_{vector_name} -> embedder -> vectorstore path run on a laptop or in CI:
+
+    EDMONBRAIN_TRANSPORT=local QNA_URL=http://chunker EMBED_URL=http://embedder LOCAL_GCS_DIR=/tmp/gcs
+
+    from utils.local_transport import register_push_app, wait_until_idle, delivery_stats
+    from chunker.app import app as chunker_app
+    from embedder.app import app as embedder_app
+    register_push_app("http://chunker", chunker_app)
+    register_push_app("http://embedder", embedder_app)
+    ... publish or upload something ...
+    wait_until_idle()
+    print(delivery_stats())
+
+Push endpoints that match a registered base URL are delivered straight to that Flask app,
+anything else is POSTed over HTTP so services can also run as separate local processes.
+Blobs are stored under LOCAL_GCS_DIR/<bucket>/<name> with their metadata alongside in .meta/.
+Set LOCAL_GCS_NOTIFY_TOPIC (e.g. "app_to_pubsub_{vector_name}") to publish OBJECT_FINALIZE
+notifications like a bucket Pub/Sub notification would, with vector_name the first folder of the object.
+"""
+import os
+import json
+import time
+import base64
+import shutil
+import hashlib
+import logging
+import datetime
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from google.api_core.exceptions import NotFound, AlreadyExists
+
+_lock = threading.Lock()
+_topics = set()
+# subscription name: {"topic": topic, "push_endpoint": url}
+_subscriptions = {}
+# base url: flask app
+_push_apps = {}
+_message_count = 0
+_in_flight = 0
+_idle = threading.Condition(_lock)
+_stats = {"published": 0, "delivered": 0, "failed": 0, "delivery_seconds": 0.0}
+
+# held while a blob and its meta are renamed into place, so if_generation_match=0 is checked atomically
+_blob_lock = threading.Lock()
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("LOCAL_PUBSUB_WORKERS", 8)),
+                               thread_name_prefix="local-pubsub")
+
+def register_push_app(base_url: str, app):
+    """Deliver pushes for endpoints starting with base_url to this Flask app"""
+    _push_apps[base_url.rstrip("/")] = app
+
+def reset():
+    with _lock:
+        _topics.clear()
+        _subscriptions.clear()
+        _stats.update({"published": 0, "delivered": 0, "failed": 0, "delivery_seconds": 0.0})
+
+def delivery_stats():
+    with _lock:
+        stats = dict(_stats)
+    if stats["delivered"]:
+        stats["mean_delivery_seconds"] = round(stats["delivery_seconds"] / stats["delivered"], 4)
+    return stats
+
+def wait_until_idle(timeout: float=None):
+    """Blocks until every published message (and any it caused to be published) has been delivered"""
+    with _idle:
+        return _idle.wait_for(lambda: _in_flight == 0, timeout=timeout)
+
+def _topic_name(topic: str):
+    # accept "projects/x/topics/name" or just "name"
+    return topic.split("/")[-1]
+
+def _post(endpoint: str, envelope: dict):
+    for base_url, app in _push_apps.items():
+        if endpoint.startswith(base_url):
+            path = endpoint[len(base_url):] or "/"
+            response = app.test_client().post(path, json=envelope)
+            return response.status_code
+
+    import requests
+    response = requests.post(endpoint, json=envelope)
+    return response.status_code
+
+def _deliver(subscription: str, endpoint: str, envelope: dict, max_attempts: int):
+    global _in_flight
+    try:
+        for attempt in range(1, max_attempts + 1):
+            envelope["deliveryAttempt"] = attempt
+            start = time.time()
+            try:
+                status = _post(endpoint, envelope)
+            except Exception as err:
+                logging.error(f"Local push to {endpoint} failed: {str(err)}")
+                status = 500
+            with _lock:
+                _stats["delivery_seconds"] += time.time() - start
+            if 200 <= status < 300:
+                with _lock:
+                    _stats["delivered"] += 1
+                return
+            logging.warning(f"Local push to {endpoint} for {subscription} returned {status} - attempt {attempt}")
+        with _lock:
+            _stats["failed"] += 1
+    finally:
+        with _idle:
+            _in_flight -= 1
+            _idle.notify_all()
+
+def publish(topic: str, data: bytes, attributes: dict=None) -> str:
+    """Fans the message out to every push subscription on the topic, in background threads"""
+    global _message_count, _in_flight
+    topic = _topic_name(topic)
+    with _lock:
+        if topic not in _topics:
+            raise NotFound(f"Topic {topic} not found")
+        _message_count += 1
+        message_id = str(_message_count)
+        _stats["published"] += 1
+        targets = [(name, sub["push_endpoint"]) for name, sub in _subscriptions.items()
+                   if sub["topic"] == topic and sub["push_endpoint"]]
+        _in_flight += len(targets)
+
+    for subscription, endpoint in targets:
+        envelope = {
+            "message": {
+                "data": base64.b64encode(data).decode("utf-8"),
+                "attributes": dict(attributes or {}),
+                "messageId": message_id,
+                "publishTime": datetime.datetime.utcnow().isoformat() + "Z"
+            },
+            "subscription": subscription
+        }
+        _executor.submit(_deliver, subscription, endpoint, envelope,
+                         int(os.getenv("LOCAL_PUBSUB_MAX_ATTEMPTS", 5)))
+
+    return message_id
+
+
+class LocalPublisherClient:
+    """The subset of pubsub_v1.PublisherClient used by PubSubManager"""
+
+    def get_topic(self, request: dict):
+        topic = _topic_name(request["topic"])
+        if topic not in _topics:
+            raise NotFound(f"Topic {topic} not found")
+        return {"name": request["topic"]}
+
+    def create_topic(self, request: dict):
+        with _lock:
+            _topics.add(_topic_name(request["name"]))
+        return {"name": request["name"]}
+
+    def publish(self, topic: str, data: bytes, **attrs):
+        future = Future()
+        try:
+            future.set_result(publish(topic, data, attrs))
+        except Exception as err:
+            future.set_exception(err)
+        return future
+
+
+class LocalSubscriberClient:
+    """The subset of pubsub_v1.SubscriberClient used by PubSubManager"""
+
+    def get_subscription(self, subscription: str):
+        name = subscription.split("/")[-1]
+        if name not in _subscriptions:
+            raise NotFound(f"Subscription {name} not found")
+        return _subscriptions[name]
+
+    def create_subscription(self, name: str, topic: str, push_config=None, **kwargs):
+        sub_name = name.split("/")[-1]
+        with _lock:
+            if sub_name in _subscriptions:
+                raise AlreadyExists(f"Subscription {sub_name} already exists")
+            _subscriptions[sub_name] = {
+                "topic": _topic_name(topic),
+                "push_endpoint": getattr(push_config, "push_endpoint", None)
+            }
+        return _subscriptions[sub_name]
+
+
+class LocalStorageClient:
+    """The subset of storage.Client used by the services, backed by a local directory"""
+
+    def __init__(self, root: str=None, notify_topic: str=None):
+        self.root = root or os.getenv("LOCAL_GCS_DIR", os.path.join(tempfile.gettempdir(), "edmonbrain_gcs"))
+        self.notify_topic = notify_topic or os.getenv("LOCAL_GCS_NOTIFY_TOPIC", None)
+        os.makedirs(self.root, exist_ok=True)
+
+    def bucket(self, bucket_name: str):
+        return LocalBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_name: str):
+        bucket = self.bucket(bucket_name)
+        os.makedirs(bucket.path, exist_ok=True)
+        return bucket
+
+
+class LocalBucket:
+
+    def __init__(self, client: LocalStorageClient, name: str):
+        self.client = client
+        self.name = name.replace("gs://", "")
+        self.path = os.path.join(client.root, self.name)
+
+    def blob(self, blob_name: str, **kwargs):
+        return LocalBlob(self, blob_name)
+
+    def get_blob(self, blob_name: str, **kwargs):
+        blob = self.blob(blob_name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+
+class LocalBlob:
+
+    def __init__(self, bucket: LocalBucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, name)
+        self.meta_path = os.path.join(bucket.path, ".meta", name + ".json")
+        self.metadata = None
+        self.generation = None
+        self.md5_hash = None
+        self.size = None
+        self.updated = None
+        self.chunk_size = None
+
+    def exists(self, **kwargs):
+        return os.path.exists(self.path)
+
+    def reload(self, **kwargs):
+        if not self.exists():
+            raise NotFound(f"gs://{self.bucket.name}/{self.name} not found")
+        with open(self.meta_path, "r") as f:
+            meta = json.load(f)
+        self.metadata = meta.get("metadata")
+        self.generation = meta["generation"]
+        self.md5_hash = meta["md5_hash"]
+        self.size = meta["size"]
+        self.updated = datetime.datetime.fromisoformat(meta["updated"])
+
+    def _check_precondition(self, if_generation_match):
+        if if_generation_match == 0 and self.exists():
+            from google.api_core.exceptions import PreconditionFailed
+            raise PreconditionFailed(f"gs://{self.bucket.name}/{self.name} already exists")
+
+    def _finalize(self, tmp_path: str, if_generation_match=None):
+        # the meta is in place before the data is renamed over the blob path, so a blob that exists always has it
+        tmp_meta = None
+        try:
+            with open(tmp_path, "rb") as f:
+                md5 = hashlib.md5()
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    md5.update(block)
+            self.md5_hash = base64.b64encode(md5.digest()).decode("utf-8")
+            self.size = os.path.getsize(tmp_path)
+            self.generation = time.time_ns()
+            self.updated = datetime.datetime.now(datetime.timezone.utc)
+            os.makedirs(os.path.dirname(self.meta_path), exist_ok=True)
+            fd, tmp_meta = tempfile.mkstemp(dir=os.path.dirname(self.meta_path), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"metadata": self.metadata, "generation": self.generation, "md5_hash": self.md5_hash,
+                           "size": self.size, "updated": self.updated.isoformat()}, f)
+            with _blob_lock:
+                self._check_precondition(if_generation_match)
+                os.replace(tmp_meta, self.meta_path)
+                os.replace(tmp_path, self.path)
+        finally:
+            for path in (tmp_path, tmp_meta):
+                if path and os.path.exists(path):
+                    os.remove(path)
+        self._notify()
+
+    def _temp_file(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".upload-")
+
+    def _notify(self):
+        topic = self.bucket.client.notify_topic
+        if topic is None:
+            return
+        vector_name = self.name.split("/")[0] if "/" in self.name else ""
+        topic = topic.format(vector_name=vector_name)
+        resource = {"bucket": self.bucket.name, "name": self.name, "generation": str(self.generation),
+                    "md5Hash": self.md5_hash, "size": str(self.size), "metadata": self.metadata}
+        attributes = {"eventType": "OBJECT_FINALIZE", "payloadFormat": "JSON_API_V1",
+                      "bucketId": self.bucket.name, "objectId": self.name,
+                      "objectGeneration": str(self.generation)}
+        try:
+            publish(topic, json.dumps(resource).encode("utf-8"), attributes)
+        except NotFound:
+            logging.info(f"No local topic {topic} to notify about gs://{self.bucket.name}/{self.name}")
+
+    def upload_from_filename(self, filename: str, if_generation_match=None, **kwargs):
+        self._check_precondition(if_generation_match)
+        fd, tmp_path = self._temp_file()
+        os.close(fd)
+        shutil.copyfile(filename, tmp_path)
+        self._finalize(tmp_path, if_generation_match)
+
+    def upload_from_string(self, data, if_generation_match=None, **kwargs):
+        self._check_precondition(if_generation_match)
+        fd, tmp_path = self._temp_file()
+        with os.fdopen(fd, "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+        self._finalize(tmp_path, if_generation_match)
+
+    def download_to_filename(self, filename: str, **kwargs):
+        if not self.exists():
+            raise NotFound(f"gs://{self.bucket.name}/{self.name} not found")
+        shutil.copyfile(self.path, filename)
+
+    def download_as_bytes(self, start: int=None, end: int=None, **kwargs):
+        if not self.exists():
+            raise NotFound(f"gs://{self.bucket.name}/{self.name} not found")
+        with open(self.path, "rb") as f:
+            if start:
+                f.seek(start)
+            if end is not None:
+                return f.read(end - (start or 0) + 1)
+            return f.read()
+
+    def download_as_text(self, **kwargs):
+        return self.download_as_bytes(**kwargs).decode("utf-8")
+
+    def open(self, mode: str="r", **kwargs):
+        if "r" in mode:
+            if not self.exists():
+                raise NotFound(f"gs://{self.bucket.name}/{self.name} not found")
+            if "b" in mode:
+                return open(self.path, mode)
+            return open(self.path, mode.replace("t", ""), encoding=kwargs.get("encoding") or "utf-8",
+                        errors=kwargs.get("errors"))
+        raise NotImplementedError("LocalBlob only supports reading via open()")
@@ -0,0 +1,58 @@
+import os
+import logging
+import threading
+
+# Factories for the Google Cloud clients used by the services.
+# Set EDMONBRAIN_TRANSPORT=local to swap them for the in-process stand-ins in utils.local_transport
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def is_local():
+    return os.getenv("EDMONBRAIN_TRANSPORT", "gcp") == "local"
+
+def _shared(name, create):
+    if name not in _clients:
+        with _clients_lock:
+            if name not in _clients:
+                logging.debug(f"Creating shared {name} client - local transport: {is_local()}")
+                _clients[name] = create()
+    return _clients[name]
+
+def get_default_project_id():
+    if is_local():
+        return os.environ.get('GOOGLE_CLOUD_PROJECT', 'local')
+    from google.auth import default
+    # Get the project ID from the default Google Cloud settings or the environment variable
+    _, project_id = default()
+    return project_id or os.environ.get('GOOGLE_CLOUD_PROJECT')
+
+def get_storage_client():
+    """Returns a process-wide Cloud Storage client"""
+    def create():
+        if is_local():
+            from utils.local_transport import LocalStorageClient
+            return LocalStorageClient()
+        from google.cloud import storage
+        return storage.Client()
+    return _shared("storage", create)
+
+def new_publisher_client(batch_settings=None, flow_control=None):
+    if is_local():
+        from utils.local_transport import LocalPublisherClient
+        return LocalPublisherClient()
+    from google.cloud import pubsub_v1
+    publisher_options = pubsub_v1.types.PublisherOptions(flow_control=flow_control) \
+        if flow_control is not None else ()
+    return pubsub_v1.PublisherClient(batch_settings=batch_settings or (),
+                                     publisher_options=publisher_options)
+
+def get_subscriber_client():
+    """Returns a process-wide Pub/Sub subscriber client"""
+    def create():
+        if is_local():
+            from utils.local_transport import LocalSubscriberClient
+            return LocalSubscriberClient()
+        from google.cloud import pubsub_v1
+        return pubsub_v1.SubscriberClient()
+    return _shared("subscriber", create)
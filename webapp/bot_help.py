@@ -9,7 +9,7 @@ import tempfile
 
 import qna.database as db
 import chunker.publish_to_pubsub_embed as pbembed
-from google.cloud import storage
+from utils.transport import get_storage_client
 from utils.config import load_config
 
 
@@ -85,6 +85,8 @@ def process_pubsub(data):
 def app_to_store(safe_file_name, vector_name, via_bucket_pubsub=False, metadata:dict=None):
     
     gs_file = pbembed.add_file_to_gcs(safe_file_name, vector_name, metadata=metadata)
+    if gs_file is None:
+        raise ValueError(f"Could not upload {safe_file_name} to GCS")
 
     # we send the gs:// to the pubsub ourselves
     if not via_bucket_pubsub:
@@ -211,11 +213,27 @@ def handle_special_commands(user_input, vector_name, chat_history):
             return {"result": f"*sources:*\n{msg}"}
 
 
+    elif user_input.startswith("!ingeststatus"):
+        from qna.ingest_jobs import get_jobs
+        source = user_input.replace("!ingeststatus", "").strip() or None
+        jobs = get_jobs(vector_name, source=source, limit=10)
+        if not jobs:
+            return {"result": "No ingest jobs were found"}
+        lines = []
+        for job in jobs:
+            line = f"{job['source']}: {job['status']} {job['counts']}"
+            if "complete" in job["timings"]:
+                line += f" in {job['timings']['complete']}s"
+            lines.append(line)
+        msg = "\n".join(lines)
+        return {"result": f"*ingest jobs:*\n{msg}"}
+
     elif user_input.startswith("!help"):
         return {"result":f"""*Commands*
 - `!saveurl [https:// url]` - add the contents found at this URL to database. 
 - `!help`- see this message
 - `!sources` - get sources added in last 24hrs
+- `!ingeststatus [gs:// source]` - see the progress of the latest ingests, or of one source
 - `!deletesource [gs:// source]` - delete a source from database
 - `!dream` - get last night's dream. Use `!dream 2023-07-30` to get a dream from a specific date. Also works with `!journal` and `!practice`
 *Tips*
@@ -258,7 +276,7 @@ def get_gcs_text_file(user_input, vector_name):
 
     bucket_name = os.getenv("GCS_BUCKET").replace("gs://","") 
     source_blob_name = f"{vector_name}/{command}/{command}_{dream_date_str}.txt"
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     bucket = storage_client.bucket(bucket_name)
 
     blob = bucket.blob(source_blob_name)